@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Click, Link
+from .models import Click, Link, LinkStats
 
 
 @admin.register(Link)
@@ -12,3 +12,8 @@ class LinkAdmin(admin.ModelAdmin):
 @admin.register(Click)
 class ClickAdmin(admin.ModelAdmin):
     list_display = ('link', 'ip_address', 'clicks_count', 'clicked_date', )
+
+
+@admin.register(LinkStats)
+class LinkStatsAdmin(admin.ModelAdmin):
+    list_display = ('link', 'total_clicks', 'unique_ips', 'last_clicked', )
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AppUrlsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app_urls'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,89 @@
+"""
+PostgreSQL backend that takes its connections from a `ConnectionPool` per
+worker process and database instead of connecting for every request.
+
+Django still opens and closes a connection around each request (with
+`CONN_MAX_AGE = 0`), which here checks one out of the pool and back in.
+Connections are returned with their transaction rolled back; other session
+state, like settings changed with `SET`, is kept. The pool is configured
+by the `POOL` dict of the database settings, see the `SQL_POOL_*`
+environment variables.
+"""
+import os
+import threading
+
+from django.db.backends.postgresql import base, creation
+from psycopg2 import extensions
+
+from app_urls.pool import ConnectionPool
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def check_connection(connection):
+    if connection.closed:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    if not connection.autocommit:
+        connection.rollback()
+    return True
+
+
+def reset_connection(connection):
+    if connection.closed:
+        return False
+    status = connection.info.transaction_status
+    if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if status != extensions.TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+    return True
+
+
+def get_pool(alias, settings_dict):
+    """
+    Returns the pool of the database `alias` in this process. Forked
+    processes get their own pools, and a changed database (e.g. the test
+    database) gets a new one.
+    """
+    key = (os.getpid(), alias)
+    target = tuple(settings_dict[name] for name in ('NAME', 'USER', 'HOST', 'PORT'))
+    entry = _pools.get(key)
+    if entry is None or entry[0] != target:
+        with _pools_lock:
+            entry = _pools.get(key)
+            if entry is None or entry[0] != target:
+                if entry is not None:
+                    entry[1].close_idle()
+                pool = ConnectionPool(check=check_connection, reset=reset_connection, **settings_dict.get('POOL', {}))
+                entry = _pools[key] = (target, pool)
+    return entry[1]
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle connections to the test database would keep it from being dropped.
+        self.connection.pool.close_idle()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.acquire(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # Set by the parent for new connections only.
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.release(self.connection)
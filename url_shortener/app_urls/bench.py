@@ -0,0 +1,57 @@
+"""
+Timing helpers used by the benchmark commands.
+"""
+import random
+import time
+from itertools import accumulate
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the `fraction` (0..1) percentile of `sorted_values`
+    using the nearest-rank method.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    """
+    Returns count, mean and p50/p95/p99 of `latencies` (in seconds),
+    reported in milliseconds.
+    """
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        'count': len(values),
+        'mean_ms': round(total / len(values) * 1000, 4) if values else 0.0,
+        'p50_ms': round(percentile(values, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 4),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 4),
+    }
+
+
+def time_calls(func, calls):
+    """
+    Calls `func(*args)` for every `args` of `calls` and returns
+    the latency of each call in seconds.
+    """
+    latencies = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def zipf_choices(population, k, s=1.1, rng=None):
+    """
+    Returns `k` items drawn from `population` with Zipf popularity:
+    the n-th item is picked with probability proportional to 1 / n**s,
+    so the first items get most of the traffic, like popular short links.
+    """
+    rng = rng or random.Random()
+    cum_weights = list(accumulate(1 / rank ** s for rank in range(1, len(population) + 1)))
+    return rng.choices(population, cum_weights=cum_weights, k=k)
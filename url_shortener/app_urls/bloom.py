@@ -0,0 +1,396 @@
+"""
+Bloom filter of all aliases, so that redirects for aliases that don't exist
+(scanners, typos) are answered without a database query.
+
+When `ALIAS_FILTER_DIR` is set, the filter lives in a file in that directory
+that the workers of a host map into memory and share. It's built in the
+background by the first worker that needs it, from a streamed
+`values_list('alias')`, and rebuilt every `ALIAS_FILTER_REBUILD_INTERVAL`
+seconds, which also drops deleted aliases. Until it's built, every alias
+may exist. New aliases are added to the file by every process that
+creates links (see `app_urls.signals` and `app_urls.bulk`), after waiting
+for a rebuild in progress. A worker also adds the aliases it created again
+to a rebuilt filter when it notices it, within `REFRESH_INTERVAL` seconds.
+Links created by processes that don't share the file, e.g. on another host,
+are added by every worker every `ALIAS_FILTER_SYNC_INTERVAL` seconds, which
+reads the links with ids above those the filter is known to hold.
+
+A Bloom filter has no false negatives, so an alias it doesn't contain
+doesn't exist. With the default `ALIAS_FILTER_ERROR_RATE` about 1% of the
+unknown aliases still reach the database.
+"""
+import fcntl
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from hashlib import blake2b
+from mmap import mmap
+
+from django.conf import settings
+from django.db import connection
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+from .models import Link
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ALSBLM'
+VERSION = 2
+# Magic, format version, number of bits and hash functions, number of
+# aliases it was built with, the time it was built and the id below which
+# it holds the aliases of all links.
+HEADER = struct.Struct('<6sHQIQdQ')
+
+# Seconds between checks for a rebuilt or outdated filter file.
+REFRESH_INTERVAL = 1
+
+# Seconds a link's transaction may take to commit after it was created.
+# Links with lower ids may still show up until then, so they are read again
+# by the next sync.
+SYNC_MARGIN = 60
+
+
+def get_size(capacity, error_rate):
+    """
+    Returns the number of bits and hash functions of a filter holding
+    `capacity` values with a false positive rate of `error_rate`.
+    """
+    num_bits = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+    return num_bits, num_hashes
+
+
+class BloomFilter:
+    """
+    Bloom filter of strings over `buffer`, a bytearray or a memory map of
+    at least `num_bits` bits.
+    """
+
+    def __init__(self, buffer, num_bits, num_hashes, offset=0):
+        self.buffer = buffer
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.offset = offset
+
+    @classmethod
+    def create(cls, capacity, error_rate):
+        num_bits, num_hashes = get_size(capacity, error_rate)
+        return cls(bytearray((num_bits + 7) // 8), num_bits, num_hashes)
+
+    def get_positions(self, value):
+        # Double hashing: the i-th position is h1 + i * h2.
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, value):
+        buffer, offset = self.buffer, self.offset
+        for position in self.get_positions(value):
+            buffer[offset + (position >> 3)] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        buffer, offset = self.buffer, self.offset
+        return all(buffer[offset + (position >> 3)] & (1 << (position & 7)) for position in self.get_positions(value))
+
+    @property
+    def size(self):
+        """
+        Size of the bit array in bytes.
+        """
+        return (self.num_bits + 7) // 8
+
+
+class AliasFilter:
+    """
+    A worker's handle on the shared alias filter file in `directory`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'aliases.bloom')
+        self._lock = threading.RLock()
+        self._adds_lock_file = None
+        self._bloom = None
+        self._inode = None
+        self._built_at = 0
+        self._aliases = 0
+        self._next_refresh = 0
+        self._building = False
+        self._synced_id = 0
+        self._next_sync = 0
+        self._syncing = False
+        # Aliases this worker added since it opened the current file.
+        self._recent = []
+
+    def may_exist(self, alias):
+        """
+        Returns False if `alias`, normalized, definitely doesn't exist.
+        """
+        self.refresh()
+        bloom = self._bloom
+        return bloom is None or alias in bloom
+
+    def add(self, aliases):
+        """
+        Adds `aliases` to the shared file, also in a process that hasn't
+        looked up any alias yet (e.g. a management command).
+        """
+        aliases = list(aliases)
+        # A rebuild in progress, here or in another worker, may have read
+        # the aliases before these were saved, so add them to its file.
+        with self._build_lock(fcntl.LOCK_SH):
+            with self._lock:
+                self._recent.extend(aliases)
+                if self._get_inode() != self._inode:
+                    # Adds the recent aliases to the file, if there's one.
+                    self._open()
+                elif self._bloom is not None:
+                    self._add(aliases)
+
+    @contextmanager
+    def _build_lock(self, operation):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, operation)
+            yield
+
+    def _add(self, aliases):
+        # Bits are set with read-modify-write, so adds of all workers are
+        # serialized with a lock.
+        if self._adds_lock_file is None:
+            self._adds_lock_file = open(self.path + '.adds', 'w')
+        fcntl.flock(self._adds_lock_file, fcntl.LOCK_EX)
+        try:
+            for alias in aliases:
+                self._bloom.add(alias)
+        finally:
+            fcntl.flock(self._adds_lock_file, fcntl.LOCK_UN)
+
+    def refresh(self, force=False):
+        """
+        Opens the filter file again if it was rebuilt, and starts a rebuild
+        in the background if it's missing or outdated. Does nothing if it
+        ran less than `REFRESH_INTERVAL` seconds ago, unless `force`.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_refresh:
+            return
+        with self._lock:
+            self._next_refresh = now + REFRESH_INTERVAL
+            if self._get_inode() != self._inode:
+                self._open()
+            if self._bloom is None or time.time() - self._built_at >= settings.ALIAS_FILTER_REBUILD_INTERVAL:
+                self.rebuild_in_background()
+            elif now >= self._next_sync:
+                self.sync_in_background()
+
+    def _get_inode(self):
+        try:
+            return os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _open(self):
+        self._close()
+        try:
+            with open(self.path, 'r+b') as file:
+                mapped = mmap(file.fileno(), 0)
+                inode = os.fstat(file.fileno()).st_ino
+        except FileNotFoundError:
+            return
+        magic, version = HEADER.unpack_from(mapped)[:2]
+        if magic != MAGIC or version != VERSION:
+            logger.warning('%s is not an alias filter of version %s, rebuilding it.', self.path, VERSION)
+            return
+        _, _, num_bits, num_hashes, aliases, built_at, synced_id = HEADER.unpack_from(mapped)
+        self._bloom = BloomFilter(mapped, num_bits, num_hashes, offset=HEADER.size)
+        self._inode = inode
+        self._aliases, self._built_at, self._synced_id = aliases, built_at, synced_id
+        self._next_sync = time.monotonic() + settings.ALIAS_FILTER_SYNC_INTERVAL
+        recent, self._recent = self._recent, []
+        if recent:
+            self._add(recent)
+
+    def _close(self):
+        # The map isn't closed, lookups in other threads may still use it.
+        # It's unmapped once they're done with it.
+        self._bloom = self._inode = None
+        self._built_at = 0
+
+    def rebuild_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._rebuild_in_thread, name='alias-filter', daemon=True).start()
+
+    def _rebuild_in_thread(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception('Could not build the alias filter.')
+        finally:
+            connection.close()
+            self._building = False
+
+    def sync_in_background(self):
+        with self._lock:
+            self._next_sync = time.monotonic() + settings.ALIAS_FILTER_SYNC_INTERVAL
+            if self._syncing:
+                return
+            self._syncing = True
+        threading.Thread(target=self._sync_in_thread, name='alias-filter-sync', daemon=True).start()
+
+    def _sync_in_thread(self):
+        try:
+            self.sync()
+        except Exception:
+            logger.exception('Could not sync the alias filter.')
+        finally:
+            connection.close()
+            self._syncing = False
+
+    def sync(self):
+        """
+        Adds the aliases of the links created since the filter was built or
+        last synced, including those created by processes that don't share
+        its file. Returns the number of aliases read.
+        """
+        with self._lock:
+            if self._bloom is None:
+                return 0
+            inode, synced_id = self._inode, self._synced_id
+        recent = timezone.now() - timedelta(seconds=SYNC_MARGIN)
+        aliases = []
+        new_synced_id = synced_id
+        advancing = True
+        links = Link.objects.filter(id__gt=synced_id).order_by('id').values_list('id', 'alias', 'date_created')
+        for link_id, alias, date_created in links.iterator(chunk_size=10000):
+            aliases.append(alias)
+            # Links with lower ids than a recent link may not be committed
+            # yet, so it and the links after it are read again next time.
+            advancing = advancing and date_created < recent
+            if advancing:
+                new_synced_id = link_id
+        with self._lock:
+            if self._inode == inode and self._bloom is not None:
+                self._add(aliases)
+                self._synced_id = max(self._synced_id, new_synced_id)
+        return len(aliases)
+
+    def rebuild(self, force=False):
+        """
+        Builds the filter from all aliases and replaces the shared file,
+        unless another worker is building it or, unless `force`, just did.
+        Returns whether it was built here.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if not force and self._read_built_at() > time.time() - settings.ALIAS_FILTER_REBUILD_INTERVAL:
+                self.refresh(force=True)
+                if self._bloom is not None:
+                    return False
+            self._build()
+        self.refresh(force=True)
+        return True
+
+    def _read_built_at(self):
+        try:
+            with open(self.path, 'rb') as file:
+                return HEADER.unpack(file.read(HEADER.size))[5]
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    def _build(self):
+        # Room for links created until the next rebuild.
+        capacity = max(settings.ALIAS_FILTER_MIN_CAPACITY, 2 * Link.objects.count())
+        bloom = BloomFilter.create(capacity, settings.ALIAS_FILTER_ERROR_RATE)
+        aliases = 0
+        # Links created within the sync margin may have lower ids than links
+        # not committed yet, so syncs start below the oldest of them.
+        recent = timezone.now() - timedelta(seconds=SYNC_MARGIN)
+        max_id = 0
+        min_recent_id = None
+        links = Link.objects.order_by().values_list('alias', 'id', 'date_created')
+        for alias, link_id, date_created in links.iterator(chunk_size=10000):
+            bloom.add(alias)
+            aliases += 1
+            if date_created < recent:
+                max_id = max(max_id, link_id)
+            elif min_recent_id is None or link_id < min_recent_id:
+                min_recent_id = link_id
+        synced_id = max_id if min_recent_id is None else min(max_id, min_recent_id - 1)
+        temporary_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(HEADER.pack(
+                MAGIC, VERSION, bloom.num_bits, bloom.num_hashes, aliases, time.time(), synced_id))
+            file.write(bloom.buffer)
+        os.replace(temporary_path, self.path)
+
+    def stats(self):
+        bloom = self._bloom
+        if bloom is None:
+            return {'ready': False}
+        return {
+            'ready': True,
+            'bytes': HEADER.size + bloom.size,
+            'aliases': self._aliases,
+            'num_hashes': bloom.num_hashes,
+            'age_seconds': round(time.time() - self._built_at),
+        }
+
+    def close(self):
+        with self._lock:
+            self._close()
+            if self._adds_lock_file is not None:
+                self._adds_lock_file.close()
+                self._adds_lock_file = None
+
+
+_alias_filter = None
+_alias_filter_lock = threading.Lock()
+
+
+def get_alias_filter():
+    """
+    Returns the process-wide `AliasFilter`, or None if `ALIAS_FILTER_DIR`
+    isn't set.
+    """
+    global _alias_filter
+    if _alias_filter is None and settings.ALIAS_FILTER_DIR:
+        with _alias_filter_lock:
+            if _alias_filter is None:
+                _alias_filter = AliasFilter(settings.ALIAS_FILTER_DIR)
+    return _alias_filter
+
+
+def may_exist(alias):
+    alias_filter = get_alias_filter()
+    return alias_filter is None or alias_filter.may_exist(alias)
+
+
+def add_aliases(aliases):
+    alias_filter = get_alias_filter()
+    if alias_filter is not None:
+        alias_filter.add(aliases)
+
+
+@receiver(setting_changed)
+def reset_alias_filter(setting, **kwargs):
+    global _alias_filter
+    if setting.startswith('ALIAS_FILTER_'):
+        if _alias_filter is not None:
+            _alias_filter.close()
+        _alias_filter = None
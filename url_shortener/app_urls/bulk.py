@@ -0,0 +1,161 @@
+"""
+Bulk link creation, shared by `BulkLinkCreateView` and the `import_links`
+command. Rows are validated with `URLShortenerForm`, given aliases and
+inserted with `bulk_create` one batch at a time, so imports of any size run
+in constant memory.
+"""
+import csv
+import json
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+
+from .bloom import add_aliases
+from .cache import invalidate_aliases
+from .forms import URLShortenerForm
+from .misc import generate_alias
+from .models import Link
+
+
+class BatchResult:
+    """
+    Outcome of one imported batch. `problems` lists a
+    (row number, alias, message) tuple for every row that wasn't created.
+    """
+
+    def __init__(self, processed):
+        self.processed = processed
+        self.created = []
+        self.problems = []
+
+    def add_problem(self, row_number, alias, message):
+        self.problems.append((row_number, alias, message))
+
+    def as_dict(self):
+        return {
+            'processed': self.processed,
+            'created': len(self.created),
+            'problems': [
+                {'row': row_number, 'alias': alias, 'error': message}
+                for row_number, alias, message in self.problems
+            ],
+        }
+
+
+def read_csv_rows(lines):
+    """
+    Yields (row number, row) for every row of a CSV with a `url` and an
+    optional `alias` column, given its header.
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_ndjson_rows(lines):
+    """
+    Yields (line number, row) for every non-empty line of newline delimited
+    JSON, with None as the row of lines that aren't valid JSON.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+
+def import_links(user, rows, batch_size=1000):
+    """
+    Creates links of `user` from `rows`, an iterable of (row number, dict
+    with `url` and optional `alias`). Yields a `BatchResult` per batch.
+    Rows with invalid data or an alias that is already taken are skipped
+    and reported; rows without an alias get a generated one.
+    """
+    rows = iter(rows)
+    aliases = generated_aliases()
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield import_batch(user, batch, aliases)
+
+
+def generated_aliases():
+    """
+    Yields candidate aliases for rows that don't specify one.
+    """
+    while True:
+        yield generate_alias()
+
+
+def import_batch(user, batch, aliases):
+    result = BatchResult(len(batch))
+    links = {}
+    needs_alias = []
+    for row_number, row in batch:
+        if not isinstance(row, dict):
+            result.add_problem(row_number, '', 'Expected a JSON object with a url.')
+            continue
+        form = URLShortenerForm(data={'url': row.get('url') or '', 'alias': row.get('alias') or ''})
+        if not form.is_valid():
+            message = '; '.join(error for errors in form.errors.values() for error in errors)
+            result.add_problem(row_number, row.get('alias') or '', message)
+            continue
+        alias = form.cleaned_data['alias'].lower()
+        link = Link(user=user, url=form.cleaned_data['url'], alias=alias)
+        if not alias:
+            needs_alias.append((row_number, link))
+        elif alias in links:
+            result.add_problem(row_number, alias, 'Alias appears more than once.')
+        else:
+            links[alias] = (row_number, link)
+
+    taken = set(Link.objects.filter(alias__in=links.keys()).values_list('alias', flat=True))
+    for alias in taken:
+        row_number, _ = links.pop(alias)
+        result.add_problem(row_number, alias, 'Alias already exists.')
+
+    while needs_alias:
+        candidates = {}
+        for row_number, link in needs_alias:
+            alias = next(aliases)
+            while alias in links or alias in candidates:
+                alias = next(aliases)
+            link.alias = alias
+            candidates[alias] = (row_number, link)
+        taken = set(Link.objects.filter(alias__in=candidates.keys()).values_list('alias', flat=True))
+        needs_alias = [candidates.pop(alias) for alias in taken]
+        links.update(candidates)
+
+    created = create_links(links, result)
+    result.created = created
+    result.problems.sort()
+    add_aliases(link.alias for link in created)
+    invalidate_aliases(link.alias for link in created)
+    return result
+
+
+def create_links(links, result):
+    """
+    Bulk creates the links of `links`, a mapping of alias to
+    (row number, link). If some alias was taken concurrently, the links are
+    created one by one and the conflicting rows are reported.
+    Returns the created links.
+    """
+    try:
+        with transaction.atomic():
+            Link.objects.bulk_create(link for _, link in links.values())
+        return [link for _, link in links.values()]
+    except IntegrityError:
+        pass
+    created = []
+    for alias, (row_number, link) in links.items():
+        try:
+            with transaction.atomic():
+                link.save()
+            created.append(link)
+        except IntegrityError:
+            result.add_problem(row_number, alias, 'Alias already exists.')
+    return created
@@ -0,0 +1,273 @@
+"""
+Alias resolution cache.
+
+`resolve_alias` maps an alias to the id and URL of its link through two
+tiers: a bounded LRU in each worker process, backed by the Django cache
+named by `LINK_CACHE_ALIAS` (shared by all workers when it is memcached or
+redis, as in `docker-compose.prod.yml`). A local-memory cache there is
+only another per-process tier, so its entries expire as soon as the LRU's
+do, or edits and deletions made in one worker would go unnoticed by the
+others for `LINK_CACHE_TIMEOUT`. Unknown aliases are cached too, for a shorter time, so repeated
+hits on a missing alias don't reach the database. With `ALIAS_FILTER_DIR`
+set, aliases the filter of `app_urls.bloom` doesn't contain are unknown
+without asking either tier.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+from .bloom import get_alias_filter
+from .metrics import ALIAS_CACHE_LOOKUPS
+from .misc import normalize_alias
+from .models import Link
+from .routers import reading_from_replica
+
+# What a redirect needs to know about a link.
+ResolvedLink = namedtuple('ResolvedLink', ['id', 'url', 'redirect_type', 'cache_max_age', 'click_sampling'])
+
+# Cached value of aliases that don't exist.
+NOT_FOUND = ()
+
+# Returned by `AliasCache.resolve_local` for aliases not cached locally.
+MISS = object()
+
+_missing = object()
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded LRU mapping whose entries expire
+    `timeout` seconds after they were set.
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _missing)
+            if item is _missing:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class AliasCache:
+    """
+    Two-tier alias -> `ResolvedLink` cache with hit/miss counters.
+    """
+
+    # Bumped whenever the fields of `ResolvedLink` change.
+    key_prefix = 'link-alias:v2:'
+
+    def __init__(self):
+        self.local = LRUCache(settings.LINK_CACHE_LOCAL_SIZE,
+                              settings.LINK_CACHE_LOCAL_TIMEOUT)
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.negative_hits = 0
+        self.filtered = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        return caches[settings.LINK_CACHE_ALIAS]
+
+    normalize = staticmethod(normalize_alias)
+
+    def get_shared_key(self, key):
+        return self.key_prefix + key
+
+    def resolve(self, alias):
+        """
+        Returns the `ResolvedLink` of `alias`, or None if it doesn't exist.
+        """
+        link = self.resolve_local(alias)
+        if link is MISS:
+            link = self.resolve_remote(alias)
+        return link
+
+    def resolve_local(self, alias):
+        """
+        Resolves `alias` from this worker's tier and the alias filter only,
+        without any I/O. Returns `MISS` if the alias isn't cached locally
+        and may exist.
+        """
+        key = self.normalize(alias)
+        value = self.local.get(key, _missing)
+        if value is _missing:
+            alias_filter = get_alias_filter()
+            if alias_filter is not None and not alias_filter.may_exist(key):
+                self.filtered += 1
+                ALIAS_CACHE_LOOKUPS.inc('filtered')
+                return None
+            return MISS
+        self.local_hits += 1
+        ALIAS_CACHE_LOOKUPS.inc('local_hit')
+        return self._to_link(value)
+
+    def resolve_remote(self, alias):
+        """
+        Resolves `alias` from the shared cache or, failing that,
+        the database and caches the result in both tiers.
+        """
+        key = self.normalize(alias)
+        value = self.shared.get(self.get_shared_key(key), _missing)
+        if value is not _missing:
+            self.shared_hits += 1
+            ALIAS_CACHE_LOOKUPS.inc('shared_hit')
+            self.local.set(key, value, self._get_local_timeout(value))
+            return self._to_link(value)
+        self.misses += 1
+        ALIAS_CACHE_LOOKUPS.inc('miss')
+        value = self._load(key)
+        self._set(key, value)
+        return value or None
+
+    def _to_link(self, value):
+        if value == NOT_FOUND:
+            self.negative_hits += 1
+            return None
+        return ResolvedLink(*value)
+
+    def _load(self, key):
+        rows = Link.objects.filter(alias=key).order_by().values_list(*ResolvedLink._fields)
+        row = rows.first()
+        if row is None and reading_from_replica():
+            # Links created moments ago may not have reached the replica yet,
+            # don't cache them as missing.
+            row = rows.using(DEFAULT_DB_ALIAS).first()
+        if row is None:
+            return NOT_FOUND
+        return ResolvedLink(*row)
+
+    def _get_local_timeout(self, value):
+        if value == NOT_FOUND:
+            return min(settings.LINK_CACHE_LOCAL_TIMEOUT, settings.LINK_CACHE_NEGATIVE_TIMEOUT)
+        return settings.LINK_CACHE_LOCAL_TIMEOUT
+
+    def _get_shared_timeout(self, value):
+        timeout = settings.LINK_CACHE_NEGATIVE_TIMEOUT if value == NOT_FOUND else settings.LINK_CACHE_TIMEOUT
+        if isinstance(self.shared, LocMemCache):
+            # Not shared, other workers can't invalidate it.
+            timeout = min(timeout, settings.LINK_CACHE_LOCAL_TIMEOUT)
+        return timeout
+
+    def _set(self, key, value):
+        shared_timeout = self._get_shared_timeout(value)
+        if value != NOT_FOUND:
+            value = tuple(value)
+        self.shared.set(self.get_shared_key(key), value, shared_timeout)
+        self.local.set(key, value, self._get_local_timeout(value))
+
+    def invalidate(self, alias):
+        """
+        Forgets `alias` in this worker and in the shared cache. Other workers
+        keep their local copy for at most `LINK_CACHE_LOCAL_TIMEOUT` seconds,
+        which is also as long as a local-memory "shared" cache keeps it.
+        """
+        key = self.normalize(alias)
+        self.local.delete(key)
+        self.shared.delete(self.get_shared_key(key))
+
+    def invalidate_many(self, aliases):
+        keys = [self.normalize(alias) for alias in aliases]
+        for key in keys:
+            self.local.delete(key)
+        self.shared.delete_many([self.get_shared_key(key) for key in keys])
+
+    def clear(self):
+        """
+        Empties the local tier and resets the counters.
+        """
+        self.local.clear()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.local_hits = self.shared_hits = self.negative_hits = self.filtered = self.misses = 0
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.filtered + self.misses
+        alias_filter = get_alias_filter()
+        return {
+            'local_size': len(self.local),
+            'local_max_size': self.local.max_size,
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'negative_hits': self.negative_hits,
+            'filtered': self.filtered,
+            'misses': self.misses,
+            'hit_ratio': (lookups - self.misses) / lookups if lookups else 0.0,
+            'alias_filter': alias_filter.stats() if alias_filter is not None else None,
+        }
+
+
+alias_cache = AliasCache()
+
+
+def resolve_alias(alias):
+    """
+    Returns the `ResolvedLink` of `alias`, or None if it doesn't exist.
+    """
+    return alias_cache.resolve(alias)
+
+
+async def resolve_alias_async(alias):
+    """
+    Async variant of `resolve_alias`. Local hits are answered in the event
+    loop; shared cache and database lookups run in a worker thread.
+    """
+    link = alias_cache.resolve_local(alias)
+    if link is MISS:
+        link = await sync_to_async(alias_cache.resolve_remote)(alias)
+    return link
+
+
+def invalidate_alias(alias):
+    alias_cache.invalidate(alias)
+
+
+def invalidate_aliases(aliases):
+    alias_cache.invalidate_many(aliases)
+
+
+@receiver(setting_changed)
+def reset_alias_cache(setting, **kwargs):
+    global alias_cache
+    if setting.startswith('LINK_CACHE_'):
+        alias_cache = AliasCache()
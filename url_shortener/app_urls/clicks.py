@@ -0,0 +1,463 @@
+"""
+Click recording backends.
+
+Every redirect hands its click to the backend named by the `CLICK_RECORDER`
+setting (see `get_click_recorder`). `DirectClickRecorder` writes each click
+as it happens, `BufferedClickRecorder` aggregates clicks in process memory
+and writes them in bulk once the response has been sent, and
+`SpoolClickRecorder` queues them on local disk for the `click_worker`
+command.
+"""
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import IntegrityError, InterfaceError, OperationalError, connections, transaction
+from django.db.models import DateField, F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from .hll import HyperLogLog
+from .metrics import CLICK_BUFFER_DEPTH, CLICK_FLUSH_ERRORS, CLICK_FLUSH_LATENCY, CLICKS_DROPPED
+from .models import Click, DailyClicks, Link, LinkStats
+from .spool import ClickSpool
+
+logger = logging.getLogger(__name__)
+
+
+def write_clicks(increments):
+    """
+    Writes `increments`, a mapping of (link_id, clicked_date, ip_address)
+    to a number of clicks, in a single transaction.
+    Existing rows are incremented atomically with
+    `clicks_count = clicks_count + n`, missing rows are bulk created and
+    increments of links deleted in the meantime are dropped.
+    The `LinkStats` and `DailyClicks` rollups of the clicked links,
+    including their unique IP sketches, are updated as well.
+    Rows are written in (link_id, clicked_date, ip_address) order, so that
+    concurrent flushes lock them in the same order and can't deadlock.
+    Returns the number of clicks written.
+    """
+    if not increments:
+        return 0
+    existing_link_ids = set(Link.objects.filter(
+        id__in={link_id for link_id, _, _ in increments}
+    ).order_by().values_list('id', flat=True))
+    written = 0
+    link_clicks = Counter()
+    daily_clicks = Counter()
+    daily_ips = defaultdict(set)
+    last_clicked = {}
+    with transaction.atomic():
+        new_clicks = []
+        for (link_id, clicked_date, ip_address), count in sorted(increments.items()):
+            if link_id not in existing_link_ids:
+                continue
+            updated = Click.objects.filter(
+                link_id=link_id,
+                clicked_date=clicked_date,
+                ip_address=ip_address,
+            ).update(clicks_count=F('clicks_count') + count)
+            if not updated:
+                new_clicks.append(Click(
+                    link_id=link_id,
+                    clicked_date=clicked_date,
+                    ip_address=ip_address,
+                    clicks_count=count,
+                ))
+            written += count
+            link_clicks[link_id] += count
+            last_clicked[link_id] = max(last_clicked.get(link_id, clicked_date), clicked_date)
+            daily_clicks[(link_id, clicked_date)] += count
+            daily_ips[(link_id, clicked_date)].add(ip_address)
+        new_unique_ips = count_new_unique_ips(new_clicks)
+        create_clicks(new_clicks)
+        for link_id, count in sorted(link_clicks.items()):
+            add_link_stats(link_id, count, new_unique_ips[link_id], last_clicked[link_id])
+        for (link_id, clicked_date), count in sorted(daily_clicks.items()):
+            increment_or_create(DailyClicks, {'link_id': link_id, 'date': clicked_date},
+                                {'clicks': F('clicks') + count}, {'clicks': count})
+        add_to_sketches(daily_ips)
+    return written
+
+
+# Errors of an unavailable database, after which clicks are retried later
+# rather than written one row at a time.
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+
+
+def write_click_row(key, count):
+    """
+    Writes the `count` clicks of `key`, a (link_id, clicked_date, ip_address)
+    tuple, on their own, e.g. after writing them with others failed.
+    Returns (clicks written, error), where error is the exception that
+    rejected the row, e.g. for an IP address the database doesn't accept,
+    or None. `CONNECTION_ERRORS` are raised.
+    """
+    try:
+        return write_clicks({key: count}), None
+    except CONNECTION_ERRORS:
+        raise
+    except Exception as e:
+        return 0, e
+
+
+def create_clicks(new_clicks):
+    """
+    Bulk creates `new_clicks`. If another worker created some of the same
+    (link, date, ip) rows in the meantime, the `unique_click` constraint
+    fails the batch and the clicks are added one by one instead.
+    """
+    try:
+        with transaction.atomic():
+            Click.objects.bulk_create(new_clicks)
+    except IntegrityError:
+        for click in new_clicks:
+            increment_or_create(Click, {
+                'link_id': click.link_id,
+                'clicked_date': click.clicked_date,
+                'ip_address': click.ip_address,
+            }, {'clicks_count': F('clicks_count') + click.clicks_count}, {'clicks_count': click.clicks_count})
+
+
+def count_new_unique_ips(new_clicks, batch_size=500):
+    """
+    Returns a Counter of link id -> number of IPs among the (not yet saved)
+    `new_clicks` that never clicked that link on another day.
+    """
+    pairs = {(click.link_id, click.ip_address) for click in new_clicks}
+    seen = set()
+    pair_list = list(pairs)
+    for i in range(0, len(pair_list), batch_size):
+        batch = pair_list[i:i + batch_size]
+        seen.update(Click.objects.filter(
+            link_id__in={link_id for link_id, _ in batch},
+            ip_address__in={ip_address for _, ip_address in batch},
+        ).order_by().values_list('link_id', 'ip_address'))
+    return Counter(link_id for link_id, _ in pairs - seen)
+
+
+def add_to_sketches(daily_ips):
+    """
+    Adds the IPs of `daily_ips`, a mapping of (link_id, date) to IPs, to the
+    unique IP sketches of the (existing) `DailyClicks` and `LinkStats` rows.
+    Rows are locked in primary key order while their sketches are merged,
+    and only rows whose sketch changed, i.e. that got a new IP, are written.
+    """
+    link_ips = defaultdict(set)
+    for (link_id, _), ips in daily_ips.items():
+        link_ips[link_id].update(ips)
+    changed_days = []
+    for daily in DailyClicks.objects.select_for_update().filter(
+        link_id__in=link_ips, date__in={clicked_date for _, clicked_date in daily_ips},
+    ).order_by('pk').only('id', 'link_id', 'date', 'unique_ips_sketch'):
+        ips = daily_ips.get((daily.link_id, daily.date))
+        if ips and update_sketch(daily, ips):
+            changed_days.append(daily)
+    changed_stats = [
+        stats for stats in LinkStats.objects.select_for_update().filter(
+            link_id__in=link_ips).order_by('pk').only('link_id', 'unique_ips_sketch')
+        if update_sketch(stats, link_ips[stats.link_id])
+    ]
+    DailyClicks.objects.bulk_update(changed_days, ['unique_ips_sketch'], batch_size=500)
+    LinkStats.objects.bulk_update(changed_stats, ['unique_ips_sketch'], batch_size=500)
+
+
+def update_sketch(row, ips):
+    sketch = HyperLogLog.from_bytes(row.unique_ips_sketch)
+    if not sketch.update(ips):
+        return False
+    row.unique_ips_sketch = sketch.to_bytes()
+    return True
+
+
+def increment_or_create(model, lookup, increments, defaults):
+    """
+    Atomically applies `increments` (F() expressions) to the row of `model`
+    matching `lookup`, creating it from `defaults` if it doesn't exist yet.
+    """
+    if model.objects.filter(**lookup).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **defaults)
+    except IntegrityError:
+        # Created concurrently by another worker.
+        model.objects.filter(**lookup).update(**increments)
+
+
+def add_link_stats(link_id, clicks, unique_ips, last_clicked):
+    """
+    Atomically adds to the `LinkStats` counters of a link,
+    creating them on its first click.
+    """
+    last_clicked_value = Value(last_clicked, output_field=DateField())
+    increment_or_create(LinkStats, {'link_id': link_id}, {
+        'total_clicks': F('total_clicks') + clicks,
+        'unique_ips': F('unique_ips') + unique_ips,
+        'last_clicked': Greatest(Coalesce('last_clicked', last_clicked_value), last_clicked_value),
+    }, {
+        'total_clicks': clicks,
+        'unique_ips': unique_ips,
+        'last_clicked': last_clicked,
+    })
+
+
+class BaseClickRecorder:
+    """
+    Base class of click recorders. `blocking` tells whether `record`
+    does I/O, i.e. must not be called from an event loop.
+    """
+    blocking = True
+    pending_clicks = 0
+
+    def record(self, link_id, clicked_date, ip_address, count=1):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Writes pending clicks, if any. Returns the number of clicks written.
+        """
+        return 0
+
+    def flush_if_due(self):
+        return 0
+
+    def close(self):
+        """
+        Stops any background work of the recorder.
+        """
+
+
+class DirectClickRecorder(BaseClickRecorder):
+    """
+    Writes every click to the database as soon as it is recorded.
+    """
+
+    def record(self, link_id, clicked_date, ip_address, count=1):
+        write_clicks({(link_id, clicked_date, ip_address): count})
+
+
+# Shortest wait, in seconds, of the background flush thread. Shorter flush
+# intervals are still met by the flushes after each request.
+MIN_BACKGROUND_FLUSH_INTERVAL = 1
+
+
+class BufferedClickRecorder(BaseClickRecorder):
+    """
+    Aggregates clicks in process memory and writes them with `write_clicks`.
+
+    Pending clicks are flushed after a response has been sent, once
+    `flush_interval` seconds have passed since the last flush or
+    `max_pending` clicks are waiting, and when the process exits. A
+    background thread flushes them as well, so clicks of a worker that
+    stopped getting requests are written within about `flush_interval`
+    seconds (at least `MIN_BACKGROUND_FLUSH_INTERVAL`).
+    If a flush fails while the database is reachable, its clicks are written
+    one row at a time and the rows that fail are logged and dropped, so one
+    bad row doesn't hold back the others.
+    At most `max_pending` clicks are held in memory, which bounds how many
+    clicks a crashed worker can lose. Clicks recorded while the buffer is
+    full (i.e. the database could not keep up) are dropped and counted in
+    `dropped`.
+    """
+
+    blocking = False
+
+    def __init__(self, flush_interval=None, max_pending=None):
+        if flush_interval is None:
+            flush_interval = settings.CLICK_BUFFER_FLUSH_INTERVAL
+        if max_pending is None:
+            max_pending = settings.CLICK_BUFFER_MAX_PENDING
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = Counter()
+        self._pending_clicks = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+        self._stopped = threading.Event()
+
+    @property
+    def pending_clicks(self):
+        return self._pending_clicks
+
+    def record(self, link_id, clicked_date, ip_address, count=1):
+        with self._lock:
+            if self._pending_clicks >= self.max_pending:
+                self.dropped += count
+                CLICKS_DROPPED.inc(amount=count)
+                return
+            self._pending[(link_id, clicked_date, ip_address)] += count
+            self._pending_clicks += count
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def _start_flusher(self):
+        # Threads don't survive a fork, so every worker process starts its own.
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_in_background, name='click-flusher', daemon=True).start()
+
+    def _flush_in_background(self):
+        interval = max(self.flush_interval, MIN_BACKGROUND_FLUSH_INTERVAL)
+        while not self._stopped.wait(interval):
+            if self.is_flush_due():
+                try:
+                    self.flush()
+                finally:
+                    connections.close_all()
+
+    def close(self):
+        self._stopped.set()
+
+    def is_flush_due(self):
+        return self._pending_clicks > 0 and (
+            self._pending_clicks >= self.max_pending
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        )
+
+    def flush_if_due(self):
+        if self.is_flush_due():
+            return self.flush()
+        return 0
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._pending_clicks = 0
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        start = time.perf_counter()
+        try:
+            return write_clicks(pending)
+        except CONNECTION_ERRORS:
+            logger.exception("Could not write %d buffered clicks.", sum(pending.values()))
+            CLICK_FLUSH_ERRORS.inc()
+            self._requeue(pending)
+            return 0
+        except Exception:
+            logger.exception("Could not write %d buffered clicks, writing them one row at a time.",
+                             sum(pending.values()))
+            CLICK_FLUSH_ERRORS.inc()
+            return self._write_by_row(pending)
+        finally:
+            CLICK_FLUSH_LATENCY.observe(time.perf_counter() - start)
+            CLICK_BUFFER_DEPTH.set(self._pending_clicks)
+
+    def _write_by_row(self, pending):
+        """
+        Writes the clicks of a failed flush one row at a time, dropping the
+        rows that fail. Requeues the rest if the database becomes unavailable.
+        """
+        written = 0
+        keys = sorted(pending)
+        for i, key in enumerate(keys):
+            try:
+                row_written, error = write_click_row(key, pending[key])
+            except CONNECTION_ERRORS:
+                logger.exception("Could not write %d buffered clicks.", sum(pending[key] for key in keys[i:]))
+                self._requeue({key: pending[key] for key in keys[i:]})
+                break
+            written += row_written
+            if error is not None:
+                logger.error("Dropped %d clicks of %r: %s", pending[key], key, error)
+                self.dropped += pending[key]
+                CLICKS_DROPPED.inc(amount=pending[key])
+        return written
+
+    def _requeue(self, pending):
+        """
+        Puts clicks of a failed flush back into the buffer as far as
+        `max_pending` allows, dropping the rest.
+        """
+        with self._lock:
+            for key, count in pending.items():
+                if self._pending_clicks >= self.max_pending:
+                    self.dropped += count
+                    CLICKS_DROPPED.inc(amount=count)
+                    continue
+                self._pending[key] += count
+                self._pending_clicks += count
+
+
+class SpoolClickRecorder(BaseClickRecorder):
+    """
+    Appends clicks to the `ClickSpool` at `CLICK_SPOOL_PATH`, from where the
+    `click_worker` command writes them in batches. Redirects only do a
+    local SQLite insert, so they are not affected by a slow or unavailable
+    database. Clicks recorded while `max_pending` rows are waiting (i.e.
+    the worker is down or can't keep up) or the spool can't be written are
+    dropped and counted in `dropped`.
+    """
+
+    def __init__(self, path=None, max_pending=None):
+        if path is None:
+            path = settings.CLICK_SPOOL_PATH
+        if max_pending is None:
+            max_pending = settings.CLICK_SPOOL_MAX_PENDING
+        self.spool = ClickSpool(path)
+        self.max_pending = max_pending
+        self.dropped = 0
+
+    def record(self, link_id, clicked_date, ip_address, count=1):
+        try:
+            # The spool is shared by all workers, so its depth is not
+            # reported as this worker's `pending_clicks`.
+            if self.spool.pending() < self.max_pending:
+                self.spool.append(link_id, clicked_date, ip_address, count)
+                return
+        except sqlite3.Error:
+            logger.exception("Could not spool a click.")
+        self.dropped += count
+        CLICKS_DROPPED.inc(amount=count)
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_click_recorder():
+    """
+    Returns the process-wide click recorder configured by `CLICK_RECORDER`.
+    """
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                recorder = import_string(settings.CLICK_RECORDER)()
+                atexit.register(recorder.flush)
+                _recorder = recorder
+    return _recorder
+
+
+@receiver(request_finished)
+def flush_click_recorder(sender, **kwargs):
+    """
+    Flushes pending clicks after the response has been sent to the client,
+    so redirect latency doesn't depend on the write path.
+    """
+    if _recorder is not None:
+        _recorder.flush_if_due()
+
+
+@receiver(setting_changed)
+def reset_click_recorder(setting, **kwargs):
+    global _recorder
+    if setting.startswith('CLICK_'):
+        if _recorder is not None:
+            atexit.unregister(_recorder.flush)
+            _recorder.close()
+        _recorder = None
@@ -0,0 +1,277 @@
+"""
+Append-only binary log of raw click events.
+
+When `CLICK_EVENT_LOG_DIR` is set, every click is appended to the log as a
+fixed-width record, before sampling or aggregation, so clicks can be
+audited and `Click` rows re-aggregated from them later with the
+`replay_click_log` command.
+
+Every process writes its own segment files, named after the time they were
+started, and starts a new one once `CLICK_EVENT_LOG_SEGMENT_SIZE` bytes
+have been written. A segment is a `SEGMENT_HEADER` followed by `RECORD`s.
+"""
+import ipaddress
+import os
+import struct
+import threading
+import time
+from datetime import date
+from functools import lru_cache
+from glob import glob
+from hashlib import blake2b
+from mmap import ACCESS_READ, mmap
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+MAGIC = b'CLKLOG'
+VERSION = 1
+# Magic, format version and record size.
+SEGMENT_HEADER = struct.Struct('<6sHI')
+# Link id, time in microseconds since the epoch, number of clicks,
+# 64-bit hashes of the user agent and the referrer (0 if missing) and
+# the IP address as 16 bytes (IPv4 addresses are IPv4-mapped).
+RECORD = struct.Struct('<QqIQQ16s')
+
+# Local dates are looked up once per 15 minutes, the finest granularity
+# of UTC offsets.
+DATE_GRANULARITY_US = 15 * 60 * 1000000
+
+
+class ClickEvent:
+    __slots__ = ('link_id', 'timestamp_us', 'count', 'user_agent_hash', 'referrer_hash', 'ip_packed')
+
+    def __init__(self, link_id, timestamp_us, count, user_agent_hash, referrer_hash, ip_packed):
+        self.link_id = link_id
+        self.timestamp_us = timestamp_us
+        self.count = count
+        self.user_agent_hash = user_agent_hash
+        self.referrer_hash = referrer_hash
+        self.ip_packed = ip_packed
+
+    @property
+    def clicked_date(self):
+        return local_date(self.timestamp_us // DATE_GRANULARITY_US)
+
+    @property
+    def ip_address(self):
+        return unpack_ip(self.ip_packed)
+
+
+def hash_header(value):
+    if not value:
+        return 0
+    return int.from_bytes(blake2b(value.encode('utf-8', 'replace'), digest_size=8).digest(), 'little')
+
+
+@lru_cache(maxsize=10000)
+def pack_ip(ip_address):
+    """
+    Returns `ip_address` as 16 bytes, all zeros if it isn't a valid address.
+    """
+    try:
+        address = ipaddress.ip_address(ip_address.strip())
+    except (AttributeError, ValueError):
+        return bytes(16)
+    if address.version == 4:
+        address = ipaddress.IPv6Address(b'\0' * 10 + b'\xff\xff' + address.packed)
+    return address.packed
+
+
+@lru_cache(maxsize=100000)
+def unpack_ip(packed):
+    address = ipaddress.IPv6Address(packed)
+    return str(address.ipv4_mapped or address)
+
+
+@lru_cache(maxsize=None)
+def local_date(slot):
+    return date.fromtimestamp(slot * DATE_GRANULARITY_US / 1000000)
+
+
+class ClickEventLog:
+    """
+    Writes click events to segments in `directory`. Records are written
+    with a single unbuffered `write` each, so a crashed process loses at
+    most the record being written.
+    """
+
+    def __init__(self, directory, segment_size=None):
+        if segment_size is None:
+            segment_size = settings.CLICK_EVENT_LOG_SEGMENT_SIZE
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._written = 0
+
+    def append(self, link_id, ip_address, user_agent='', referrer='', count=1, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        record = RECORD.pack(
+            link_id, int(timestamp * 1000000), count,
+            hash_header(user_agent), hash_header(referrer), pack_ip(ip_address),
+        )
+        with self._lock:
+            if self._pid != os.getpid() or self._written + len(record) > self.segment_size:
+                self._open_segment()
+            os.write(self._fd, record)
+            self._written += len(record)
+
+    def _open_segment(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        os.makedirs(self.directory, exist_ok=True)
+        # Time first, so that segments sort in the order they were started.
+        path = os.path.join(self.directory, f'clicks-{time.time_ns() // 1000:017d}-{os.getpid()}.log')
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._pid = os.getpid()
+        os.write(self._fd, SEGMENT_HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self._written = SEGMENT_HEADER.size
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+
+
+def get_segments(directory, start=None, end=None):
+    """
+    Returns the segment paths in `directory` in the order they were started,
+    skipping those that can't contain events between the `start` and `end`
+    timestamps (in seconds).
+    """
+    segments = []
+    for path in sorted(glob(os.path.join(directory, 'clicks-*.log'))):
+        started = int(os.path.basename(path).split('-')[1]) / 1000000
+        if end is not None and started > end:
+            continue
+        # Modification times may lag behind `time.time()` on some filesystems.
+        if start is not None and os.path.getmtime(path) < start - 60:
+            continue
+        segments.append(path)
+    return segments
+
+
+def iter_records(path):
+    """
+    Yields the raw `RECORD` tuples of the segment at `path`, read through
+    `mmap`. A partly written last record is ignored.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < SEGMENT_HEADER.size:
+            return
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+            magic, version, record_size = SEGMENT_HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+                raise ValueError(f'{path} is not a click event log segment of version {VERSION}.')
+            end = SEGMENT_HEADER.size + (size - SEGMENT_HEADER.size) // RECORD.size * RECORD.size
+            view = memoryview(data)[SEGMENT_HEADER.size:end]
+            records = RECORD.iter_unpack(view)
+            try:
+                yield from records
+            finally:
+                # The mmap can only be closed once nothing points into it.
+                del records
+                view.release()
+
+
+def read_events(directory, start=None, end=None):
+    """
+    Yields the `ClickEvent`s logged in `directory` between the `start` and
+    `end` timestamps (in seconds), segment by segment.
+    """
+    start_us = None if start is None else int(start * 1000000)
+    end_us = None if end is None else int(end * 1000000)
+    for path in get_segments(directory, start, end):
+        for record in iter_records(path):
+            timestamp_us = record[1]
+            if (start_us is None or timestamp_us >= start_us) and (end_us is None or timestamp_us < end_us):
+                yield ClickEvent(*record)
+
+
+def get_log_days(directory, start=None, end=None):
+    """
+    Returns a {day: segment paths} dict, in order of days, of the days
+    (local dates) with events logged in `directory` between the `start` and
+    `end` timestamps and the segments holding their events. Only keeps the
+    days of each segment in memory, for `aggregate_clicks` to read one day
+    at a time.
+    """
+    start_us = None if start is None else int(start * 1000000)
+    end_us = None if end is None else int(end * 1000000)
+    days = {}
+    for path in get_segments(directory, start, end):
+        slots = set()
+        for _, timestamp_us, _, _, _, _ in iter_records(path):
+            if (start_us is None or timestamp_us >= start_us) and (end_us is None or timestamp_us < end_us):
+                slots.add(timestamp_us // DATE_GRANULARITY_US)
+        for day in {local_date(slot) for slot in slots}:
+            days.setdefault(day, []).append(path)
+    return dict(sorted(days.items()))
+
+
+def aggregate_clicks(directory, start=None, end=None, paths=None):
+    """
+    Returns the events logged between `start` and `end` as a
+    {(link_id, clicked_date, ip_address): clicks} dict, the shape of `Click`.
+    Only the segments in `paths` are read if it's given, e.g. those
+    `get_log_days` found for a day. Memory grows with the number of rows, so
+    long logs are aggregated one day at a time.
+    Works on raw records, which is several times faster than `read_events`.
+    """
+    start_us = None if start is None else int(start * 1000000)
+    end_us = None if end is None else int(end * 1000000)
+    if paths is None:
+        paths = get_segments(directory, start, end)
+    packed_counts = {}
+    for path in paths:
+        for link_id, timestamp_us, count, _, _, ip_packed in iter_records(path):
+            if (start_us is not None and timestamp_us < start_us) or (end_us is not None and timestamp_us >= end_us):
+                continue
+            key = (link_id, timestamp_us // DATE_GRANULARITY_US, ip_packed)
+            packed_counts[key] = packed_counts.get(key, 0) + count
+    clicks = {}
+    for (link_id, slot, ip_packed), count in packed_counts.items():
+        key = (link_id, local_date(slot), unpack_ip(ip_packed))
+        clicks[key] = clicks.get(key, 0) + count
+    return clicks
+
+
+_event_log = None
+_event_log_lock = threading.Lock()
+
+
+def get_event_log():
+    """
+    Returns the process-wide `ClickEventLog`, or None if
+    `CLICK_EVENT_LOG_DIR` isn't set.
+    """
+    global _event_log
+    if _event_log is None and settings.CLICK_EVENT_LOG_DIR:
+        with _event_log_lock:
+            if _event_log is None:
+                _event_log = ClickEventLog(settings.CLICK_EVENT_LOG_DIR)
+    return _event_log
+
+
+def log_click(request, link_id, ip_address):
+    event_log = get_event_log()
+    if event_log is not None:
+        event_log.append(
+            link_id, ip_address,
+            request.META.get('HTTP_USER_AGENT', ''), request.META.get('HTTP_REFERER', ''),
+        )
+
+
+@receiver(setting_changed)
+def reset_event_log(setting, **kwargs):
+    global _event_log
+    if setting.startswith('CLICK_EVENT_LOG_'):
+        if _event_log is not None:
+            _event_log.close()
+        _event_log = None
@@ -0,0 +1,186 @@
+"""
+Streaming export of a user's links with their click totals and daily clicks,
+served by `AnalyticsExportView`.
+
+Links are read with a server-side cursor (`QuerySet.iterator`) and written
+`chunk_size` at a time, each chunk with one `DailyClicks` range query
+pivoted into a links x days matrix, so memory doesn't grow with the number
+of links. The pivot is vectorized with NumPy and the Parquet output needs
+PyArrow; without them the pivot runs in Python and exports fall back to CSV.
+"""
+import csv
+import io
+from datetime import timedelta
+
+from .models import DailyClicks, Link
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+LINK_COLUMNS = ('alias', 'url', 'date_created', 'total_clicks', 'unique_ips')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def get_export_format(requested):
+    """
+    Returns the format to export in, given the `requested` one.
+    Parquet falls back to CSV if PyArrow isn't installed.
+    """
+    if requested == 'parquet' and pq is not None:
+        return 'parquet'
+    return 'csv'
+
+
+def iter_link_chunks(user, chunk_size):
+    """
+    Yields the links of `user`, with their stats, in lists of `chunk_size`.
+    """
+    links = Link.objects.filter(user=user).with_stats().order_by('id')
+    chunk = []
+    for link in links.iterator(chunk_size=chunk_size):
+        chunk.append(link)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def pivot_daily_clicks(link_ids, daily_clicks, start_date, days):
+    """
+    Returns a len(link_ids) x `days` matrix of clicks per link and day, given
+    `daily_clicks`, (link_id, date, clicks) tuples of days from `start_date`.
+    A NumPy array if NumPy is installed, a list of lists otherwise.
+    """
+    start = start_date.toordinal()
+    if np is None:
+        index = {link_id: i for i, link_id in enumerate(link_ids)}
+        matrix = [[0] * days for _ in link_ids]
+        for link_id, day, clicks in daily_clicks:
+            matrix[index[link_id]][day.toordinal() - start] = clicks
+        return matrix
+    matrix = np.zeros((len(link_ids), days), dtype=np.int64)
+    if daily_clicks:
+        link_column, date_column, clicks_column = zip(*daily_clicks)
+        ids = np.asarray(link_ids)
+        sorter = np.argsort(ids)
+        rows = sorter[np.searchsorted(ids, link_column, sorter=sorter)]
+        columns = np.fromiter((day.toordinal() for day in date_column), dtype=np.int64,
+                              count=len(date_column)) - start
+        matrix[rows, columns] = clicks_column
+    return matrix
+
+
+def iter_export_chunks(user, start_date, end_date, chunk_size=1000):
+    """
+    Yields (link values, daily clicks matrix) per chunk of links, where
+    link values are rows of `LINK_COLUMNS` values.
+    """
+    days = (end_date - start_date).days + 1
+    for links in iter_link_chunks(user, chunk_size):
+        link_ids = [link.id for link in links]
+        daily_clicks = list(DailyClicks.objects.filter(
+            link_id__in=link_ids, date__range=(start_date, end_date),
+        ).order_by().values_list('link_id', 'date', 'clicks'))
+        values = []
+        for link in links:
+            clicks = link.get_clicks()
+            values.append((link.alias, link.url, link.date_created.isoformat(),
+                           clicks['total_clicks'], clicks['unique_users']))
+        yield values, pivot_daily_clicks(link_ids, daily_clicks, start_date, days)
+
+
+def get_day_columns(start_date, end_date):
+    return [str(start_date + timedelta(days=i)) for i in range((end_date - start_date).days + 1)]
+
+
+class Echo:
+    """
+    File-like object handing back what is written, for `csv.writer`.
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(user, start_date, end_date, chunk_size=1000):
+    """
+    Yields the export as CSV, one chunk of links at a time.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(LINK_COLUMNS + tuple(get_day_columns(start_date, end_date)))
+    for values, matrix in iter_export_chunks(user, start_date, end_date, chunk_size):
+        rows = matrix.tolist() if np is not None else matrix
+        yield ''.join(writer.writerow(link_values + tuple(daily)) for link_values, daily in zip(values, rows))
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only stream whose written bytes are collected with `drain`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_parquet(user, start_date, end_date, chunk_size=1000):
+    """
+    Yields the export as a Parquet file with one row group per chunk of links.
+    """
+    day_columns = get_day_columns(start_date, end_date)
+    schema = pa.schema(
+        [(name, pa.string()) for name in LINK_COLUMNS[:3]]
+        + [(name, pa.int64()) for name in LINK_COLUMNS[3:]]
+        + [(name, pa.int64()) for name in day_columns]
+    )
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for values, matrix in iter_export_chunks(user, start_date, end_date, chunk_size):
+        link_columns = list(zip(*values))
+        if np is not None:
+            day_arrays = [pa.array(matrix[:, i]) for i in range(len(day_columns))]
+        else:
+            day_arrays = [pa.array(column, pa.int64()) for column in zip(*matrix)]
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(column, field.type) for column, field in zip(link_columns, schema)] + day_arrays,
+            schema=schema,
+        )
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_export(user, start_date, end_date, export_format, chunk_size=1000):
+    if export_format == 'parquet':
+        return stream_parquet(user, start_date, end_date, chunk_size)
+    return stream_csv(user, start_date, end_date, chunk_size)
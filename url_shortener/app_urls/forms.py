@@ -7,6 +7,9 @@ from .models import Link
 _alias = Link._meta.get_field('alias')
 _url = Link._meta.get_field('url')
 
+# Paths served by the project itself, which can't be used as aliases.
+RESERVED_ALIASES = ('metrics',)
+
 
 class URLShortenerForm(forms.Form):
     url = forms.URLField(
@@ -33,3 +36,9 @@ class URLShortenerForm(forms.Form):
             MaxLengthValidator(_alias.max_length),
         ]
     )
+
+    def clean_alias(self):
+        alias = self.cleaned_data['alias']
+        if alias.lower() in RESERVED_ALIASES:
+            raise forms.ValidationError(_('This alias is reserved.'), code='reserved_alias')
+        return alias
@@ -0,0 +1,105 @@
+"""
+HyperLogLog sketches for approximate distinct counts.
+
+Unique IPs are kept as a sketch per link and per link and day (see
+`LinkStats.unique_ips_sketch` and `DailyClicks.unique_ips_sketch`), so
+the unique IPs of any date range are estimated by merging one sketch per
+day, without reading `Click` rows. With the default precision a sketch
+takes at most a few kilobytes and estimates have a standard error of
+about 1.6%.
+"""
+import math
+import zlib
+from hashlib import blake2b
+
+DEFAULT_PRECISION = 12
+# 2 ** -rank for every possible register value.
+INVERSE_POWERS = [2.0 ** -rank for rank in range(65)]
+
+
+def hash_value(value):
+    return int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    """
+    Sketch of a set of strings with `2 ** precision` one-byte registers.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('Precision must be between 4 and 16.')
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size) if registers is None else bytearray(registers)
+
+    def add(self, value):
+        """
+        Adds `value` and returns whether the sketch changed.
+        """
+        hashed = hash_value(value)
+        index = hashed >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        rest = hashed & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def update(self, values):
+        changed = False
+        for value in values:
+            changed = self.add(value) or changed
+        return changed
+
+    def merge(self, other):
+        """
+        Adds the values counted by `other`, a sketch of the same precision.
+        """
+        if other.precision != self.precision:
+            raise ValueError('Only sketches of the same precision can be merged.')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """
+        Returns the estimated number of distinct values added.
+        """
+        zeros = self.registers.count(0)
+        if zeros == self.size:
+            return 0
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(map(INVERSE_POWERS.__getitem__, self.registers))
+        if estimate <= 2.5 * self.size and zeros:
+            # Linear counting is more accurate for small sets.
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        """
+        Returns the sketch as the precision followed by the compressed
+        registers. Sketches of small sets, mostly zeros, take a few bytes.
+        """
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data, precision=DEFAULT_PRECISION):
+        """
+        Returns the sketch saved by `to_bytes`, or an empty sketch of
+        `precision` if `data` is empty.
+        """
+        if not data:
+            return cls(precision)
+        data = bytes(data)
+        return cls(data[0], zlib.decompress(data[1:]))
+
+
+def merge_sketches(sketches):
+    """
+    Returns the union of the serialized `sketches`.
+    """
+    merged = HyperLogLog()
+    for data in sketches:
+        if data:
+            merged.merge(HyperLogLog.from_bytes(data))
+    return merged
@@ -0,0 +1,73 @@
+import random
+import uuid
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.core.management.base import BaseCommand
+
+from app_urls.bench import summarize, time_calls
+from app_urls.models import Click, User
+from app_urls.seeding import CLICK_FIELDS, generate_clicks, insert_rows, seed_links
+
+
+class Command(BaseCommand):
+    help = ("Seeds clicks and measures the click upsert (redirect) and date range (chart) "
+            "queries on the current schema. Run it before and after migrating to compare indexes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clicks', type=int, default=1000000, help="Number of click rows to seed.")
+        parser.add_argument('--links', type=int, default=1000, help="Number of links to spread clicks over.")
+        parser.add_argument('--days', type=int, default=30, help="Number of days to spread clicks over.")
+        parser.add_argument('--samples', type=int, default=1000, help="Number of timed queries of each kind.")
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+        parser.add_argument('--keep', action='store_true', help="Keep the seeded data instead of rolling back.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        today = date.today()
+        with transaction.atomic():
+            user = User.objects.create_user(email=f'bench-{uuid.uuid4().hex}@example.com')
+            link_ids = seed_links(user, options['links'], prefix=f'bench-{uuid.uuid4().hex[:8]}')
+            insert_rows(
+                Click, CLICK_FIELDS, generate_clicks(link_ids, options['clicks'], options['days'], rng, today),
+                batch_size=options['batch_size'],
+                callback=lambda sent: self.stdout.write(f"Seeded {sent} clicks", ending='\r'),
+            )
+            self.stdout.write('')
+
+            sampled_links = [rng.choice(link_ids) for _ in range(options['samples'])]
+            keys = list(Click.objects.filter(link_id__in=set(sampled_links)).values_list(
+                'link_id', 'clicked_date', 'ip_address')[:options['samples']])
+            upsert = time_calls(self.upsert_click, keys)
+            chart = time_calls(self.chart_range, [
+                (link_id, today - timedelta(days=7), today) for link_id in sampled_links
+            ])
+            self.report('click upsert (redirect)', upsert, self.click_queryset(*keys[0]))
+            self.report('7 day range (chart)', chart, self.range_queryset(
+                sampled_links[0], today - timedelta(days=7), today).values('clicks_count'))
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    @staticmethod
+    def click_queryset(link_id, clicked_date, ip_address):
+        return Click.objects.filter(link_id=link_id, clicked_date=clicked_date, ip_address=ip_address)
+
+    @staticmethod
+    def range_queryset(link_id, start_date, end_date):
+        return Click.objects.filter(link_id=link_id, clicked_date__range=(start_date, end_date)).order_by()
+
+    def upsert_click(self, link_id, clicked_date, ip_address):
+        self.click_queryset(link_id, clicked_date, ip_address).update(clicks_count=F('clicks_count') + 1)
+
+    def chart_range(self, link_id, start_date, end_date):
+        self.range_queryset(link_id, start_date, end_date).aggregate(clicks=Sum('clicks_count'))
+
+    def report(self, name, latencies, queryset):
+        stats = summarize(latencies)
+        self.stdout.write(
+            f"{name}: n={stats['count']} mean={stats['mean_ms']}ms p50={stats['p50_ms']}ms "
+            f"p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms")
+        self.stdout.write(f"  plan: {queryset.explain()}")
@@ -0,0 +1,159 @@
+import json
+import platform
+import random
+import threading
+import time
+import uuid
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.backends.signals import connection_created
+from django.db.utils import load_backend
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from app_urls.backends.postgresql_pool.base import get_pool
+from app_urls.bench import summarize, zipf_choices
+from app_urls.clicks import get_click_recorder
+from app_urls.models import User
+from app_urls.seeding import random_ip, seed_links
+
+MODES = {
+    'connect': 'django.db.backends.postgresql',
+    'pool': 'app_urls.backends.postgresql_pool',
+}
+
+
+class Command(BaseCommand):
+    help = ("Replays redirect traffic once connecting to PostgreSQL for every request and once with "
+            "pooled connections, and reports latency, throughput and connections opened by each. "
+            "Alias caching is disabled, so every redirect queries the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--links', type=int, default=1000, help="Number of links to seed.")
+        parser.add_argument('--requests', type=int, default=2000, help="Number of timed redirects per mode.")
+        parser.add_argument('--warmup', type=int, default=100, help="Number of untimed redirects per mode.")
+        parser.add_argument('--threads', type=int, default=1,
+                            help="Number of concurrent clients, each sending --requests / --threads redirects.")
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help="Zipf exponent of alias popularity, higher is more skewed.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+        parser.add_argument('--output', help="Write the results as JSON to this file ('-' for stdout).")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Connection pooling needs PostgreSQL, set SQL_ENGINE and the other SQL_* variables.")
+        rng = random.Random(options['seed'])
+        prefix = f'bench-{uuid.uuid4().hex[:8]}'
+        user = User.objects.create_user(email=f'{prefix}@example.com')
+        try:
+            link_ids = seed_links(user, options['links'], prefix=prefix)
+            paths = [reverse('app_urls:alias', args=(f'{prefix}-{i}',)) for i in range(len(link_ids))]
+            results = {
+                'config': {key: options[key] for key in ('links', 'requests', 'warmup', 'threads', 'zipf', 'seed')},
+                'environment': {
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'click_recorder': settings.CLICK_RECORDER,
+                    'pool': connection.settings_dict.get('POOL', {}),
+                },
+            }
+            with override_settings(LINK_CACHE_TIMEOUT=0, LINK_CACHE_NEGATIVE_TIMEOUT=0, LINK_CACHE_LOCAL_TIMEOUT=0):
+                for mode in MODES:
+                    results[mode] = self.replay(mode, zipf_choices(
+                        paths, options['warmup'] + options['requests'], options['zipf'], rng), options)
+        finally:
+            get_click_recorder().flush()
+            user.delete()
+
+        self.report(results)
+        if options['output']:
+            output = json.dumps(results, indent=2)
+            if options['output'] == '-':
+                self.stdout.write(output)
+            else:
+                with open(options['output'], 'w') as f:
+                    f.write(output + '\n')
+
+    def replay(self, mode, paths, options):
+        """
+        Sends `paths` from `--threads` threads with connections of `mode`,
+        closing the connection after every request like Django does at the
+        end of a request, and returns the results of the timed requests.
+        """
+        settings_dict = dict(connection.settings_dict, ENGINE=MODES[mode], CONN_MAX_AGE=0)
+        backend = load_backend(MODES[mode])
+        warmup, timed = paths[:options['warmup']], paths[options['warmup']:]
+        threads = max(1, options['threads'])
+        latencies = []
+        statuses = {}
+        lock = threading.Lock()
+        connects = []
+        errors = []
+
+        def count_connect(sender, **kwargs):
+            connects.append(sender)
+
+        def send(paths, timed):
+            client = Client()
+            connections[DEFAULT_DB_ALIAS] = backend.DatabaseWrapper(settings_dict, DEFAULT_DB_ALIAS)
+            rng = random.Random()
+            try:
+                for path in paths:
+                    request_start = time.perf_counter()
+                    status = client.get(path, REMOTE_ADDR=random_ip(rng)).status_code
+                    connections[DEFAULT_DB_ALIAS].close()
+                    if timed:
+                        latency = time.perf_counter() - request_start
+                        with lock:
+                            latencies.append(latency)
+                            statuses[status] = statuses.get(status, 0) + 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections[DEFAULT_DB_ALIAS].close()
+
+        def run(paths, timed):
+            workers = [threading.Thread(target=send, args=(paths[i::threads], timed)) for i in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if errors:
+                raise errors[0]
+
+        run(warmup, False)
+        pool = get_pool(DEFAULT_DB_ALIAS, settings_dict) if mode == 'pool' else None
+        created = pool.connections_created if pool else 0
+        connection_created.connect(count_connect)
+        try:
+            start = time.perf_counter()
+            run(timed, True)
+            elapsed = time.perf_counter() - start
+        finally:
+            connection_created.disconnect(count_connect)
+        if pool:
+            pool_stats = pool.stats()
+            pool.close_idle()
+        return {
+            'latency': summarize(latencies),
+            'throughput_rps': round(len(timed) / elapsed, 2) if elapsed else 0.0,
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'connections_opened': pool_stats['connections_created'] - created if pool else len(connects),
+            'pool': pool_stats if pool else None,
+        }
+
+    def report(self, results):
+        for mode in MODES:
+            latency = results[mode]['latency']
+            self.stdout.write(
+                f"{mode}: n={latency['count']} mean={latency['mean_ms']}ms p50={latency['p50_ms']}ms "
+                f"p95={latency['p95_ms']}ms p99={latency['p99_ms']}ms")
+            self.stdout.write(
+                f"  throughput={results[mode]['throughput_rps']} req/s "
+                f"connections opened={results[mode]['connections_opened']} statuses={results[mode]['statuses']}")
+        if results['connect']['throughput_rps']:
+            self.stdout.write(
+                f"pool/connect throughput: {results['pool']['throughput_rps'] / results['connect']['throughput_rps']:.2f}x")
@@ -0,0 +1,181 @@
+import json
+import platform
+import random
+import time
+import uuid
+from datetime import date
+
+import django
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+from django.http import Http404
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+
+from app_urls.bench import summarize, zipf_choices
+from app_urls import cache as link_cache
+from app_urls.bloom import get_alias_filter
+from app_urls.clicks import get_click_recorder
+from app_urls.models import Click, User
+from app_urls.seeding import CLICK_FIELDS, generate_clicks, insert_rows, random_ip, seed_links
+
+
+class Command(BaseCommand):
+    help = ("Seeds links and clicks, replays Zipf-distributed redirect traffic and reports latency, "
+            "queries per request and throughput. Use --output to save the results as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--links', type=int, default=10000, help="Number of links to seed.")
+        parser.add_argument('--clicks', type=int, default=100000, help="Number of click rows to seed.")
+        parser.add_argument('--days', type=int, default=30, help="Number of days to spread seeded clicks over.")
+        parser.add_argument('--requests', type=int, default=10000, help="Number of timed redirects.")
+        parser.add_argument('--warmup', type=int, default=1000, help="Number of untimed redirects sent first.")
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help="Zipf exponent of alias popularity, higher is more skewed.")
+        parser.add_argument('--miss-ratio', type=float, default=0.01,
+                            help="Fraction of requests for aliases that don't exist.")
+        parser.add_argument('--mode', choices=('client', 'factory'), default='client',
+                            help="Send requests through the test client (full middleware stack) "
+                                 "or call the redirect view with RequestFactory requests.")
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+        parser.add_argument('--output', help="Write the results as JSON to this file ('-' for stdout).")
+        parser.add_argument('--keep', action='store_true', help="Keep the seeded data instead of rolling back.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            prefix = f'bench-{uuid.uuid4().hex[:8]}'
+            user = User.objects.create_user(email=f'{prefix}@example.com')
+            link_ids = seed_links(user, options['links'], prefix=prefix, batch_size=options['batch_size'])
+            insert_rows(
+                Click, CLICK_FIELDS, generate_clicks(link_ids, options['clicks'], options['days'], rng, date.today()),
+                batch_size=options['batch_size'],
+            )
+            self.stdout.write(f"Seeded {len(link_ids)} links and {options['clicks']} clicks.")
+
+            aliases = [f'{prefix}-{i}' for i in range(len(link_ids))]
+            rng.shuffle(aliases)
+            results = self.replay(aliases, rng, options)
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+        if not options['keep']:
+            link_cache.invalidate_aliases(aliases)
+
+        self.report(results)
+        if options['output']:
+            output = json.dumps(results, indent=2)
+            if options['output'] == '-':
+                self.stdout.write(output)
+            else:
+                with open(options['output'], 'w') as f:
+                    f.write(output + '\n')
+
+    def replay(self, aliases, rng, options):
+        """
+        Sends the warm-up and timed redirects and returns the results.
+        Clicks still buffered at the end are flushed, and counted, as part
+        of the timed run.
+        """
+        send = self.client_sender() if options['mode'] == 'client' else self.factory_sender()
+        paths = self.traffic(aliases, options['warmup'] + options['requests'], rng, options)
+        warmup, timed = paths[:options['warmup']], paths[options['warmup']:]
+
+        recorder = get_click_recorder()
+        link_cache.alias_cache.clear()
+        alias_filter = get_alias_filter()
+        if alias_filter is not None:
+            alias_filter.rebuild(force=True)
+        for path in warmup:
+            send(path, random_ip(rng))
+        recorder.flush()
+
+        link_cache.alias_cache.reset_stats()
+        latencies = []
+        statuses = {}
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for path in timed:
+                ip = random_ip(rng)
+                request_start = time.perf_counter()
+                status = send(path, ip)
+                latencies.append(time.perf_counter() - request_start)
+                statuses[status] = statuses.get(status, 0) + 1
+            recorder.flush()
+            elapsed = time.perf_counter() - start
+
+        return {
+            'config': {
+                key: options[key]
+                for key in ('links', 'clicks', 'days', 'requests', 'warmup', 'zipf', 'miss_ratio', 'mode', 'seed')
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'click_recorder': settings.CLICK_RECORDER,
+                'async_redirects': settings.ASYNC_REDIRECTS,
+            },
+            'latency': summarize(latencies),
+            'queries_per_request': round(len(queries) / len(timed), 4) if timed else 0.0,
+            'throughput_rps': round(len(timed) / elapsed, 2) if elapsed else 0.0,
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'alias_cache': link_cache.alias_cache.stats(),
+        }
+
+    @staticmethod
+    def traffic(aliases, count, rng, options):
+        """
+        Returns `count` request paths, Zipf-distributed over `aliases`
+        with `--miss-ratio` of them for unknown aliases.
+        """
+        paths = [reverse('app_urls:alias', args=(alias,)) for alias in aliases]
+        paths = zipf_choices(paths, count, options['zipf'], rng)
+        for i in range(count):
+            if rng.random() < options['miss_ratio']:
+                paths[i] = reverse('app_urls:alias', args=(f'missing-{rng.randrange(1 << 32):x}',))
+        return paths
+
+    @staticmethod
+    def client_sender():
+        client = Client()
+
+        def send(path, ip):
+            return client.get(path, REMOTE_ADDR=ip).status_code
+        return send
+
+    @staticmethod
+    def factory_sender():
+        factory = RequestFactory()
+
+        def send(path, ip):
+            match = resolve(path)
+            view = match.func
+            if not hasattr(view, 'view_class'):
+                view = async_to_sync(view)
+            try:
+                return view(factory.get(path, REMOTE_ADDR=ip), *match.args, **match.kwargs).status_code
+            except Http404:
+                return 404
+        return send
+
+    def report(self, results):
+        latency = results['latency']
+        self.stdout.write(
+            f"redirects: n={latency['count']} mean={latency['mean_ms']}ms p50={latency['p50_ms']}ms "
+            f"p95={latency['p95_ms']}ms p99={latency['p99_ms']}ms")
+        self.stdout.write(
+            f"  throughput={results['throughput_rps']} req/s "
+            f"queries/request={results['queries_per_request']} statuses={results['statuses']}")
+        self.stdout.write(
+            f"  alias cache: hit ratio={results['alias_cache']['hit_ratio']:.4f} "
+            f"filtered={results['alias_cache']['filtered']}")
+        alias_filter = results['alias_cache']['alias_filter']
+        if alias_filter and alias_filter['ready']:
+            self.stdout.write(
+                f"  alias filter: {alias_filter['aliases']} aliases in {alias_filter['bytes']} bytes, "
+                f"{alias_filter['num_hashes']} hashes")
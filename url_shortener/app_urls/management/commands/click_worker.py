@@ -0,0 +1,124 @@
+import logging
+import signal
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from app_urls.clicks import CONNECTION_ERRORS, write_click_row, write_clicks
+from app_urls.metrics import CLICK_FLUSH_ERRORS, CLICK_FLUSH_LATENCY
+from app_urls.spool import ClickSpool, SpoolLocked
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Drains the click spool written by `SpoolClickRecorder` into the database in batches. "
+            "Clicks are removed from the spool only once they are written, so they are retried "
+            "while the database is unavailable. Rows the database rejects are quarantined in the spool.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Number of spooled clicks written at once.")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait for more clicks when the spool holds less than a batch.")
+        parser.add_argument('--max-backoff', type=float, default=60.0,
+                            help="Longest wait, in seconds, between retries of a failed batch.")
+        parser.add_argument('--once', action='store_true', help="Drain the spool and exit.")
+        parser.add_argument('--path', help="Spool file, defaults to CLICK_SPOOL_PATH.")
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.stopping = False
+        spool = ClickSpool(options['path'] or settings.CLICK_SPOOL_PATH)
+        try:
+            with spool.drain_lock():
+                if not options['once']:
+                    signal.signal(signal.SIGTERM, self.stop)
+                    signal.signal(signal.SIGINT, self.stop)
+                written = self.drain(spool, options)
+        except SpoolLocked as e:
+            raise CommandError(f"{e} Only one click_worker may run per spool.")
+        finally:
+            spool.close()
+        self.stdout.write(f"Wrote {written} clicks.")
+
+    def stop(self, signum, frame):
+        # Finish the current batch, then exit.
+        self.stopping = True
+
+    def drain(self, spool, options):
+        written = 0
+        backoff = 0
+        while not self.stopping:
+            rows = spool.read_batch(options['batch_size'])
+            if not rows:
+                if options['once']:
+                    break
+                self.sleep(options['interval'])
+                continue
+            try:
+                written += self.write(spool, rows)
+            except CONNECTION_ERRORS:
+                if options['once']:
+                    raise
+                backoff = min(max(2 * backoff, 0.5), options['max_backoff'])
+                logger.exception("Could not write %d spooled clicks, retrying in %.1fs.", len(rows), backoff)
+                # Reconnect on the next attempt.
+                connection.close()
+                self.sleep(backoff)
+                continue
+            backoff = 0
+            spool.delete_through(rows[-1][0])
+            if self.verbosity >= 2:
+                self.stdout.write(f"Wrote {len(rows)} spooled rows, {spool.pending()} waiting.")
+            if len(rows) < options['batch_size'] and not options['once']:
+                # Let the next batch fill up rather than writing a few clicks at a time.
+                self.sleep(options['interval'])
+        return written
+
+    def write(self, spool, rows):
+        increments = Counter()
+        for _, link_id, clicked_date, ip_address, count in rows:
+            increments[(link_id, clicked_date, ip_address)] += count
+        start = time.perf_counter()
+        try:
+            return write_clicks(increments)
+        except CONNECTION_ERRORS:
+            CLICK_FLUSH_ERRORS.inc()
+            raise
+        except Exception:
+            CLICK_FLUSH_ERRORS.inc()
+            logger.exception("Could not write %d spooled clicks, writing them one row at a time.", len(rows))
+            return self.write_by_row(spool, rows)
+        finally:
+            CLICK_FLUSH_LATENCY.observe(time.perf_counter() - start)
+
+    @staticmethod
+    def write_by_row(spool, rows):
+        """
+        Writes spooled `rows` one at a time and quarantines those that fail,
+        so they aren't retried forever. If the database becomes unavailable,
+        the rows written so far are removed from the spool before the error
+        is raised.
+        """
+        written = 0
+        for i, row in enumerate(rows):
+            row_id, link_id, clicked_date, ip_address, count = row
+            try:
+                row_written, error = write_click_row((link_id, clicked_date, ip_address), count)
+            except CONNECTION_ERRORS:
+                if i:
+                    spool.delete_through(rows[i - 1][0])
+                raise
+            written += row_written
+            if error is not None:
+                logger.error("Quarantined spooled click %d: %s", row_id, error)
+                spool.quarantine(row, error)
+        return written
+
+    def sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(max(0, min(0.1, deadline - time.monotonic())))
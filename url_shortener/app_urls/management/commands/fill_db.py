@@ -1,34 +1,103 @@
 import random
-from django.utils.timezone import datetime, timedelta
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
 
+from app_urls.bloom import get_alias_filter
+from app_urls.misc import AliasAllocator, hash_encode
 from app_urls.models import Click, Link, User
+from app_urls.seeding import CLICK_FIELDS, generate_clicks, insert_rows
+
+LINK_FIELDS = ('user', 'url', 'alias', 'date_created', 'redirect_type', 'cache_max_age', 'click_sampling')
+ADMIN_EMAIL = "admin@admin.com"
+ADMIN_PASSWORD = "admin"
 
 
 class Command(BaseCommand):
-    help = "Fills database with fake data."
+    help = ("Fills database with fake data. Links, users and clicks are streamed "
+            "in batches, so it can load production-sized data for load testing.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1,
+                            help="Number of users owning the links, including the admin.")
+        parser.add_argument('--links', type=int, default=10, help="Number of links to create.")
+        parser.add_argument('--clicks', type=int, default=500, help="Number of click rows to create.")
+        parser.add_argument('--days', type=int, default=30, help="Number of days to spread clicks over.")
+        parser.add_argument('--seed', type=int, help="Random seed, for reproducible data.")
+        parser.add_argument('--batch-size', type=int, default=10000, help="Number of rows per insert.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        start = time.perf_counter()
+
+        users = self.create_users(options['users'], batch_size)
+        self.stdout.write(f"Users: {len(users)}")
 
-    def handle(self, *args, **kwargs):
-        user = User.objects.create_superuser(
-            email="admin@admin.com",
-            password="admin"
+        first_link_id = (Link.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+        insert_rows(Link, LINK_FIELDS, self.generate_links(users, options['links'], rng, batch_size),
+                    batch_size=batch_size, callback=self.progress("links"))
+        self.stdout.write('')
+        link_ids = list(Link.objects.filter(id__gte=first_link_id).order_by('id')
+                       .values_list('id', flat=True))
+
+        if link_ids:
+            insert_rows(Click, CLICK_FIELDS, generate_clicks(link_ids, options['clicks'], options['days'], rng),
+                        batch_size=batch_size, callback=self.progress("clicks"))
+            self.stdout.write('')
+        call_command('rebuild_click_stats', sketches=True, verbosity=0, stdout=self.stdout)
+        # Links are inserted without signals, so the alias filter is rebuilt.
+        alias_filter = get_alias_filter()
+        if alias_filter is not None:
+            alias_filter.rebuild(force=True)
+        self.stdout.write(f"Done in {time.perf_counter() - start:.1f}s.")
+        self.stdout.write(f"Admin Email: {ADMIN_EMAIL}, Password: {ADMIN_PASSWORD}")
+
+    def create_users(self, count, batch_size):
+        """
+        Returns the admin and `count - 1` other users, creating
+        the ones that don't exist yet.
+        """
+        admin = User.objects.filter(email=ADMIN_EMAIL).first()
+        if admin is None:
+            admin = User.objects.create_superuser(email=ADMIN_EMAIL, password=ADMIN_PASSWORD)
+        emails = [f"user{i}@example.com" for i in range(1, count)]
+        # Hashing is slow, so all fake users share the same password.
+        password = make_password("password")
+        User.objects.bulk_create(
+            (User(email=email, password=password) for email in emails),
+            batch_size=batch_size, ignore_conflicts=True,
         )
-        today = datetime.today()
-        for i in range(10):
-            link, _ = Link.objects.get_or_create(
-                user=user,
-                url="https://github.com/seyyedaliayati",
-                alias=f"link{i}"
+        users = [admin]
+        for start in range(0, len(emails), 500):
+            users.extend(User.objects.filter(email__in=emails[start:start + 500]).order_by('id'))
+        return users
+
+    @staticmethod
+    def generate_links(users, count, rng, batch_size):
+        """
+        Yields `count` links of random `users` with generated aliases as
+        tuples of `LINK_FIELDS` values, reserving alias numbers a batch at a time.
+        """
+        allocator = AliasAllocator(block_size=batch_size)
+        user_ids = [user.id for user in users]
+        now = timezone.now()
+        for _ in range(count):
+            yield (
+                rng.choice(user_ids),
+                f"https://github.com/seyyedaliayati?tab=repositories&page={rng.randint(1, 100)}",
+                hash_encode(allocator.allocate()),
+                now,
+                Link.TEMPORARY_REDIRECT,
+                0,
+                1,
             )
-            self.stdout.write(str(link))
-            for j in range(random.randint(0, 100)):
-                click, _ = Click.objects.get_or_create(
-                    link=link,
-                    ip_address=f"{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(0, 255)}"
-                )
-                click.clicked_date = today - \
-                    timedelta(days=random.randint(0, 30))
-                click.clicks_count += random.randint(1, 10)
-                click.save()
-                self.stdout.write("----  " + str(click))
-        self.stdout.write("Admin Email: admin@admin.com, Password: admin")
+
+    def progress(self, name):
+        def callback(sent):
+            self.stdout.write(f"Created {sent} {name}", ending='\r')
+        return callback
@@ -0,0 +1,39 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app_urls.bulk import import_links, read_csv_rows
+from app_urls.models import User
+
+
+class Command(BaseCommand):
+    help = "Creates links from a CSV file with `url` and optional `alias` columns."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file to import, or - to read from stdin.")
+        parser.add_argument('--user', required=True, help="Email of the user owning the links.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of rows validated and inserted at once.")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(email=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['user']} does not exist.")
+        if options['path'] == '-':
+            self.run(user, sys.stdin, options['batch_size'])
+        else:
+            with open(options['path'], newline='', encoding='utf-8-sig') as f:
+                self.run(user, f, options['batch_size'])
+
+    def run(self, user, lines, batch_size):
+        processed = created = failed = 0
+        for result in import_links(user, read_csv_rows(lines), batch_size):
+            for row_number, alias, message in result.problems:
+                self.stderr.write(f"Row {row_number} ({alias or 'no alias'}): {message}")
+            processed += result.processed
+            created += len(result.created)
+            failed += len(result.problems)
+            self.stdout.write(f"Processed {processed} rows, created {created} links.")
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {processed} rows, {created} links created, {failed} rows skipped."))
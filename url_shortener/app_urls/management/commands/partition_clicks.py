@@ -0,0 +1,65 @@
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app_urls import partitions
+from app_urls.models import Click
+
+
+class Command(BaseCommand):
+    help = ("Partitions clicks by month on PostgreSQL, creates the partitions of the coming months and "
+            "drops those older than the retention window. Run it daily. Other databases keep a plain "
+            "table whose old clicks are deleted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help="Number of months after the current one to create partitions for.")
+        parser.add_argument('--retention-months', type=int,
+                            help="Number of full months of clicks kept before the current month, "
+                                 "defaults to CLICK_RETENTION_MONTHS. 0 keeps all clicks.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would change.")
+
+    def handle(self, *args, **options):
+        retention_months = options['retention_months']
+        if retention_months is None:
+            retention_months = settings.CLICK_RETENTION_MONTHS
+        if retention_months < 0 or options['months_ahead'] < 0:
+            raise CommandError("--months-ahead and --retention-months can't be negative.")
+        dry_run = options['dry_run']
+        this_month = partitions.month_start(date.today())
+        cutoff = partitions.get_retention_cutoff(retention_months)
+        connection = partitions.get_connection()
+
+        if not partitions.supports_partitions(connection):
+            self.stdout.write(f"Clicks are kept in a plain table on {connection.vendor}.")
+            if cutoff:
+                if dry_run:
+                    count = Click.objects.filter(clicked_date__lt=cutoff).count()
+                    self.stdout.write(f"Would delete {count} click rows before {cutoff}.")
+                else:
+                    self.stdout.write(f"Deleted {partitions.delete_clicks(cutoff)} click rows before {cutoff}.")
+            return
+
+        last_month = partitions.add_months(this_month, options['months_ahead'])
+        if not partitions.is_partitioned(connection):
+            if dry_run:
+                self.stdout.write("Would partition the click table by month.")
+                return
+            partitions.convert_to_partitioned(connection, options['months_ahead'])
+            self.stdout.write("Partitioned the click table by month.")
+
+        if dry_run:
+            existing = partitions.get_partitions(connection)
+            missing = [partitions.get_partition_name(month)
+                       for month in partitions.get_months(this_month, last_month) if month not in existing]
+            expired = partitions.get_expired_partitions(connection, cutoff) if cutoff else []
+            self.stdout.write(f"Would create {len(missing)} partitions: {', '.join(missing) or '-'}")
+            self.stdout.write(f"Would drop {len(expired)} partitions: {', '.join(expired) or '-'}")
+            return
+
+        created = partitions.create_partitions(connection, this_month, last_month)
+        self.stdout.write(f"Created {len(created)} partitions: {', '.join(created) or '-'}")
+        if cutoff:
+            dropped = partitions.drop_partitions(connection, cutoff)
+            self.stdout.write(f"Dropped {len(dropped)} partitions before {cutoff}: {', '.join(dropped) or '-'}")
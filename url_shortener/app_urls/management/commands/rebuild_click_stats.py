@@ -0,0 +1,224 @@
+from collections import defaultdict
+
+from django.db import models, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from app_urls.hll import HyperLogLog
+from app_urls.partitions import get_retention_cutoff
+from app_urls.models import Click, DailyClicks, Link, LinkStats
+
+STATS_FIELDS = ('total_clicks', 'unique_ips', 'last_clicked')
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds link click counters and daily clicks from clicks and reports any drift. Days "
+            "before the retention window, whose clicks `partition_clicks` dropped, are left as they are.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report drift, don't fix it.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of links checked per query.")
+        parser.add_argument('--since',
+                            help="First day (YYYY-MM-DD) whose clicks are stored, defaults to the start of "
+                                 "the CLICK_RETENTION_MONTHS window. Older days are kept as they are.")
+        parser.add_argument('--sketches', action='store_true',
+                            help="Also rebuild the unique IP sketches of the days since --since, and the "
+                                 "all-time sketches of links without older days.")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        self.verbosity = options['verbosity']
+        self.sketches = options['sketches']
+        self.since = get_retention_cutoff()
+        if options['since']:
+            try:
+                self.since = parse_date(options['since'])
+            except ValueError:
+                self.since = None
+            if self.since is None:
+                raise CommandError(f"Invalid date {options['since']!r}, use YYYY-MM-DD.")
+        checked = drifted = 0
+        batch = []
+        link_ids = Link.objects.order_by('id').values_list('id', flat=True)
+        for link_id in link_ids.iterator(chunk_size=options['batch_size']):
+            batch.append(link_id)
+            if len(batch) >= options['batch_size']:
+                drifted += self.rebuild(batch, dry_run)
+                checked += len(batch)
+                batch = []
+        if batch:
+            drifted += self.rebuild(batch, dry_run)
+            checked += len(batch)
+        action = "found" if dry_run else "fixed"
+        self.stdout.write(f"Checked {checked} links, {action} drift in {drifted}.")
+
+    def rebuild(self, link_ids, dry_run):
+        """
+        Compares the stats of `link_ids` with their clicks, writes the
+        differences unless `dry_run` and returns the number of drifted links.
+        """
+        expected = {
+            row.pop('link_id'): row
+            for row in self.get_clicks(link_ids).values('link_id').annotate(
+                total_clicks=models.Sum('clicks_count'),
+                unique_ips=models.Count('ip_address', distinct=True),
+                last_clicked=models.Max('clicked_date'),
+            )
+        }
+        history = self.get_history(link_ids)
+        current = LinkStats.objects.in_bulk(link_ids)
+        to_create, to_update = [], []
+        for link_id in link_ids:
+            values = expected.get(link_id, {'total_clicks': 0, 'unique_ips': 0, 'last_clicked': None})
+            stats = current.get(link_id)
+            if link_id in history:
+                values = self.add_history(values, history[link_id], stats)
+            if stats is None:
+                if not values['total_clicks']:
+                    continue
+                stats = LinkStats(link_id=link_id)
+                to_create.append(stats)
+            elif all(getattr(stats, field) == values[field] for field in STATS_FIELDS):
+                continue
+            else:
+                to_update.append(stats)
+            self.log("Link {}: {}".format(link_id, ", ".join(
+                f"{field} {getattr(stats, field)} -> {values[field]}"
+                for field in STATS_FIELDS if getattr(stats, field) != values[field]
+            )))
+            for field in STATS_FIELDS:
+                setattr(stats, field, values[field])
+        drifted_links = {stats.link_id for stats in to_create + to_update}
+        daily_drift = self.get_daily_drift(link_ids)
+        drifted_links.update(link_id for link_id, _ in daily_drift)
+        if not dry_run:
+            with transaction.atomic():
+                LinkStats.objects.bulk_create(to_create)
+                LinkStats.objects.bulk_update(to_update, STATS_FIELDS)
+                self.fix_daily_drift(daily_drift)
+        if self.sketches:
+            changed_days, changed_stats = self.get_sketch_drift(link_ids)
+            drifted_links.update(row.link_id for row in changed_days + changed_stats)
+            if not dry_run:
+                with transaction.atomic():
+                    DailyClicks.objects.bulk_update(changed_days, ['unique_ips_sketch'], batch_size=1000)
+                    LinkStats.objects.bulk_update(changed_stats, ['unique_ips_sketch'], batch_size=1000)
+        return len(drifted_links)
+
+    def get_clicks(self, link_ids):
+        clicks = Click.objects.filter(link_id__in=link_ids).order_by()
+        if self.since:
+            clicks = clicks.filter(clicked_date__gte=self.since)
+        return clicks
+
+    def get_daily_clicks(self, link_ids):
+        daily_clicks = DailyClicks.objects.filter(link_id__in=link_ids)
+        if self.since:
+            daily_clicks = daily_clicks.filter(date__gte=self.since)
+        return daily_clicks
+
+    def get_history(self, link_ids):
+        """
+        Returns a mapping of link_id -> clicks and last day of the daily
+        clicks before `--since`, which are all that's left of their clicks.
+        """
+        if not self.since:
+            return {}
+        return {
+            row.pop('link_id'): row
+            for row in DailyClicks.objects.filter(link_id__in=link_ids, date__lt=self.since).order_by().values(
+                'link_id').annotate(clicks=models.Sum('clicks'), last_clicked=models.Max('date'))
+        }
+
+    @staticmethod
+    def add_history(values, history, stats):
+        """
+        Returns the expected stats of a link given `values` from its stored
+        clicks and the `history` of its days before `--since`. Unique IPs
+        can't be counted without the older clicks, so they are kept unless
+        the stored clicks have more.
+        """
+        last_clicked = values['last_clicked'] or history['last_clicked']
+        return {
+            'total_clicks': values['total_clicks'] + history['clicks'],
+            'unique_ips': max(values['unique_ips'], stats.unique_ips if stats else 0),
+            'last_clicked': max(last_clicked, history['last_clicked']),
+        }
+
+    def log(self, message):
+        if self.verbosity >= 1:
+            self.stdout.write(message)
+
+    def get_daily_drift(self, link_ids):
+        """
+        Returns a mapping of (link_id, date) -> (row id, current, expected
+        clicks) for every day whose `DailyClicks` row doesn't match the clicks.
+        """
+        expected = {
+            (link_id, clicked_date): clicks
+            for link_id, clicked_date, clicks in self.get_clicks(link_ids).values('link_id', 'clicked_date').annotate(
+                clicks=models.Sum('clicks_count')).values_list('link_id', 'clicked_date', 'clicks')
+        }
+        current = {
+            (link_id, date): (row_id, clicks)
+            for row_id, link_id, date, clicks in self.get_daily_clicks(link_ids).values_list(
+                'id', 'link_id', 'date', 'clicks')
+        }
+        drift = {}
+        for key in sorted(expected.keys() | current.keys()):
+            row_id, clicks = current.get(key, (None, 0))
+            if clicks != expected.get(key, 0):
+                drift[key] = (row_id, clicks, expected.get(key, 0))
+                self.log(f"Link {key[0]} on {key[1]}: clicks {clicks} -> {expected.get(key, 0)}")
+        return drift
+
+    def fix_daily_drift(self, drift):
+        to_create, to_update, to_delete = [], [], []
+        for (link_id, date), (row_id, _, clicks) in drift.items():
+            if not clicks:
+                to_delete.append(row_id)
+            elif row_id is None:
+                to_create.append(DailyClicks(link_id=link_id, date=date, clicks=clicks))
+            else:
+                to_update.append(DailyClicks(id=row_id, link_id=link_id, date=date, clicks=clicks))
+        DailyClicks.objects.bulk_create(to_create, batch_size=1000)
+        DailyClicks.objects.bulk_update(to_update, ['clicks'], batch_size=1000)
+        DailyClicks.objects.filter(id__in=to_delete).delete()
+
+    def get_sketch_drift(self, link_ids):
+        """
+        Returns the `DailyClicks` and `LinkStats` rows of `link_ids` whose
+        unique IP sketch doesn't match their clicks, with the sketch built
+        from the clicks set on them. The all-time sketches of links with
+        days before `--since` are left as they are.
+        """
+        daily_sketches = defaultdict(HyperLogLog)
+        link_sketches = defaultdict(HyperLogLog)
+        clicks = self.get_clicks(link_ids).values_list('link_id', 'clicked_date', 'ip_address')
+        for link_id, clicked_date, ip_address in clicks.iterator(chunk_size=10000):
+            daily_sketches[(link_id, clicked_date)].add(ip_address)
+            link_sketches[link_id].add(ip_address)
+        changed_days = []
+        for daily in self.get_daily_clicks(link_ids).only('id', 'link_id', 'date', 'unique_ips_sketch'):
+            sketch = daily_sketches.get((daily.link_id, daily.date))
+            if self.set_sketch(daily, sketch):
+                self.log(f"Link {daily.link_id} on {daily.date}: unique IP sketch rebuilt")
+                changed_days.append(daily)
+        changed_stats = []
+        history = self.get_history(link_ids)
+        for stats in LinkStats.objects.filter(link_id__in=link_ids).exclude(
+                link_id__in=history).only('link_id', 'unique_ips_sketch'):
+            if self.set_sketch(stats, link_sketches.get(stats.link_id)):
+                self.log(f"Link {stats.link_id}: unique IP sketch rebuilt")
+                changed_stats.append(stats)
+        return changed_days, changed_stats
+
+    @staticmethod
+    def set_sketch(row, sketch):
+        expected = sketch.to_bytes() if sketch is not None else b''
+        if bytes(row.unique_ips_sketch) == expected:
+            return False
+        row.unique_ips_sketch = expected
+        return True
@@ -0,0 +1,120 @@
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from app_urls.eventlog import aggregate_clicks, get_log_days
+from app_urls.models import Click, Link
+from app_urls.seeding import CLICK_FIELDS, insert_rows
+
+
+class Command(BaseCommand):
+    help = ("Re-aggregates the click event log into clicks. The clicks of every link and day found in the "
+            "log are replaced with the logged ones, then the click counters are rebuilt. A log only holds the "
+            "clicks of its host since logging was enabled, so other links and days are left alone.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help="Event log directory, defaults to CLICK_EVENT_LOG_DIR.")
+        parser.add_argument('--start', help="First day to replay (YYYY-MM-DD), defaults to the oldest event.")
+        parser.add_argument('--end', help="Last day to replay (YYYY-MM-DD), defaults to the newest event.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what the log contains.")
+        parser.add_argument('--batch-size', type=int, default=10000, help="Number of rows per insert.")
+        parser.add_argument('--replace-days', action='store_true',
+                            help="Replace all clicks of the days found in the log, also of links it has no "
+                                 "clicks of. Only use it with a log of every host that covers those days.")
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or settings.CLICK_EVENT_LOG_DIR
+        if not directory:
+            raise CommandError("Set CLICK_EVENT_LOG_DIR or pass --dir.")
+        start = self.get_timestamp(options['start'])
+        end = self.get_timestamp(options['end'], next_day=True)
+
+        started = time.perf_counter()
+        days = get_log_days(directory, start, end)
+        read = rows = deleted = inserted = 0
+        # One day at a time, so memory doesn't grow with the length of the log.
+        for day, paths in days.items():
+            clicks = aggregate_clicks(
+                directory, self.get_day_start(day), self.get_day_start(day + timedelta(days=1)), paths)
+            read += sum(clicks.values())
+            rows += len(clicks)
+            if not options['dry_run'] and clicks:
+                day_deleted, day_inserted = self.replace_clicks(day, clicks, options)
+                deleted += day_deleted
+                inserted += day_inserted
+        self.stdout.write(
+            f"Read {read} clicks in {rows} rows over {len(days)} days "
+            f"in {time.perf_counter() - started:.1f}s.")
+        if options['dry_run'] or not rows:
+            return
+        self.stdout.write(f"Replaced {deleted} click rows with {inserted} rows from the log.")
+        call_command('rebuild_click_stats', sketches=True, verbosity=0, stdout=self.stdout)
+
+    def replace_clicks(self, day, clicks, options):
+        """
+        Replaces the clicks of `day` with `clicks`, the logged ones.
+        Returns the number of deleted and inserted rows.
+        """
+        link_ids = sorted({link_id for link_id, _, _ in clicks})
+        existing_link_ids = set()
+        for i in range(0, len(link_ids), 500):
+            existing_link_ids.update(Link.objects.filter(
+                id__in=link_ids[i:i + 500]).order_by().values_list('id', flat=True))
+        with transaction.atomic():
+            if options['replace_days']:
+                deleted, _ = Click.objects.filter(clicked_date=day).delete()
+            else:
+                deleted = self.delete_logged_clicks(clicks)
+            inserted = insert_rows(
+                Click, CLICK_FIELDS,
+                ((link_id, clicked_date, ip_address, count)
+                 for (link_id, clicked_date, ip_address), count in clicks.items()
+                 if link_id in existing_link_ids),
+                batch_size=options['batch_size'],
+            )
+        return deleted, inserted
+
+    @staticmethod
+    def delete_logged_clicks(clicks, batch_size=500):
+        """
+        Deletes the clicks of the (link, day) pairs of `clicks`.
+        Returns the number of deleted rows.
+        """
+        link_ids_by_day = {}
+        for link_id, clicked_date, _ in clicks:
+            link_ids_by_day.setdefault(clicked_date, set()).add(link_id)
+        deleted = 0
+        for clicked_date, link_ids in sorted(link_ids_by_day.items()):
+            link_ids = sorted(link_ids)
+            for i in range(0, len(link_ids), batch_size):
+                count, _ = Click.objects.filter(
+                    clicked_date=clicked_date, link_id__in=link_ids[i:i + batch_size]).delete()
+                deleted += count
+        return deleted
+
+    @staticmethod
+    def get_timestamp(day, next_day=False):
+        """
+        Returns the timestamp of the start of `day` (or of the day after),
+        in local time like `Click.clicked_date`.
+        """
+        if day is None:
+            return None
+        try:
+            parsed = parse_date(day)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise CommandError(f"Invalid date {day!r}, use YYYY-MM-DD.")
+        if next_day:
+            parsed += timedelta(days=1)
+        return Command.get_day_start(parsed)
+
+    @staticmethod
+    def get_day_start(day):
+        return datetime.combine(day, datetime.min.time()).timestamp()
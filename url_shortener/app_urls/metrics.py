@@ -0,0 +1,355 @@
+"""
+Request and redirect metrics.
+
+`view_timings` holds per-view request timings of this worker process,
+collected by `app_urls.middleware.RequestTimingMiddleware` when
+`REQUEST_TIMING` is set.
+
+The redirect and click counters below are exported at `/metrics` in the
+Prometheus text format. Every worker process keeps its values in its own
+file under `METRICS_DIR`, updated through `mmap` without any system call,
+and the endpoint sums the files of all workers. Without `METRICS_DIR` the
+values stay in process memory and only cover the worker that serves
+`/metrics`.
+
+Files are named by host name and pid, so containers can share the
+directory (e.g. the web workers and the click worker). Whether a process
+still runs can only be told on its own host, so gauges only cover the
+processes of the host serving `/metrics`.
+"""
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from glob import glob
+from hashlib import md5
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.http import Http404
+from django.test.signals import setting_changed
+
+# Upper bounds, in milliseconds, of the request wall time histogram buckets.
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class ViewTimings:
+    """
+    Thread-safe aggregate of wall time, query count and DB time per view name,
+    with a histogram of wall times.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def record(self, view_name, wall_time, queries, db_time):
+        """
+        Adds one request to `view_name`. Times are in seconds.
+        """
+        bucket = bisect_left(self.buckets, wall_time * 1000)
+        with self._lock:
+            view = self._views.get(view_name)
+            if view is None:
+                view = self._views[view_name] = {
+                    'count': 0, 'wall_time': 0.0, 'max_wall_time': 0.0, 'queries': 0, 'db_time': 0.0,
+                    'histogram': [0] * (len(self.buckets) + 1),
+                }
+            view['count'] += 1
+            view['wall_time'] += wall_time
+            view['max_wall_time'] = max(view['max_wall_time'], wall_time)
+            view['queries'] += queries
+            view['db_time'] += db_time
+            view['histogram'][bucket] += 1
+
+    def snapshot(self):
+        """
+        Returns the aggregated numbers of every view, in milliseconds.
+        Percentiles are the upper bound of the bucket they fall in.
+        """
+        with self._lock:
+            views = {name: dict(view, histogram=list(view['histogram'])) for name, view in self._views.items()}
+        return {name: self.summarize(view) for name, view in sorted(views.items())}
+
+    def summarize(self, view):
+        count = view['count']
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {
+            'count': count,
+            'mean_ms': round(view['wall_time'] / count * 1000, 3),
+            'max_ms': round(view['max_wall_time'] * 1000, 3),
+            'p50_ms': self.percentile(view['histogram'], count, 0.50),
+            'p95_ms': self.percentile(view['histogram'], count, 0.95),
+            'p99_ms': self.percentile(view['histogram'], count, 0.99),
+            'queries_per_request': round(view['queries'] / count, 3),
+            'db_mean_ms': round(view['db_time'] / count * 1000, 3),
+            'histogram': dict(zip(bounds, view['histogram'])),
+        }
+
+    def percentile(self, histogram, count, fraction):
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, histogram):
+            seen += bucket_count
+            if seen >= fraction * count:
+                return bound
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+
+view_timings = ViewTimings()
+
+
+class MetricsStore:
+    """
+    Fixed-size array of float64 values, one per metric series, kept in
+    memory or in a file of this process that is mapped into memory.
+    """
+
+    def __init__(self, size, directory=None, layout=''):
+        self.size = size
+        self.directory = directory
+        self.layout = layout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._values = None
+        self.host = socket.gethostname().replace('-', '_')
+
+    def _get_values(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # First use, or a forked worker that must not share its parent's file.
+            self._pid = pid
+            self._values = self._open(pid) if self.directory else bytearray(8 * self.size)
+        return self._values
+
+    def _open(self, pid):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.get_path(pid), 'a+b') as f:
+            f.truncate(8 * self.size)
+            return mmap.mmap(f.fileno(), 8 * self.size)
+
+    def get_path(self, pid, host=None):
+        return os.path.join(self.directory, f'metrics-{self.layout}-{host or self.host}-{pid}.db')
+
+    def add(self, index, amount):
+        with self._lock:
+            values = self._get_values()
+            struct.pack_into('d', values, 8 * index, struct.unpack_from('d', values, 8 * index)[0] + amount)
+
+    def set(self, index, value):
+        with self._lock:
+            struct.pack_into('d', self._get_values(), 8 * index, value)
+
+    def read_all(self):
+        """
+        Returns a {(host, pid): values} mapping of every process that wrote
+        metrics.
+        """
+        with self._lock:
+            values = self._get_values()
+            result = {(self.host, self._pid): struct.unpack_from(f'{self.size}d', values)}
+        if self.directory:
+            for path in glob(self.get_path('*', '*')):
+                host, pid = os.path.basename(path)[:-len('.db')].rsplit('-', 2)[1:]
+                key = (host, int(pid))
+                if key in result:
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read(8 * self.size)
+                if len(data) == 8 * self.size:
+                    result[key] = struct.unpack(f'{self.size}d', data)
+        return result
+
+    def clear(self):
+        with self._lock:
+            values = self._get_values()
+            values[:] = bytes(8 * self.size)
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metric:
+    type = None
+    # Whether only the values of running processes are summed.
+    live_only = False
+
+    def __init__(self, registry, name, documentation, labels=None, suffixes=('',)):
+        self.name = 'url_shortener_' + name
+        self.documentation = documentation
+        self.label_name, self.label_values = labels or (None, (None,))
+        self.series = [
+            (self.name + suffix, label) for label in self.label_values for suffix in suffixes
+        ]
+        self.offset = registry.register(self)
+
+    def get_index(self, label=None):
+        return self.offset + self.label_values.index(label)
+
+    def format_labels(self, label):
+        return f'{{{self.label_name}="{label}"}}' if label is not None else ''
+
+    def expose(self, values):
+        """
+        Returns the exposition lines of this metric given its `values`,
+        summed over the processes that count.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for label, value in zip(self.label_values, values):
+            lines.append(f'{self.name}{self.format_labels(label)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, label=None, amount=1):
+        self.registry.store.add(self.get_index(label), amount)
+
+
+class Gauge(Metric):
+    """
+    Per-process value, summed over the running processes of this host.
+    """
+    type = 'gauge'
+    live_only = True
+
+    def set(self, value, label=None):
+        self.registry.store.set(self.get_index(label), value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, buckets):
+        self.buckets = tuple(buckets)
+        self.bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        super().__init__(registry, name, documentation, suffixes=[
+            f'_bucket:{bound}' for bound in self.bounds
+        ] + ['_sum'])
+
+    def observe(self, value):
+        store = self.registry.store
+        store.add(self.offset + bisect_left(self.buckets, value), 1)
+        store.add(self.offset + len(self.bounds), value)
+
+    def expose(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        count = 0
+        for bound, value in zip(self.bounds, values):
+            count += value
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {format_value(count)}')
+        lines.append(f'{self.name}_sum {format_value(values[-1])}')
+        lines.append(f'{self.name}_count {format_value(count)}')
+        return lines
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Registry:
+    """
+    Fixed set of metrics sharing one `MetricsStore`.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.series = []
+        self._store = None
+
+    def register(self, metric):
+        metric.registry = self
+        offset = len(self.series)
+        self.metrics.append(metric)
+        self.series.extend(metric.series)
+        return offset
+
+    @property
+    def store(self):
+        if self._store is None:
+            # Files of another metric layout (e.g. an older release) are ignored.
+            layout = md5('\n'.join(f'{name}:{label}' for name, label in self.series).encode()).hexdigest()[:8]
+            self._store = MetricsStore(len(self.series), settings.METRICS_DIR, layout)
+        return self._store
+
+    def reset(self):
+        self._store = None
+
+    def expose(self):
+        """
+        Returns all metrics in the Prometheus text exposition format,
+        summed over worker processes.
+        """
+        store = self.store
+        processes = store.read_all()
+        live = [
+            values for (host, pid), values in processes.items() if host == store.host and is_process_alive(pid)
+        ]
+        lines = []
+        for metric in self.metrics:
+            sources = live if metric.live_only else processes.values()
+            lines.extend(metric.expose([
+                sum(values[i] for values in sources)
+                for i in range(metric.offset, metric.offset + len(metric.series))
+            ]))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REDIRECT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+FLUSH_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REDIRECTS = Counter(registry, 'redirects_total', 'Redirects served.')
+REDIRECT_NOT_FOUND = Counter(registry, 'redirect_not_found_total', 'Redirect requests for unknown aliases.')
+REDIRECT_LATENCY = Histogram(
+    registry, 'redirect_duration_seconds', 'Time spent in the redirect view.', REDIRECT_LATENCY_BUCKETS)
+ALIAS_CACHE_LOOKUPS = Counter(
+    registry, 'alias_cache_lookups_total', 'Alias lookups by the cache tier that answered them.',
+    labels=('result', ('local_hit', 'shared_hit', 'filtered', 'miss')))
+CLICKS_RECORDED = Counter(registry, 'clicks_recorded_total', 'Clicks handed to the click recorder.')
+CLICKS_DROPPED = Counter(registry, 'clicks_dropped_total', 'Clicks dropped because the click buffer was full.')
+CLICK_BUFFER_DEPTH = Gauge(registry, 'click_buffer_depth', 'Clicks waiting in click buffers.')
+CLICK_FLUSH_LATENCY = Histogram(
+    registry, 'click_flush_duration_seconds', 'Time spent writing buffered clicks.', FLUSH_LATENCY_BUCKETS)
+CLICK_FLUSH_ERRORS = Counter(registry, 'click_flush_errors_total', 'Click buffer flushes that failed.')
+
+
+@contextmanager
+def observe_redirect():
+    """
+    Counts and times a redirect. Redirects raising `Http404` are counted
+    as unknown aliases.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Http404:
+        REDIRECT_NOT_FOUND.inc()
+        raise
+    else:
+        REDIRECTS.inc()
+    finally:
+        REDIRECT_LATENCY.observe(time.perf_counter() - start)
+
+
+@receiver(setting_changed)
+def reset_metrics_store(setting, **kwargs):
+    if setting == 'METRICS_DIR':
+        registry.reset()
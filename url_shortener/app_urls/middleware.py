@@ -0,0 +1,200 @@
+"""
+Optional per-view instrumentation, enabled with the `REQUEST_TIMING` setting,
+and the redirect fast path, enabled with `REDIRECT_FAST_PATH`. When they're
+off the middlewares remove themselves from the stack at startup.
+"""
+import asyncio
+import re
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.urls import ResolverMatch, get_resolver
+
+from .forms import RESERVED_ALIASES
+from .metrics import view_timings
+
+# `QueryStats` of the request being handled. A context variable rather than
+# a thread local, so queries run through `sync_to_async` by async views are
+# counted too.
+current_query_stats = ContextVar('current_query_stats', default=None)
+
+
+class QueryStats:
+    __slots__ = ('queries', 'db_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    `execute_wrapper` hook adding each query to the current request's stats.
+    """
+    stats = current_query_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - start
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def install_query_recorders(**kwargs):
+    """
+    Installs the recorder on this thread's connections. Connected to
+    `request_started`, which the ASGI handler sends from the thread that
+    later runs the request's sync code.
+    """
+    for connection in connections.all():
+        install_query_recorder(connection)
+
+
+class RequestTimingMiddleware:
+    """
+    Records wall time, query count and DB time of every request, keyed by
+    the resolved URL name (e.g. `app_urls:alias`), into `view_timings` and
+    a `Server-Timing` response header.
+
+    Queries are counted with an execute wrapper that is installed on the
+    connections of every thread that handles requests or opens a connection,
+    so queries of async views run through `sync_to_async` are covered too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_TIMING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        connection_created.connect(install_query_recorder)
+        request_started.connect(install_query_recorders)
+        install_query_recorders()
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        stats = QueryStats()
+        token = current_query_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_query_stats.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, stats)
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        token = current_query_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_query_stats.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, stats)
+
+    @staticmethod
+    def finish(request, response, wall_time, stats):
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else '<unresolved>'
+        view_timings.record(view_name, wall_time, stats.queries, stats.db_time)
+        response['Server-Timing'] = 'app;dur={:.3f}, db;dur={:.3f};desc="{} queries"'.format(
+            wall_time * 1000, stats.db_time * 1000, stats.queries)
+        return response
+
+
+class RedirectFastPathMiddleware:
+    """
+    Serves `/<alias>` and `/<alias>/<extra>` GET and HEAD requests with the
+    redirect view before the rest of the middleware stack (sessions, CSRF,
+    auth, messages, ...) and URL resolution run. Paths claimed by other URL
+    patterns, e.g. `/admin/...` or `/metrics`, go through the full stack.
+
+    Place it after `SecurityMiddleware`, so redirects still get its headers
+    and HTTPS redirect.
+    """
+    sync_capable = True
+    async_capable = True
+    alias_path = re.compile(r'^/(?P<alias>[a-zA-Z0-9-_]+)(?P<extra>/.*)?$', re.DOTALL)
+
+    def __init__(self, get_response):
+        if not settings.REDIRECT_FAST_PATH:
+            raise MiddlewareNotUsed
+        # Imported here, views import the URL configuration's dependencies.
+        from .views import LinkRedirectView, link_redirect_async
+
+        self.get_response = get_response
+        self.reserved_aliases = set(RESERVED_ALIASES)
+        self.reserved_prefixes = self.get_reserved_prefixes()
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            if settings.ASYNC_REDIRECTS:
+                self.redirect_view = link_redirect_async
+            else:
+                self.redirect_view = sync_to_async(LinkRedirectView.as_view())
+        else:
+            self.redirect_view = LinkRedirectView.as_view()
+
+    @staticmethod
+    def get_reserved_prefixes():
+        """
+        Returns the first path segments that project URL patterns other than
+        the alias patterns start with, such as `admin` or `accounts`.
+        """
+        prefixes = set()
+        for pattern in get_resolver().url_patterns:
+            match = re.match(r'^\^?([a-zA-Z0-9-_]+)/', str(pattern.pattern))
+            if match:
+                prefixes.add(match.group(1))
+        return prefixes
+
+    def match(self, request):
+        """
+        Returns the (alias, extra) of a redirect request, or None.
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        match = self.alias_path.match(request.path_info)
+        if match is None:
+            return None
+        alias, extra = match.group('alias', 'extra')
+        if extra is None:
+            if alias in self.reserved_aliases:
+                return None
+            extra = ''
+        elif alias in self.reserved_prefixes:
+            return None
+        request.resolver_match = ResolverMatch(
+            self.redirect_view, (), {'alias': alias, 'extra': extra},
+            url_name='alias', app_names=['app_urls'], namespaces=['app_urls'],
+        )
+        return alias, extra
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        match = self.match(request)
+        if match is None:
+            return self.get_response(request)
+        return self.redirect_view(request, *match)
+
+    async def __acall__(self, request):
+        match = self.match(request)
+        if match is None:
+            return await self.get_response(request)
+        return await self.redirect_view(request, *match)
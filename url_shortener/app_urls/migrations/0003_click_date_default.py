@@ -0,0 +1,19 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:17
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0002_alter_link_options'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='click',
+            name='clicked_date',
+            field=models.DateField(default=datetime.date.today),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:18
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+def lowercase_aliases(apps, schema_editor):
+    """
+    Stores every alias lowercase, so lookups can use an exact match on the
+    unique index instead of `alias__iexact`. An alias that only differs in
+    case from another one gets its link id appended.
+    """
+    Link = apps.get_model('app_urls', 'Link')
+    db_alias = schema_editor.connection.alias
+    links = Link.objects.using(db_alias).exclude(
+        alias=django.db.models.functions.text.Lower('alias'))
+    for link in links.only('id', 'alias').iterator():
+        alias = link.alias.lower()
+        if Link.objects.using(db_alias).filter(alias=alias).exists():
+            alias = f'{alias}-{link.id}'
+        Link.objects.using(db_alias).filter(id=link.id).update(alias=alias)
+
+    remaining = Link.objects.using(db_alias).exclude(
+        alias=django.db.models.functions.text.Lower('alias')).count()
+    if remaining:
+        raise RuntimeError(f'{remaining} aliases could not be lowercased.')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0003_click_date_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(lowercase_aliases, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='link',
+            constraint=models.CheckConstraint(check=models.Q(('alias', django.db.models.functions.text.Lower('alias'))), name='link_alias_lowercase'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_link_stats(apps, schema_editor):
+    Click = apps.get_model('app_urls', 'Click')
+    LinkStats = apps.get_model('app_urls', 'LinkStats')
+    db_alias = schema_editor.connection.alias
+    rows = Click.objects.using(db_alias).order_by().values('link_id').annotate(
+        total_clicks=models.Sum('clicks_count'),
+        unique_ips=models.Count('ip_address', distinct=True),
+        last_clicked=models.Max('clicked_date'),
+    )
+    batch = []
+    for row in rows.iterator():
+        batch.append(LinkStats(**row))
+        if len(batch) >= 1000:
+            LinkStats.objects.using(db_alias).bulk_create(batch)
+            batch = []
+    LinkStats.objects.using(db_alias).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0004_link_alias_lowercase'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkStats',
+            fields=[
+                ('link', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='app_urls.link')),
+                ('total_clicks', models.PositiveBigIntegerField(default=0)),
+                ('unique_ips', models.PositiveBigIntegerField(default=0)),
+                ('last_clicked', models.DateField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'link stats',
+            },
+        ),
+        migrations.RunPython(backfill_link_stats, migrations.RunPython.noop),
+    ]
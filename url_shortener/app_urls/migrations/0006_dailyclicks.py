@@ -0,0 +1,46 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_daily_clicks(apps, schema_editor):
+    Click = apps.get_model('app_urls', 'Click')
+    DailyClicks = apps.get_model('app_urls', 'DailyClicks')
+    db_alias = schema_editor.connection.alias
+    rows = Click.objects.using(db_alias).order_by().values('link_id', 'clicked_date').annotate(
+        clicks=models.Sum('clicks_count'))
+    batch = []
+    for row in rows.iterator():
+        batch.append(DailyClicks(link_id=row['link_id'], date=row['clicked_date'], clicks=row['clicks']))
+        if len(batch) >= 1000:
+            DailyClicks.objects.using(db_alias).bulk_create(batch)
+            batch = []
+    DailyClicks.objects.using(db_alias).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0005_linkstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyClicks',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('clicks', models.PositiveBigIntegerField(default=0)),
+                ('link', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_clicks', to='app_urls.link')),
+            ],
+            options={
+                'verbose_name_plural': 'daily clicks',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailyclicks',
+            constraint=models.UniqueConstraint(fields=('link', 'date'), name='unique_daily_clicks'),
+        ),
+        migrations.RunPython(backfill_daily_clicks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:22
+
+from django.db import migrations, models
+
+
+def merge_duplicate_clicks(apps, schema_editor):
+    """
+    Merges clicks of the same link, day and IP into one row, so the
+    `unique_click` constraint can be added.
+    """
+    Click = apps.get_model('app_urls', 'Click')
+    db_alias = schema_editor.connection.alias
+    duplicates = Click.objects.using(db_alias).order_by().values(
+        'link_id', 'clicked_date', 'ip_address',
+    ).annotate(
+        rows=models.Count('id'), total=models.Sum('clicks_count'), keep=models.Min('id'),
+    ).filter(rows__gt=1)
+    for duplicate in duplicates.iterator():
+        Click.objects.using(db_alias).filter(id=duplicate['keep']).update(clicks_count=duplicate['total'])
+        Click.objects.using(db_alias).filter(
+            link_id=duplicate['link_id'],
+            clicked_date=duplicate['clicked_date'],
+            ip_address=duplicate['ip_address'],
+        ).exclude(id=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0006_dailyclicks'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_clicks, migrations.RunPython.noop),
+    ]
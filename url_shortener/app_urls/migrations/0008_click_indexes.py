@@ -0,0 +1,31 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0007_merge_duplicate_clicks'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='click',
+            constraint=models.UniqueConstraint(fields=('link', 'clicked_date', 'ip_address'), name='unique_click'),
+        ),
+        migrations.AddIndex(
+            model_name='click',
+            index=models.Index(fields=['link', 'clicked_date', 'clicks_count'], name='click_link_date_count_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='click',
+            index=models.Index(fields=['link', 'ip_address'], name='click_link_ip_idx'),
+        ),
+        migrations.AlterField(
+            model_name='click',
+            name='link',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app_urls.link'),
+        ),
+    ]
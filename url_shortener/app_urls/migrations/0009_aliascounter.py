@@ -0,0 +1,34 @@
+# Generated by Django 3.2.11 on 2026-10-18 17:44
+
+from django.db import migrations, models
+
+
+def seed_alias_counter(apps, schema_editor):
+    """
+    Starts generated aliases after the highest link id, which the
+    previous `hash_encode(latest id + 1)` scheme may have used.
+    """
+    AliasCounter = apps.get_model('app_urls', 'AliasCounter')
+    Link = apps.get_model('app_urls', 'Link')
+    db_alias = schema_editor.connection.alias
+    latest_id = Link.objects.using(db_alias).aggregate(models.Max('id'))['id__max'] or 0
+    AliasCounter.objects.using(db_alias).create(name='link', value=latest_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0008_click_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AliasCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_alias_counter, migrations.RunPython.noop),
+    ]
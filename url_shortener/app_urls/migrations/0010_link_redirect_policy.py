@@ -0,0 +1,29 @@
+# Generated by Django 3.2.11 on 2026-10-18 18:23
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0009_aliascounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='link',
+            name='cache_max_age',
+            field=models.PositiveIntegerField(default=0, help_text="Seconds browsers and proxies may cache the redirect. Cached hits aren't counted. 0 disables caching."),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='click_sampling',
+            field=models.PositiveIntegerField(default=1, help_text='Record about one in this many clicks, each counted this many times. Click totals become estimates. 1 records every click.', validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='redirect_type',
+            field=models.PositiveSmallIntegerField(choices=[(302, 'Temporary (302)'), (301, 'Permanent (301)'), (308, 'Permanent, keeping the request method (308)')], default=302, help_text="Browsers remember permanent redirects, so only use them for links whose URL won't change."),
+        ),
+    ]
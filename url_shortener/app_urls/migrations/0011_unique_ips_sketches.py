@@ -0,0 +1,23 @@
+# Generated by Django 3.2.11 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_urls', '0010_link_redirect_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailyclicks',
+            name='unique_ips_sketch',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='linkstats',
+            name='unique_ips_sketch',
+            field=models.BinaryField(default=b''),
+        ),
+    ]
@@ -1,10 +1,31 @@
+import ipaddress
+import random
 import string
+import tempfile
+import threading
+from hashlib import md5
 
+from asgiref.sync import sync_to_async
 from hashids import Hashids
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max
+from django.core.handlers.asgi import ASGIRequest
+from django.dispatch import receiver
+from django.http import HttpResponseNotModified, HttpResponsePermanentRedirect, HttpResponseRedirect
+from django.http.response import HttpResponseRedirectBase
+from django.test.signals import setting_changed
 from django.urls import reverse
-from django.utils.timezone import datetime
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_date
+from django.utils.http import parse_etags, quote_etag
+from django.utils.timezone import datetime, timedelta
 
-from .models import Click
+from .clicks import get_click_recorder
+from .eventlog import log_click
+from .hll import HyperLogLog
+from .metrics import CLICK_BUFFER_DEPTH, CLICKS_RECORDED
+from .models import AliasCounter, Link
 
 HASH_SALT = 'VyIZlWoq7VQCvJmq54gVHz5mb7GbaXdcT3Qz8dRssMyaYpTZl2ONBBnDA788Ef'
 ALPHABET = string.ascii_lowercase
@@ -19,6 +40,97 @@ def hash_encode(num):
     return hashids.encode(num)
 
 
+class AliasAllocator:
+    """
+    Hands out numbers for generated aliases without reading the links table.
+    Each process reserves blocks of `block_size` numbers with one atomic
+    update of its `AliasCounter` row and serves numbers from memory until
+    the block runs out, so concurrent workers and threads never get the
+    same number. Numbers left in a block when a process exits are skipped.
+    """
+
+    def __init__(self, name='link', block_size=None):
+        self.name = name
+        self.block_size = block_size or settings.ALIAS_BLOCK_SIZE
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the current block, e.g. after the counter has been rolled back.
+        """
+        self._next = self._end = 0
+
+    def allocate(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve_block()
+            num = self._next
+            self._next += 1
+        return num
+
+    def _reserve_block(self):
+        """
+        Reserves the next block and returns its [start, end) range.
+        The counter row stays locked by the update until the read.
+        """
+        counter = AliasCounter.objects.filter(name=self.name)
+        with transaction.atomic():
+            if not counter.update(value=F('value') + self.block_size):
+                self._create_counter()
+            end = counter.values_list('value', flat=True).get()
+        return end - self.block_size + 1, end + 1
+
+    def _create_counter(self):
+        start = Link.objects.aggregate(Max('id'))['id__max'] or 0
+        try:
+            with transaction.atomic():
+                AliasCounter.objects.create(name=self.name, value=start + self.block_size)
+        except IntegrityError:
+            # Created concurrently by another worker.
+            AliasCounter.objects.filter(name=self.name).update(value=F('value') + self.block_size)
+
+
+alias_allocator = AliasAllocator()
+
+
+@receiver(setting_changed)
+def reset_alias_allocator(setting, **kwargs):
+    if setting == 'ALIAS_BLOCK_SIZE':
+        alias_allocator.block_size = settings.ALIAS_BLOCK_SIZE
+        alias_allocator.reset()
+
+
+def generate_alias():
+    """
+    Returns a new alias for a link that wasn't given one.
+    """
+    return hash_encode(alias_allocator.allocate())
+
+
+def save_with_alias(link, alias):
+    """
+    Saves the new `link` with `alias`.
+    Returns False, leaving `link` unsaved, if the alias is already taken.
+    """
+    link.alias = alias
+    try:
+        with transaction.atomic():
+            link.save()
+    except IntegrityError:
+        link.pk = None
+        return False
+    return True
+
+
+def normalize_alias(alias):
+    """
+    Returns the form `alias` is stored in. Aliases are case insensitive
+    and stored lowercase, so lookups can match them exactly.
+    """
+    return alias.lower()
+
+
 def get_absolute_short_url(request, alias, remove_schema=True):
     """
     Returns absolute redirect URL, given the `request` object
@@ -38,26 +150,170 @@ def get_absolute_short_url(request, alias, remove_schema=True):
 
 def get_client_ip(request):
     """
-    Returns request's ip address.
+    Returns request's ip address: the first address of `X-Forwarded-For`,
+    or `REMOTE_ADDR` if there is none. Clients can send any
+    `X-Forwarded-For`, so an entry that isn't an IP address is ignored.
     """
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
+        try:
+            return str(ipaddress.ip_address(x_forwarded_for.split(',')[0].strip()))
+        except ValueError:
+            pass
+    return request.META.get('REMOTE_ADDR')
 
 
 def process_new_click(request, link):
     """
-    Gets or creates a click object and increases its `clicks_count`.
-    """
-    today = datetime.today()
-    click, _ = Click.objects.get_or_create(
-        link=link,
-        clicked_date=today,
-        ip_address=get_client_ip(request)
-    )
-    click.clicks_count += 1
-    click.save()
-    return click
+    Hands a click on `link` (a `ResolvedLink`) to the configured click
+    recorder, or a sample of clicks if the link uses click sampling.
+    The click may be written later, see `app_urls.clicks`. Every click is
+    also appended to the click event log if it's enabled.
+    """
+    ip_address = get_client_ip(request)
+    log_click(request, link.id, ip_address)
+    record_click(link, ip_address)
+
+
+def record_click(link, ip_address):
+    """
+    Hands a click on `link` to the click recorder, without logging it.
+    """
+    count = 1
+    if link.click_sampling > 1:
+        # Sampled links record one in `click_sampling` clicks on average,
+        # scaled up so that totals stay unbiased.
+        if random.random() * link.click_sampling >= 1:
+            return
+        count = link.click_sampling
+    today = datetime.today().date()
+    recorder = get_click_recorder()
+    recorder.record(link.id, today, ip_address, count)
+    CLICKS_RECORDED.inc(amount=count)
+    CLICK_BUFFER_DEPTH.set(recorder.pending_clicks)
+
+
+class HttpResponsePermanentRedirectKeepMethod(HttpResponseRedirectBase):
+    status_code = 308
+
+
+REDIRECT_RESPONSE_CLASSES = {
+    Link.TEMPORARY_REDIRECT: HttpResponseRedirect,
+    Link.PERMANENT_REDIRECT: HttpResponsePermanentRedirect,
+    Link.PERMANENT_REDIRECT_KEEP_METHOD: HttpResponsePermanentRedirectKeepMethod,
+}
+
+
+def get_redirect_response(request, link, extra=''):
+    """
+    Returns the redirect to `link` (a `ResolvedLink`) following its redirect
+    policy. Cacheable redirects get `Cache-Control` and an ETag, and are
+    answered with a 304 if the request's `If-None-Match` matches, e.g. when
+    nginx revalidates its cached copy. `X-Accel-Expires` caps how long nginx keeps it.
+    """
+    location = link.url + extra
+    response = REDIRECT_RESPONSE_CLASSES[link.redirect_type](location)
+    if link.cache_max_age:
+        patch_cache_control(response, public=True, max_age=link.cache_max_age)
+        response['X-Accel-Expires'] = min(link.cache_max_age, settings.REDIRECT_PROXY_CACHE_MAX_AGE)
+        etag = quote_etag(md5(f'{link.redirect_type} {location}'.encode()).hexdigest())
+        response['ETag'] = etag
+        # `get_conditional_response` only handles 2xx responses.
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            not_modified = HttpResponseNotModified()
+            for header in ('Cache-Control', 'ETag', 'X-Accel-Expires'):
+                not_modified[header] = response[header]
+            return not_modified
+    return response
+
+
+async def process_new_click_async(request, link):
+    """
+    Async variant of `process_new_click`. Non-blocking recorders are
+    called in the event loop, blocking ones in a worker thread. Clicks are
+    appended to the event log in a worker thread too, as that's a blocking
+    write.
+    """
+    if get_click_recorder().blocking:
+        await sync_to_async(process_new_click)(request, link)
+        return
+    ip_address = get_client_ip(request)
+    if settings.CLICK_EVENT_LOG_DIR:
+        await sync_to_async(log_click)(request, link.id, ip_address)
+    record_click(link, ip_address)
+
+
+def get_chart_date_range(start, end):
+    """
+    Parses the `start` and `end` dates (YYYY-MM-DD) of a chart request.
+    Defaults to the last 7 days. Raises ValueError if a date is invalid,
+    `start` is after `end` or the range exceeds `CHART_MAX_DAYS`.
+    """
+    today = datetime.today().date()
+    end_date = parse_date(end) if end else today
+    start_date = parse_date(start) if start else end_date - timedelta(days=7)
+    if start_date is None or end_date is None:
+        raise ValueError('Dates must be in YYYY-MM-DD format.')
+    if start_date > end_date:
+        raise ValueError('Start date must not be after end date.')
+    if (end_date - start_date).days >= settings.CHART_MAX_DAYS:
+        raise ValueError(f'Date range can be at most {settings.CHART_MAX_DAYS} days.')
+    return start_date, end_date
+
+
+def get_daily_series(start_date, end_date, counts):
+    """
+    Returns chart labels and data for every day from `start_date` to
+    `end_date`, given `counts`, a mapping of date to clicks.
+    Missing days are filled with zero.
+    """
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    return [str(day) for day in days], [counts.get(day, 0) for day in days]
+
+
+def count_unique_ips(sketches):
+    """
+    Returns a {key: estimated unique IPs} dict given `sketches`, an iterable
+    of (key, serialized sketch) pairs. Sketches of the same key are merged,
+    e.g. to count the unique IPs of a link over a range of days.
+    """
+    merged = {}
+    for key, data in sketches:
+        if not data:
+            continue
+        sketch = HyperLogLog.from_bytes(data)
+        if key in merged:
+            merged[key].merge(sketch)
+        else:
+            merged[key] = sketch
+    return {key: sketch.count() for key, sketch in merged.items()}
+
+
+STREAM_SPOOL_MAX_SIZE = 1024 * 1024
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+def get_streaming_content(request, parts):
+    """
+    Returns `parts`, an iterator of response parts that reads the database,
+    as the content of a `StreamingHttpResponse`. Django 3.2's ASGI handler
+    iterates streaming responses in the event loop, where the ORM can't be
+    used, so under ASGI the parts are written to a temporary file in the
+    view's thread first and the file is streamed instead.
+    """
+    if not isinstance(request, ASGIRequest):
+        return parts
+    spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_MAX_SIZE)
+    try:
+        for part in parts:
+            spool.write(part.encode() if isinstance(part, str) else part)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return read_spool(spool)
+
+
+def read_spool(spool):
+    with spool:
+        yield from iter(lambda: spool.read(STREAM_BLOCK_SIZE), b'')
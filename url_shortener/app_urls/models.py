@@ -1,8 +1,10 @@
+from datetime import date
 from urllib.parse import urlparse
 
 from django.db import models
+from django.db.models.functions import Lower
 from django.urls import reverse
-from django.core.validators import RegexValidator
+from django.core.validators import MinValueValidator, RegexValidator
 from django.contrib.auth import get_user_model
 
 from django.utils.translation import gettext_lazy as _
@@ -11,7 +13,25 @@ from django.utils.translation import gettext_lazy as _
 User = get_user_model()
 
 
+class LinkQuerySet(models.QuerySet):
+    def with_stats(self):
+        """
+        Fetches the click counters (`LinkStats`) of every link
+        in the same query, without their unique IP sketch.
+        """
+        return self.select_related('stats').defer('stats__unique_ips_sketch')
+
+
 class Link(models.Model):
+    TEMPORARY_REDIRECT = 302
+    PERMANENT_REDIRECT = 301
+    PERMANENT_REDIRECT_KEEP_METHOD = 308
+    REDIRECT_TYPE_CHOICES = [
+        (TEMPORARY_REDIRECT, _('Temporary (302)')),
+        (PERMANENT_REDIRECT, _('Permanent (301)')),
+        (PERMANENT_REDIRECT_KEEP_METHOD, _('Permanent, keeping the request method (308)')),
+    ]
+
     user = models.ForeignKey(to=User, on_delete=models.CASCADE)
     url = models.URLField(max_length=2048)
     alias = models.CharField(max_length=255, unique=True, validators=[
@@ -22,12 +42,29 @@ class Link(models.Model):
         ),
     ])
     date_created = models.DateTimeField(auto_now_add=True)
+    redirect_type = models.PositiveSmallIntegerField(
+        choices=REDIRECT_TYPE_CHOICES, default=TEMPORARY_REDIRECT,
+        help_text=_("Browsers remember permanent redirects, so only use them for links "
+                    "whose URL won't change."))
+    cache_max_age = models.PositiveIntegerField(
+        default=0,
+        help_text=_("Seconds browsers and proxies may cache the redirect. Cached hits aren't counted. "
+                    "0 disables caching."))
+    click_sampling = models.PositiveIntegerField(
+        default=1, validators=[MinValueValidator(1)],
+        help_text=_("Record about one in this many clicks, each counted this many times. "
+                    "Click totals become estimates. 1 records every click."))
+
+    objects = LinkQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.alias} -> {self.url}"
 
     class Meta:
         ordering = ('-date_created', )
+        constraints = [
+            models.CheckConstraint(check=models.Q(alias=Lower('alias')), name='link_alias_lowercase'),
+        ]
 
     def get_long_url_truncated(self, max_length=30, remove_schema=True):
         truncated_url = self.url
@@ -54,19 +91,87 @@ class Link(models.Model):
         return reverse('app_urls:preview', args=(self.alias,))
 
     def get_clicks(self):
-        clicks = Click.objects.filter(link=self)
-        clicks = clicks.aggregate(total_clicks=models.Sum(
-            'clicks_count'), unique_users=models.Count('ip_address'))
-        if clicks['total_clicks'] is None:
-            clicks['total_clicks'] = 0
-        return clicks
+        """
+        Returns total clicks and unique users (IPs) of the link
+        from its `LinkStats` counters.
+        """
+        try:
+            stats = self.stats
+        except LinkStats.DoesNotExist:
+            return {'total_clicks': 0, 'unique_users': 0}
+        return {'total_clicks': stats.total_clicks, 'unique_users': stats.unique_ips}
 
 
 class Click(models.Model):
-    link = models.ForeignKey(to=Link, on_delete=models.CASCADE)
-    clicked_date = models.DateField(auto_now_add=True)
+    # Lookups by link are served by the `unique_click` index.
+    link = models.ForeignKey(to=Link, on_delete=models.CASCADE, db_index=False)
+    clicked_date = models.DateField(default=date.today)
     ip_address = models.GenericIPAddressField()
     clicks_count = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('link', 'clicked_date', 'ip_address'), name='unique_click'),
+        ]
+        indexes = [
+            # Covers date range aggregates of a link without reading the table.
+            models.Index(fields=('link', 'clicked_date', 'clicks_count'), name='click_link_date_count_idx'),
+            # Finds whether an IP clicked a link on any day (unique IPs).
+            models.Index(fields=('link', 'ip_address'), name='click_link_ip_idx'),
+        ]
+
     def __str__(self):
         return f"{self.link.alias}: {self.clicks_count}"
+
+
+class LinkStats(models.Model):
+    """
+    Click counters of a link, kept up to date by the click recording path
+    (see `app_urls.clicks.write_clicks`) and rebuilt from `Click` rows by
+    the `rebuild_click_stats` command.
+    """
+    link = models.OneToOneField(to=Link, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    total_clicks = models.PositiveBigIntegerField(default=0)
+    unique_ips = models.PositiveBigIntegerField(default=0)
+    last_clicked = models.DateField(null=True, blank=True)
+    # `app_urls.hll.HyperLogLog` of the IPs that ever clicked the link.
+    unique_ips_sketch = models.BinaryField(default=b'', editable=False)
+
+    class Meta:
+        verbose_name_plural = 'link stats'
+
+    def __str__(self):
+        return f"{self.link_id}: {self.total_clicks}"
+
+
+class DailyClicks(models.Model):
+    """
+    Clicks and unique IPs of a link per day, fed by the click recording
+    path and used to serve chart data with a single range scan.
+    """
+    link = models.ForeignKey(to=Link, on_delete=models.CASCADE, related_name='daily_clicks')
+    date = models.DateField()
+    clicks = models.PositiveBigIntegerField(default=0)
+    # `app_urls.hll.HyperLogLog` of the IPs that clicked the link that day.
+    unique_ips_sketch = models.BinaryField(default=b'', editable=False)
+
+    class Meta:
+        verbose_name_plural = 'daily clicks'
+        constraints = [
+            models.UniqueConstraint(fields=('link', 'date'), name='unique_daily_clicks'),
+        ]
+
+    def __str__(self):
+        return f"{self.link_id} {self.date}: {self.clicks}"
+
+
+class AliasCounter(models.Model):
+    """
+    Highest number handed out for generated aliases, reserved in blocks
+    by `app_urls.misc.AliasAllocator`.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
@@ -0,0 +1,225 @@
+"""
+Monthly partitions of the `Click` table on PostgreSQL.
+
+`partition_clicks` turns the table created by the migrations into a table
+partitioned by range of `clicked_date`, with one partition per month named
+`<table>_y<year>m<month>` and a default partition for clicks of months
+without one. Queries filtering on `clicked_date` only read the partitions
+of the months in their range.
+
+Clicks older than the retention window are removed by dropping whole
+partitions, which doesn't leave dead rows behind like a `DELETE` does.
+Other databases, e.g. SQLite, keep a plain table whose old clicks are
+deleted instead.
+"""
+import re
+from datetime import date
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from .models import Click
+
+
+def get_connection():
+    return connections[router.db_for_write(Click)]
+
+
+def supports_partitions(connection):
+    return connection.vendor == 'postgresql'
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def add_months(day, months):
+    """
+    Returns the first day of the month `months` after the month of `day`.
+    """
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def get_retention_cutoff(retention_months=None, today=None):
+    """
+    Returns the first day whose clicks are kept when `retention_months`
+    full months are kept before the current one (`CLICK_RETENTION_MONTHS`
+    by default), or None if all clicks are kept.
+    """
+    if retention_months is None:
+        retention_months = settings.CLICK_RETENTION_MONTHS
+    if not retention_months:
+        return None
+    return add_months(month_start(today or date.today()), -retention_months)
+
+
+def get_months(first_month, last_month):
+    """
+    Yields the first day of every month from `first_month` to `last_month`.
+    """
+    month = month_start(first_month)
+    while month <= last_month:
+        yield month
+        month = add_months(month, 1)
+
+
+def get_table():
+    return Click._meta.db_table
+
+
+def get_partition_name(month):
+    return f'{get_table()}_y{month.year}m{month.month:02d}'
+
+
+def get_default_partition_name():
+    return f'{get_table()}_default'
+
+
+def is_partitioned(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', [get_table()])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def get_partitions(connection):
+    """
+    Returns a {first day of month: partition name} dict of the monthly
+    partitions of the click table.
+    """
+    pattern = re.compile(re.escape(get_table()) + r'_y(\d{4})m(\d{2})$')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = to_regclass(%s)', [get_table()])
+        names = [name for name, in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            partitions[date(int(match[1]), int(match[2]), 1)] = name
+    return dict(sorted(partitions.items()))
+
+
+def convert_to_partitioned(connection, months_ahead):
+    """
+    Replaces the plain click table by a partitioned one holding the same
+    rows, with partitions from the month of the oldest click to
+    `months_ahead` months after the current one. The click table is
+    locked, so clicks wait for it to finish.
+    """
+    table = get_table()
+    old_table = f'{table}_unpartitioned'
+    quote = connection.ops.quote_name
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f'LOCK TABLE {quote(table)} IN ACCESS EXCLUSIVE MODE')
+        # Deferred foreign key checks of clicks written earlier in the
+        # transaction would keep the old table from being dropped.
+        connection.check_constraints()
+        constraints = connection.introspection.get_constraints(cursor, table)
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, 'id'])
+        sequence, = cursor.fetchone()
+        cursor.execute(f'SELECT MIN({quote("clicked_date")}) FROM {quote(table)}')
+        oldest, = cursor.fetchone()
+
+        # Indexes and constraints backed by one are relations, whose names
+        # must be free for the new table's.
+        cursor.execute(f'ALTER TABLE {quote(table)} RENAME TO {quote(old_table)}')
+        for name, constraint in constraints.items():
+            if not constraint['foreign_key'] and not constraint['check']:
+                cursor.execute(f'ALTER INDEX {quote(name)} RENAME TO {quote(name[:50] + "_unpartitioned")}')
+        cursor.execute(
+            f'CREATE TABLE {quote(table)} (LIKE {quote(old_table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+            f'PARTITION BY RANGE ({quote("clicked_date")})')
+        cursor.execute(f'CREATE TABLE {quote(get_default_partition_name())} PARTITION OF {quote(table)} DEFAULT')
+        today = date.today()
+        create_partitions(connection, month_start(oldest or today), add_months(today, months_ahead))
+        cursor.execute(f'INSERT INTO {quote(table)} SELECT * FROM {quote(old_table)}')
+
+        # The primary key and unique constraints of a partitioned table
+        # must include the partition key.
+        pk_name = next(name for name, constraint in constraints.items() if constraint['primary_key'])
+        cursor.execute(
+            f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(pk_name)} '
+            f'PRIMARY KEY ({quote("id")}, {quote("clicked_date")})')
+        with connection.schema_editor(atomic=False) as schema_editor:
+            for constraint in Click._meta.constraints:
+                schema_editor.add_constraint(Click, constraint)
+            for index in Click._meta.indexes:
+                schema_editor.add_index(Click, index)
+        for name, constraint in constraints.items():
+            if constraint['foreign_key']:
+                to_table, to_column = constraint['foreign_key']
+                cursor.execute(
+                    f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} '
+                    f'FOREIGN KEY ({", ".join(quote(column) for column in constraint["columns"])}) '
+                    f'REFERENCES {quote(to_table)} ({quote(to_column)}) DEFERRABLE INITIALLY DEFERRED')
+
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {quote(table)}.{quote("id")}')
+        cursor.execute(f'DROP TABLE {quote(old_table)}')
+
+
+def create_partitions(connection, first_month, last_month):
+    """
+    Creates the missing monthly partitions from `first_month` to
+    `last_month`, moving the clicks of their months out of the default
+    partition. Returns the names of the created partitions.
+    """
+    table = get_table()
+    default = get_default_partition_name()
+    quote = connection.ops.quote_name
+    existing = get_partitions(connection)
+    created = []
+    for month in get_months(first_month, last_month):
+        if month not in existing:
+            name = get_partition_name(month)
+            bounds = [month, add_months(month, 1)]
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                # Creating a partition checks that the default partition has
+                # no rows of its range, so they are moved to it first.
+                cursor.execute(
+                    f'CREATE TABLE {quote(name)} (LIKE {quote(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+                cursor.execute(
+                    f'WITH moved AS (DELETE FROM {quote(default)} '
+                    f'WHERE {quote("clicked_date")} >= %s AND {quote("clicked_date")} < %s RETURNING *) '
+                    f'INSERT INTO {quote(name)} SELECT * FROM moved', bounds)
+                cursor.execute(
+                    f'ALTER TABLE {quote(table)} ATTACH PARTITION {quote(name)} FOR VALUES FROM (%s) TO (%s)',
+                    bounds)
+            created.append(name)
+    return created
+
+
+def get_expired_partitions(connection, before):
+    """
+    Returns the names of the monthly partitions of months ending on or
+    before `before`.
+    """
+    return [name for month, name in get_partitions(connection).items() if add_months(month, 1) <= before]
+
+
+def drop_partitions(connection, before):
+    """
+    Drops the monthly partitions of months ending on or before `before`
+    and deletes the older clicks of the default partition. Returns the
+    names of the dropped partitions.
+    """
+    quote = connection.ops.quote_name
+    dropped = get_expired_partitions(connection, before)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        for name in dropped:
+            cursor.execute(f'DROP TABLE {quote(name)}')
+        cursor.execute(
+            f'DELETE FROM {quote(get_default_partition_name())} WHERE {quote("clicked_date")} < %s', [before])
+    return dropped
+
+
+def delete_clicks(before):
+    """
+    Deletes the clicks older than `before` from a plain click table.
+    Returns the number of deleted clicks.
+    """
+    deleted, _ = Click.objects.filter(clicked_date__lt=before).delete()
+    return deleted
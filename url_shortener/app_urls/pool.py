@@ -0,0 +1,184 @@
+"""
+A thread-safe database connection pool, used by the
+`app_urls.backends.postgresql_pool` database backend.
+
+Each worker process keeps at most `max_size` connections. Connections are
+checked out in most recently used order, so under light load the extra ones
+stay idle and are closed after `max_idle` seconds. Connections older than
+`max_age` seconds are replaced, and those idle for more than `check_after`
+seconds are health checked before they are handed out. Connections that
+are never released, e.g. by threads that exit without closing them, give
+their place back once they are garbage collected.
+"""
+import threading
+import time
+import weakref
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available within the pool's timeout.
+    """
+
+
+class PooledConnection:
+    __slots__ = ('connection', 'created', 'last_used')
+
+    def __init__(self, connection, created=None):
+        self.connection = connection
+        self.last_used = time.monotonic()
+        self.created = self.last_used if created is None else created
+
+
+class ConnectionPool:
+    """
+    Pool of at most `max_size` connections. `check(connection)` returns
+    whether an idle connection still works, `reset(connection)` prepares a
+    returned connection for reuse (e.g. rolls back an open transaction) and
+    returns whether it can be reused.
+    """
+
+    def __init__(self, max_size=4, timeout=10, max_age=30 * 60, max_idle=5 * 60, check_after=10,
+                 check=None, reset=None):
+        if max_size < 1:
+            raise ValueError('Pool size must be at least 1.')
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.check = check or (lambda connection: True)
+        self.reset = reset or (lambda connection: True)
+        self._condition = threading.Condition()
+        self._idle = deque()
+        # Weak references and creation times of checked out connections.
+        self._in_use = {}
+        # Open connections, including those being connected.
+        self._size = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.waits = 0
+
+    def acquire(self, connect):
+        """
+        Returns an idle connection, or one made by calling `connect` if
+        the pool isn't full. Waits for a connection to be released
+        otherwise and raises `PoolTimeout` after `timeout` seconds.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            entry = self._checkout(deadline)
+            if entry is None:
+                try:
+                    entry = PooledConnection(connect())
+                except BaseException:
+                    self._forget()
+                    raise
+                with self._condition:
+                    self.connections_created += 1
+            elif time.monotonic() - entry.last_used > self.check_after and not self._safely(self.check, entry):
+                self._close(entry)
+                continue
+            connection = entry.connection
+            key = id(connection)
+            with self._condition:
+                self._in_use[key] = (weakref.ref(connection, lambda ref: self._reclaim(key)), entry.created)
+            return connection
+
+    def release(self, connection):
+        """
+        Returns `connection` to the pool, or closes it if it's broken or
+        too old. Connections the pool doesn't know are closed.
+        """
+        with self._condition:
+            checked_out = self._in_use.pop(id(connection), None)
+        if checked_out is None:
+            connection.close()
+            return
+        entry = PooledConnection(connection, created=checked_out[1])
+        now = time.monotonic()
+        if now - entry.created >= self.max_age or not self._safely(self.reset, entry):
+            self._close(entry)
+            return
+        entry.last_used = now
+        with self._condition:
+            self._idle.append(entry)
+            self._condition.notify()
+
+    def close_idle(self):
+        """
+        Closes all idle connections, e.g. before the process exits.
+        """
+        with self._condition:
+            entries = list(self._idle)
+            self._idle.clear()
+        for entry in entries:
+            self._close(entry)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'connections_created': self.connections_created,
+                'connections_closed': self.connections_closed,
+                'waits': self.waits,
+            }
+
+    def _checkout(self, deadline):
+        """
+        Returns an idle connection, or None after reserving room for a new
+        one. Stale idle connections are closed on the way.
+        """
+        stale = []
+        try:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    # The least recently used connections are on the left.
+                    while self._idle and (now - self._idle[0].last_used >= self.max_idle
+                                          or now - self._idle[0].created >= self.max_age):
+                        stale.append(self._idle.popleft())
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._size - len(stale) < self.max_size:
+                        self._size += 1
+                        return None
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolTimeout(f'No database connection became available in {self.timeout} seconds.')
+                    self.waits += 1
+                    self._condition.wait(remaining)
+        finally:
+            for entry in stale:
+                self._close(entry)
+
+    def _safely(self, func, entry):
+        try:
+            return func(entry.connection)
+        except Exception:
+            return False
+
+    def _close(self, entry):
+        try:
+            entry.connection.close()
+        except Exception:
+            pass
+        self._forget()
+        with self._condition:
+            self.connections_closed += 1
+
+    def _reclaim(self, key):
+        with self._condition:
+            if self._in_use.pop(key, None) is not None:
+                self._size -= 1
+                self.connections_closed += 1
+                self._condition.notify()
+
+    def _forget(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
@@ -0,0 +1,76 @@
+"""
+Read replica routing.
+
+Databases named in `DATABASE_REPLICAS` (see `SQL_REPLICAS`) serve the reads
+of redirect lookups and analytics views, which run them inside
+`read_from_replica`. All other queries, and all writes, go to `default`.
+
+Replicas lag behind the primary, so a client that just changed something
+is pinned to the primary for `REPLICA_PIN_SECONDS` with a cookie (see
+`pin_to_primary`) and reads its own writes.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_COOKIE = 'pin_primary'
+
+# Database reads are routed to, None for `default`. A context variable, so
+# it follows async views into `sync_to_async` threads.
+current_read_db = ContextVar('current_read_db', default=None)
+
+
+class ReplicaRouter:
+    """
+    Routes reads made inside `read_from_replica` to a replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        return current_read_db.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def is_pinned(request):
+    """
+    Returns whether `request` comes from a client that wrote recently.
+    """
+    return PIN_COOKIE in request.COOKIES
+
+
+def pin_to_primary(response):
+    response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+    return response
+
+
+@contextmanager
+def read_from_replica(request=None):
+    """
+    Routes the reads of the block to a random replica, unless there are no
+    replicas or `request` is pinned to the primary. Yields the database
+    used.
+    """
+    if not settings.DATABASE_REPLICAS or (request is not None and is_pinned(request)):
+        yield DEFAULT_DB_ALIAS
+        return
+    database = random.choice(settings.DATABASE_REPLICAS)
+    token = current_read_db.set(database)
+    try:
+        yield database
+    finally:
+        current_read_db.reset(token)
+
+
+def reading_from_replica():
+    return current_read_db.get() is not None
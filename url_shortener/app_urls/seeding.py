@@ -0,0 +1,107 @@
+"""
+Bulk data generators used by the seeding and benchmark commands.
+"""
+import random
+from datetime import date, timedelta
+from functools import lru_cache, partial
+from itertools import islice
+
+from django.db import connections, router, transaction
+from django.db.models import DateField
+
+from .bloom import add_aliases
+from .models import Link
+
+CLICK_FIELDS = ('link', 'clicked_date', 'ip_address', 'clicks_count')
+
+
+def random_ip(rng):
+    num = rng.randrange(1 << 24, 0xdf000000)
+    return f'{num >> 24}.{num >> 16 & 255}.{num >> 8 & 255}.{num & 255}'
+
+
+def seed_links(user, count, prefix='seed', url='https://github.com/seyyedaliayati', batch_size=1000):
+    """
+    Bulk creates `count` links of `user` with aliases `<prefix>-<n>`
+    and returns their ids.
+    """
+    for start in range(0, count, batch_size):
+        Link.objects.bulk_create(
+            Link(user=user, url=url, alias=f'{prefix}-{i}')
+            for i in range(start, min(start + batch_size, count))
+        )
+    add_aliases(f'{prefix}-{i}' for i in range(count))
+    return list(Link.objects.filter(alias__startswith=f'{prefix}-').order_by('id').values_list('id', flat=True))
+
+
+def generate_clicks(link_ids, count, days=30, rng=None, today=None):
+    """
+    Yields `count` random clicks on `link_ids` spread over the last `days`
+    days, as tuples of `CLICK_FIELDS` values. IPs are drawn from the whole
+    public IPv4 space, so (link, date, ip) collisions are rare.
+    """
+    rng = rng or random.Random()
+    today = today or date.today()
+    dates = [today - timedelta(days=day) for day in range(days)]
+    for _ in range(count):
+        yield rng.choice(link_ids), rng.choice(dates), random_ip(rng), rng.randint(1, 10)
+
+
+def insert_rows(model, fields, rows, batch_size=10000, callback=None):
+    """
+    Streams `rows`, tuples of values of `fields`, into `model`'s table,
+    skipping rows that violate a unique constraint. Calls `callback` with
+    the number of rows sent so far after every batch.
+    Returns the number of rows sent.
+
+    Rows are sent as multi-row INSERTs built once per batch size, without
+    model instances or the ORM's per-value SQL compilation, which dominate
+    `bulk_create` when loading millions of rows. Date values are converted
+    once per distinct value; other values must be ready for the database.
+    """
+    connection = connections[router.db_for_write(model)]
+    model_fields = [model._meta.get_field(name) for name in fields]
+    converters = [
+        lru_cache(maxsize=None)(partial(field.get_db_prep_save, connection=connection))
+        if isinstance(field, DateField) else None
+        for field in model_fields
+    ]
+    rows_per_query = max(1, connection.ops.bulk_batch_size(model_fields, [None] * batch_size))
+    statements = {}
+    sent = 0
+    for batch in batched(rows, batch_size):
+        # Sorted rows touch index pages in order instead of at random.
+        batch = [
+            tuple(value if convert is None else convert(value) for value, convert in zip(row, converters))
+            for row in sorted(batch)
+        ]
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            for rows_chunk in batched(batch, rows_per_query):
+                if len(rows_chunk) not in statements:
+                    statements[len(rows_chunk)] = insert_sql(connection, model, model_fields, len(rows_chunk))
+                cursor.execute(statements[len(rows_chunk)], [value for row in rows_chunk for value in row])
+        sent += len(batch)
+        if callback:
+            callback(sent)
+    return sent
+
+
+def insert_sql(connection, model, model_fields, row_count):
+    ops = connection.ops
+    row = '({})'.format(', '.join(['%s'] * len(model_fields)))
+    return '{} {} ({}) VALUES {} {}'.format(
+        ops.insert_statement(ignore_conflicts=True),
+        ops.quote_name(model._meta.db_table),
+        ', '.join(ops.quote_name(field.column) for field in model_fields),
+        ', '.join([row] * row_count),
+        ops.ignore_conflicts_suffix_sql(ignore_conflicts=True),
+    ).rstrip()
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
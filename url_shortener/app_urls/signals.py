@@ -0,0 +1,34 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .bloom import add_aliases
+from .cache import invalidate_alias
+from .models import Link
+
+
+@receiver(pre_save, sender=Link)
+def invalidate_renamed_alias(sender, instance, **kwargs):
+    """
+    Forgets the previous alias of a link whose alias is being changed
+    (e.g. from the admin).
+    """
+    if instance.pk is None:
+        return
+    old_alias = sender.objects.filter(pk=instance.pk).values_list('alias', flat=True).first()
+    if old_alias and old_alias != instance.alias:
+        invalidate_alias(old_alias)
+
+
+@receiver(post_save, sender=Link)
+@receiver(post_delete, sender=Link)
+def invalidate_link_alias(sender, instance, **kwargs):
+    invalidate_alias(instance.alias)
+
+
+@receiver(post_save, sender=Link)
+def add_link_alias(sender, instance, **kwargs):
+    """
+    Adds a new or renamed alias to the alias filter. Deleted aliases stay
+    in it until it's rebuilt.
+    """
+    add_aliases([instance.alias])
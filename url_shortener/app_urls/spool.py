@@ -0,0 +1,157 @@
+"""
+Local, durable queue of clicks.
+
+`SpoolClickRecorder` appends every click to an SQLite database in WAL mode
+on the web server's disk, and the `click_worker` management command drains
+it into the main database in batches. Appending never touches the main
+database, so redirects are not slowed down (or failed) by it.
+"""
+import fcntl
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date
+
+
+class SpoolLocked(Exception):
+    """
+    Raised when another process is already draining the spool.
+    """
+
+
+class ClickSpool:
+    """
+    Append-only table of (link_id, clicked_date, ip_address, count) rows
+    at `path`. Every thread and process uses its own connection; WAL mode
+    lets the web workers append while `click_worker` reads.
+
+    With `synchronous=NORMAL` a committed click survives a crash of the
+    process but not necessarily a power loss.
+
+    Rows the database rejects are moved to a `quarantine` table with the
+    error, so they don't block the rows behind them.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            # First use in this thread, or a forked worker that must not
+            # share its parent's connection.
+            connection = self._connect()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS clicks ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'link_id INTEGER NOT NULL, '
+            'clicked_date TEXT NOT NULL, '
+            'ip_address TEXT NOT NULL, '
+            'count INTEGER NOT NULL)'
+        )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS quarantine ('
+            'id INTEGER PRIMARY KEY, '
+            'link_id INTEGER NOT NULL, '
+            'clicked_date TEXT NOT NULL, '
+            'ip_address TEXT NOT NULL, '
+            'count INTEGER NOT NULL, '
+            'error TEXT NOT NULL)'
+        )
+        return connection
+
+    def append(self, link_id, clicked_date, ip_address, count=1):
+        self.get_connection().execute(
+            'INSERT INTO clicks (link_id, clicked_date, ip_address, count) VALUES (?, ?, ?, ?)',
+            (link_id, clicked_date.isoformat(), ip_address, count),
+        )
+
+    def pending(self):
+        """
+        Returns the number of rows waiting to be drained. Rows are removed
+        oldest first, so the id range is exact and needs no table scan.
+        """
+        return self.get_connection().execute(
+            'SELECT COALESCE(MAX(id) - MIN(id) + 1, 0) FROM clicks'
+        ).fetchone()[0]
+
+    def read_batch(self, limit):
+        """
+        Returns up to `limit` of the oldest rows as
+        (id, link_id, clicked_date, ip_address, count) tuples.
+        """
+        rows = self.get_connection().execute(
+            'SELECT id, link_id, clicked_date, ip_address, count FROM clicks ORDER BY id LIMIT ?', (limit,),
+        ).fetchall()
+        return [
+            (row_id, link_id, date.fromisoformat(clicked_date), ip_address, count)
+            for row_id, link_id, clicked_date, ip_address, count in rows
+        ]
+
+    def delete_through(self, last_id):
+        """
+        Removes the rows up to and including `last_id`, once they are written.
+        """
+        self.get_connection().execute('DELETE FROM clicks WHERE id <= ?', (last_id,))
+
+    def quarantine(self, row, error):
+        """
+        Keeps `row`, as returned by `read_batch`, that couldn't be written
+        because of `error` in the quarantine table. It's still removed from
+        the spool by `delete_through`.
+        """
+        row_id, link_id, clicked_date, ip_address, count = row
+        self.get_connection().execute(
+            'INSERT OR REPLACE INTO quarantine (id, link_id, clicked_date, ip_address, count, error) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (row_id, link_id, clicked_date.isoformat(), ip_address, count, str(error)),
+        )
+
+    def quarantined(self):
+        """
+        Returns the quarantined rows as (id, link_id, clicked_date,
+        ip_address, count, error) tuples.
+        """
+        rows = self.get_connection().execute(
+            'SELECT id, link_id, clicked_date, ip_address, count, error FROM quarantine ORDER BY id',
+        ).fetchall()
+        return [
+            (row_id, link_id, date.fromisoformat(clicked_date), ip_address, count, error)
+            for row_id, link_id, clicked_date, ip_address, count, error in rows
+        ]
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    @contextmanager
+    def drain_lock(self):
+        """
+        Held by the process draining the spool, so that two workers never
+        write the same clicks. Raises `SpoolLocked` if it's taken.
+        """
+        with open(self.path + '.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise SpoolLocked(f'{self.path} is already being drained.') from None
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,15 +1,85 @@
+import gc
+import json
+import multiprocessing
+import random
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipIf, skipUnless
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_finished, request_started
+from django.conf import settings
+from django.db import (DataError, IntegrityError, OperationalError, close_old_connections, connection, connections,
+                       router, transaction)
+from django.db.models import Sum
 from django.urls import reverse
-from django.test import TestCase, Client
+from django.utils import timezone
+from django.http import Http404
+from django.test import (TestCase, TransactionTestCase, Client, AsyncClient, AsyncRequestFactory, RequestFactory,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 
-from .misc import hash_encode
+from . import bloom, cache as link_cache, eventlog, export, metrics, partitions, routers
+from .clicks import BufferedClickRecorder, SpoolClickRecorder, create_clicks, write_clicks
+from .bench import zipf_choices
+from .bloom import BloomFilter
+from .metrics import ViewTimings, view_timings
+from .views import AnalyticsView, link_redirect_async
+from .misc import AliasAllocator, alias_allocator, hash_encode, save_with_alias
 from .forms import URLShortenerForm
-from .models import Link, User
+from .hll import HyperLogLog, merge_sketches
+from .models import AliasCounter, Click, DailyClicks, Link, LinkStats, User
+from .pool import ConnectionPool, PoolTimeout
+from .spool import ClickSpool
 
 URL = 'https://www.google.com/'
 
 
+async def asgi_request(method, path, query_string='', body=b'', headers=()):
+    """
+    Sends a request through Django's `ASGIHandler`, which unlike
+    `AsyncClient` iterates streaming responses in the event loop, and
+    returns the response's (status, body).
+    """
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+        'method': method, 'path': path, 'query_string': query_string.encode(),
+        'headers': [(b'host', b'testserver')] + [(name.encode(), value.encode()) for name, value in headers],
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 50000),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    # Like the test client, keep the request signals from closing the test
+    # transaction's connection.
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        await ASGIHandler()(scope, receive, send)
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+    status = next(message['status'] for message in messages if message['type'] == 'http.response.start')
+    return status, b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+
+
+@override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
 class TestRedirect(TestCase):
     def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
         self.user = User.objects.create(email='user@gmail.com')
         self.user2 = User.objects.create(email='user2@gmail.com')
 
@@ -36,7 +106,7 @@ class TestRedirect(TestCase):
         Redirect URL with valid alias should redirect to appropriate URL
         with 301 response for all users.
         """
-        Link.objects.create(user=self.user, url=URL, alias='valid')
+        link = Link.objects.create(user=self.user, url=URL, alias='valid')
 
         # Anonymous User
         valid_url = reverse('app_urls:alias', args=('valid',))
@@ -48,8 +118,8 @@ class TestRedirect(TestCase):
         response = self.authenticated_client.get(valid_url)
         self.assertRedirects(response, URL, status_code=302)
 
-        # link.refresh_from_db()
-        # self.assertEqual(link.clicks_count, 1)
+        click = Click.objects.get(link=link)
+        self.assertEqual(click.clicks_count, 2)
 
     def test_redirect_with_uppercase_alias(self):
         """
@@ -57,7 +127,7 @@ class TestRedirect(TestCase):
         should always redirect to the same URL and refer to the same
         row in database for all users.
         """
-        Link.objects.create(user=self.user, url=URL, alias='some_alias')
+        link = Link.objects.create(user=self.user, url=URL, alias='some_alias')
         urls = (reverse('app_urls:alias', args=('Some_Alias',)),
                 reverse('app_urls:alias', args=('some_alias',)),
                 reverse('app_urls:alias', args=('sOmE_aLIas',)))
@@ -71,8 +141,8 @@ class TestRedirect(TestCase):
             response = self.authenticated_client.get(url)
             self.assertRedirects(response, URL, status_code=302)
 
-        # link.refresh_from_db()
-        # self.assertEqual(link.clicks_count, len(urls))
+        click = Click.objects.get(link=link)
+        self.assertEqual(click.clicks_count, 2 * len(urls))
 
     def test_redirect_preview_with_invalid_alias(self):
         """
@@ -108,7 +178,1805 @@ class TestRedirect(TestCase):
         response = self.authenticated_client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, link.url)
-        # self.assertEqual(link.clicks_count, 0)
+        self.assertFalse(Click.objects.filter(link=link).exists())
+
+    def test_preview_with_uppercase_alias(self):
+        """
+        Preview, update and delete pages look aliases up case insensitively.
+        """
+        Link.objects.create(user=self.user, url=URL, alias='mixed-case')
+        for name in ('app_urls:preview', 'app_urls:update', 'app_urls:delete'):
+            response = self.authenticated_client.get(
+                reverse(name, args=('Mixed-CASE',)))
+            self.assertEqual(response.status_code, 200)
+
+    def test_uppercase_alias_is_rejected_by_database(self):
+        with self.assertRaises(IntegrityError):
+            Link.objects.create(user=self.user, url=URL, alias='UPPER')
+
+
+@override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder', REDIRECT_PROXY_CACHE_MAX_AGE=10)
+class TestRedirectPolicy(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.url = reverse('app_urls:alias', args=('policy',))
+        return super().setUp()
+
+    def create_link(self, **kwargs):
+        return Link.objects.create(user=self.user, url=URL, alias='policy', **kwargs)
+
+    def test_default_redirect_is_not_cacheable(self):
+        self.create_link()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(response.has_header('Cache-Control'))
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('X-Accel-Expires'))
+
+    def test_redirect_type(self):
+        link = self.create_link(redirect_type=Link.PERMANENT_REDIRECT)
+        response = self.client.get(self.url + '/path')
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response['Location'], URL + '/path')
+
+        link.redirect_type = Link.PERMANENT_REDIRECT_KEEP_METHOD
+        link.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 308)
+        self.assertEqual(response['Location'], URL)
+
+    def test_other_methods_are_redirected(self):
+        """
+        Like GET, other methods are redirected, which 308 redirects pass on
+        to the link. Clients don't need a CSRF token for it.
+        """
+        self.create_link(redirect_type=Link.PERMANENT_REDIRECT_KEEP_METHOD)
+        client = Client(enforce_csrf_checks=True)
+        for method in ('post', 'put', 'patch', 'delete', 'options'):
+            response = getattr(client, method)(self.url + '/api', data='{}', content_type='application/json')
+            self.assertEqual(response.status_code, 308, method)
+            self.assertEqual(response['Location'], URL + '/api')
+        self.assertEqual(Click.objects.get().clicks_count, 5)
+
+    async def test_other_methods_are_redirected_by_async_view(self):
+        await sync_to_async(self.create_link)(redirect_type=Link.PERMANENT_REDIRECT_KEEP_METHOD)
+        response = await link_redirect_async(AsyncRequestFactory().post(self.url, data={}), alias='policy')
+        self.assertEqual(response.status_code, 308)
+        self.assertTrue(getattr(link_redirect_async, 'csrf_exempt', False))
+
+    def test_cacheable_redirect(self):
+        """
+        Links with a `cache_max_age` are public; nginx keeps them for at most
+        `REDIRECT_PROXY_CACHE_MAX_AGE` seconds.
+        """
+        self.create_link(cache_max_age=3600)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age=3600', response['Cache-Control'])
+        self.assertEqual(response['X-Accel-Expires'], '10')
+        self.assertTrue(response.has_header('ETag'))
+
+    def test_conditional_get(self):
+        """
+        A matching `If-None-Match` gets a 304, a changed link a new ETag.
+        """
+        link = self.create_link(cache_max_age=60)
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(Click.objects.get(link=link).clicks_count, 2)
+
+        link.url = URL + 'changed'
+        link.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 302)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_click_sampling(self):
+        """
+        Sampled links record one click out of `click_sampling`, weighted so
+        that the total stays the same on average.
+        """
+        link = self.create_link(click_sampling=10)
+        with mock.patch('app_urls.misc.random.random', side_effect=[0.5, 0.05, 0.2]):
+            for _ in range(3):
+                self.assertEqual(self.client.get(self.url).status_code, 302)
+        self.assertEqual(Click.objects.get(link=link).clicks_count, 10)
+        self.assertEqual(LinkStats.objects.get(link=link).total_clicks, 10)
+
+    def test_policy_change_invalidates_cache(self):
+        link = self.create_link()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+        link.redirect_type = Link.PERMANENT_REDIRECT
+        link.save()
+        self.assertEqual(self.client.get(self.url).status_code, 301)
+
+    def test_update_view_edits_policy(self):
+        link = self.create_link()
+        client = Client()
+        client.force_login(self.user)
+        response = client.post(reverse('app_urls:update', args=('policy',)), {
+            'url': URL, 'redirect_type': Link.PERMANENT_REDIRECT, 'cache_max_age': 300, 'click_sampling': 0,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('click_sampling', response.context['form'].errors)
+        response = client.post(reverse('app_urls:update', args=('policy',)), {
+            'url': URL, 'redirect_type': Link.PERMANENT_REDIRECT, 'cache_max_age': 300, 'click_sampling': 5,
+        })
+        self.assertEqual(response.status_code, 302)
+        link.refresh_from_db()
+        self.assertEqual((link.redirect_type, link.cache_max_age, link.click_sampling),
+                         (Link.PERMANENT_REDIRECT, 300, 5))
+
+
+class TestBufferedClickRecorder(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='buffered')
+        self.today = date.today()
+        return super().setUp()
+
+    def test_clicks_are_written_on_flush(self):
+        """
+        Clicks are aggregated in memory and written in bulk on flush,
+        incrementing rows that already exist.
+        """
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=100)
+        for _ in range(3):
+            recorder.record(self.link.id, self.today, '1.1.1.1')
+        recorder.record(self.link.id, self.today, '2.2.2.2')
+        self.assertFalse(Click.objects.exists())
+        self.assertEqual(recorder.pending_clicks, 4)
+
+        self.assertEqual(recorder.flush(), 4)
+        self.assertEqual(recorder.pending_clicks, 0)
+        self.assertEqual(
+            Click.objects.get(ip_address='1.1.1.1').clicks_count, 3)
+
+        recorder.record(self.link.id, self.today, '1.1.1.1')
+        recorder.flush()
+        self.assertEqual(
+            Click.objects.get(ip_address='1.1.1.1').clicks_count, 4)
+        self.assertEqual(Click.objects.count(), 2)
+
+    def test_flush_drops_clicks_of_deleted_links(self):
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=100)
+        recorder.record(self.link.id, self.today, '1.1.1.1')
+        recorder.record(self.link.id + 1, self.today, '1.1.1.1')
+        self.assertEqual(recorder.flush(), 1)
+        self.assertEqual(Click.objects.count(), 1)
+
+    def test_clicks_are_unique_per_link_day_and_ip(self):
+        Click.objects.create(link=self.link, ip_address='1.1.1.1', clicks_count=1)
+        with self.assertRaises(IntegrityError):
+            Click.objects.create(link=self.link, ip_address='1.1.1.1', clicks_count=1)
+
+    def test_concurrently_created_clicks_are_incremented(self):
+        """
+        If a row of the batch was created by another worker in the meantime,
+        the batch falls back to incrementing it.
+        """
+        Click.objects.create(link=self.link, ip_address='1.1.1.1', clicks_count=2)
+        create_clicks([
+            Click(link=self.link, clicked_date=self.today, ip_address='1.1.1.1', clicks_count=3),
+            Click(link=self.link, clicked_date=self.today, ip_address='2.2.2.2', clicks_count=1),
+        ])
+        self.assertEqual(
+            dict(Click.objects.values_list('ip_address', 'clicks_count')),
+            {'1.1.1.1': 5, '2.2.2.2': 1})
+
+    def test_flush_keeps_the_click_date(self):
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=100)
+        yesterday = self.today - timedelta(days=1)
+        recorder.record(self.link.id, yesterday, '1.1.1.1')
+        recorder.flush()
+        self.assertEqual(Click.objects.get().clicked_date, yesterday)
+
+    def test_pending_clicks_are_bounded(self):
+        """
+        A full buffer is due for flushing and drops further clicks.
+        """
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=2)
+        recorder.record(self.link.id, self.today, '1.1.1.1')
+        self.assertFalse(recorder.is_flush_due())
+        recorder.record(self.link.id, self.today, '1.1.1.1')
+        recorder.record(self.link.id, self.today, '1.1.1.1')
+        self.assertTrue(recorder.is_flush_due())
+        self.assertEqual(recorder.pending_clicks, 2)
+        self.assertEqual(recorder.dropped, 1)
+        self.assertEqual(recorder.flush_if_due(), 2)
+
+    def test_failed_flush_drops_only_rejected_rows(self):
+        """
+        A row the database rejects is dropped, the other clicks of the
+        flush are written instead of being retried with it forever.
+        """
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=100)
+        recorder.record(self.link.id, self.today, '1.1.1.1', 2)
+        recorder.record(self.link.id, self.today, 'bad')
+        recorder.record(self.link.id, self.today, '2.2.2.2')
+
+        def write(increments):
+            if any(ip_address == 'bad' for _, _, ip_address in increments):
+                raise DataError('invalid input syntax for type inet')
+            return write_clicks(increments)
+
+        with mock.patch('app_urls.clicks.write_clicks', side_effect=write), self.assertLogs('app_urls.clicks'):
+            self.assertEqual(recorder.flush(), 3)
+        self.assertEqual(dict(Click.objects.values_list('ip_address', 'clicks_count')), {'1.1.1.1': 2, '2.2.2.2': 1})
+        self.assertEqual((recorder.dropped, recorder.pending_clicks), (1, 0))
+
+    def test_clicks_are_kept_while_database_is_unavailable(self):
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=100)
+        recorder.record(self.link.id, self.today, '1.1.1.1')
+        with mock.patch('app_urls.clicks.write_clicks', side_effect=OperationalError), \
+                self.assertLogs('app_urls.clicks'):
+            self.assertEqual(recorder.flush(), 0)
+        self.assertEqual((recorder.dropped, recorder.pending_clicks), (0, 1))
+        self.assertEqual(recorder.flush(), 1)
+
+    def test_idle_worker_flushes_in_background(self):
+        """
+        Buffered clicks are written without another request coming in.
+        """
+        recorder = BufferedClickRecorder(flush_interval=0.01, max_pending=100)
+        self.addCleanup(recorder.close)
+        with mock.patch('app_urls.clicks.MIN_BACKGROUND_FLUSH_INTERVAL', 0.01), \
+                mock.patch('app_urls.clicks.write_clicks', return_value=1) as write:
+            recorder.record(self.link.id, self.today, '1.1.1.1')
+            deadline = time.monotonic() + 5
+            while not write.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+        write.assert_called_once_with({(self.link.id, self.today, '1.1.1.1'): 1})
+        self.assertEqual(recorder.pending_clicks, 0)
+
+    def test_redirect_flushes_after_response(self):
+        """
+        With a zero flush interval the buffer is flushed as soon as
+        the redirect response has been sent.
+        """
+        with self.settings(CLICK_BUFFER_FLUSH_INTERVAL=0):
+            response = self.client.get(
+                reverse('app_urls:alias', args=('buffered',)))
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(Click.objects.get(link=self.link).clicks_count, 1)
+
+
+class TestClickSpool(TestCase):
+    def setUp(self) -> None:
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='spooled')
+        self.today = date.today()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = f'{self.directory.name}/spool.sqlite3'
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+        return super().tearDown()
+
+    def drain(self, *args):
+        call_command('click_worker', '--once', '--path', self.path, *args, stdout=StringIO())
+
+    def test_redirect_spools_clicks(self):
+        """
+        Redirects only append to the spool, `click_worker` writes the clicks
+        and the rollups and empties the spool.
+        """
+        with self.settings(CLICK_RECORDER='app_urls.clicks.SpoolClickRecorder', CLICK_SPOOL_PATH=self.path):
+            for _ in range(3):
+                response = self.client.get(reverse('app_urls:alias', args=('spooled',)))
+                self.assertEqual(response.status_code, 302)
+        self.assertFalse(Click.objects.exists())
+        self.assertEqual(ClickSpool(self.path).pending(), 3)
+
+        self.drain('--batch-size', '2')
+        self.assertEqual(Click.objects.get(link=self.link).clicks_count, 3)
+        self.assertEqual(LinkStats.objects.get(link=self.link).total_clicks, 3)
+        self.assertEqual(ClickSpool(self.path).pending(), 0)
+
+    def test_full_spool_drops_clicks(self):
+        recorder = SpoolClickRecorder(self.path, max_pending=2)
+        for _ in range(3):
+            recorder.record(self.link.id, self.today, '1.1.1.1')
+        self.assertEqual(recorder.dropped, 1)
+        self.assertEqual(recorder.spool.pending(), 2)
+
+    def test_failed_batch_stays_in_spool(self):
+        """
+        Clicks are only removed from the spool once they are written.
+        """
+        recorder = SpoolClickRecorder(self.path, max_pending=10)
+        recorder.record(self.link.id, self.today, '1.1.1.1', count=5)
+        with mock.patch('app_urls.management.commands.click_worker.write_clicks',
+                        side_effect=OperationalError('database is down')):
+            with self.assertRaises(OperationalError):
+                self.drain()
+        self.assertEqual(recorder.spool.pending(), 1)
+
+        self.drain()
+        self.assertEqual(Click.objects.get(link=self.link).clicks_count, 5)
+        self.assertEqual(recorder.spool.pending(), 0)
+
+    def test_rejected_rows_are_quarantined(self):
+        """
+        A row the database rejects is quarantined, the rows behind it are
+        still written and the spool is emptied.
+        """
+        spool = ClickSpool(self.path)
+        spool.append(self.link.id, self.today, '1.1.1.1', 2)
+        spool.append(self.link.id, self.today, 'bad')
+        spool.append(self.link.id, self.today, '2.2.2.2')
+
+        def write(increments):
+            if any(ip_address == 'bad' for _, _, ip_address in increments):
+                raise DataError('invalid input syntax for type inet')
+            return write_clicks(increments)
+
+        with mock.patch('app_urls.clicks.write_clicks', side_effect=write), \
+                mock.patch('app_urls.management.commands.click_worker.write_clicks', side_effect=write), \
+                self.assertLogs('app_urls.management.commands.click_worker'):
+            self.drain()
+        self.assertEqual(dict(Click.objects.values_list('ip_address', 'clicks_count')), {'1.1.1.1': 2, '2.2.2.2': 1})
+        self.assertEqual(spool.pending(), 0)
+        self.assertEqual([row[:5] for row in spool.quarantined()], [(2, self.link.id, self.today, 'bad', 1)])
+
+    def test_forwarded_for_must_be_an_ip_address(self):
+        with self.settings(CLICK_RECORDER='app_urls.clicks.SpoolClickRecorder', CLICK_SPOOL_PATH=self.path):
+            for forwarded_for in ('not-an-ip, 10.0.0.1', '2001:DB8::1, 10.0.0.1'):
+                self.client.get(reverse('app_urls:alias', args=('spooled',)),
+                                HTTP_X_FORWARDED_FOR=forwarded_for, REMOTE_ADDR='10.0.0.2')
+        self.assertEqual([row[3] for row in ClickSpool(self.path).read_batch(10)], ['10.0.0.2', '2001:db8::1'])
+
+    def test_one_worker_per_spool(self):
+        spool = ClickSpool(self.path)
+        with spool.drain_lock():
+            with self.assertRaises(CommandError):
+                self.drain()
+
+
+@override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+class TestClickEventLog(TestCase):
+    def setUp(self) -> None:
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='logged')
+        self.directory = tempfile.TemporaryDirectory()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+        return super().tearDown()
+
+    def test_redirect_logs_every_click(self):
+        """
+        Sampled links write a fraction of their clicks, but all of them are logged.
+        """
+        Link.objects.filter(id=self.link.id).update(click_sampling=100)
+        with self.settings(CLICK_EVENT_LOG_DIR=self.directory.name):
+            with mock.patch('app_urls.misc.random.random', return_value=0.5):
+                for _ in range(3):
+                    self.client.get(reverse('app_urls:alias', args=('logged',)),
+                                    HTTP_USER_AGENT='Mozilla', HTTP_REFERER='https://example.com/',
+                                    REMOTE_ADDR='1.2.3.4')
+        self.assertFalse(Click.objects.exists())
+        events = list(eventlog.read_events(self.directory.name))
+        self.assertEqual(len(events), 3)
+        event = events[0]
+        self.assertEqual((event.link_id, event.count, event.ip_address, event.clicked_date),
+                         (self.link.id, 1, '1.2.3.4', date.today()))
+        self.assertEqual(event.user_agent_hash, eventlog.hash_header('Mozilla'))
+        self.assertEqual(event.referrer_hash, eventlog.hash_header('https://example.com/'))
+
+    def test_segments_are_rotated(self):
+        log = eventlog.ClickEventLog(
+            self.directory.name, segment_size=eventlog.SEGMENT_HEADER.size + 2 * eventlog.RECORD.size)
+        now = time.time()
+        for i in range(5):
+            log.append(i, '::1', timestamp=now + i)
+        log.close()
+        self.assertEqual(len(eventlog.get_segments(self.directory.name)), 3)
+        events = list(eventlog.read_events(self.directory.name))
+        self.assertEqual([event.link_id for event in events], [0, 1, 2, 3, 4])
+        self.assertEqual(events[0].ip_address, '::1')
+        self.assertEqual(
+            [event.link_id for event in eventlog.read_events(self.directory.name, start=now + 1, end=now + 3)], [1, 2])
+
+    def test_partial_record_is_ignored(self):
+        log = eventlog.ClickEventLog(self.directory.name, segment_size=1 << 20)
+        log.append(self.link.id, 'not an ip')
+        log.close()
+        path, = eventlog.get_segments(self.directory.name)
+        with open(path, 'ab') as f:
+            f.write(b'partial')
+        events = list(eventlog.read_events(self.directory.name))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].ip_address, '::')
+
+    def test_replay_replaces_clicks_of_logged_days(self):
+        """
+        Replaying rebuilds the clicks and counters of the days in the log
+        and leaves other days alone.
+        """
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        older = today - timedelta(days=5)
+        now = time.time()
+        log = eventlog.ClickEventLog(self.directory.name, segment_size=1 << 20)
+        for ip_address, timestamp in (('1.1.1.1', now), ('1.1.1.1', now), ('2.2.2.2', now - 86400)):
+            log.append(self.link.id, ip_address, timestamp=timestamp)
+        log.append(self.link.id + 1, '1.1.1.1', timestamp=now)
+        log.close()
+        Click.objects.create(link=self.link, clicked_date=today, ip_address='1.1.1.1', clicks_count=1)
+        Click.objects.create(link=self.link, clicked_date=today, ip_address='9.9.9.9', clicks_count=7)
+        Click.objects.create(link=self.link, clicked_date=older, ip_address='3.3.3.3', clicks_count=4)
+
+        out = StringIO()
+        call_command('replay_click_log', '--dir', self.directory.name, '--dry-run', stdout=out)
+        self.assertIn('Read 4 clicks in 3 rows over 2 days', out.getvalue())
+        self.assertEqual(Click.objects.count(), 3)
+
+        call_command('replay_click_log', '--dir', self.directory.name, stdout=StringIO())
+        self.assertEqual(
+            set(Click.objects.values_list('clicked_date', 'ip_address', 'clicks_count')),
+            {(today, '1.1.1.1', 2), (yesterday, '2.2.2.2', 1), (older, '3.3.3.3', 4)})
+        self.assertEqual(LinkStats.objects.get(link=self.link).total_clicks, 7)
+
+        call_command('replay_click_log', '--dir', self.directory.name, '--start', str(today), stdout=StringIO())
+        self.assertEqual(Click.objects.filter(clicked_date=yesterday).count(), 1)
+
+    def test_replay_keeps_clicks_the_log_does_not_cover(self):
+        """
+        Clicks of links the log has none of on a day, e.g. recorded by
+        another host, are only replaced with `--replace-days`.
+        """
+        today = date.today()
+        other = Link.objects.create(user=self.user, url=URL, alias='other-host')
+        log = eventlog.ClickEventLog(self.directory.name, segment_size=1 << 20)
+        log.append(self.link.id, '1.1.1.1')
+        log.close()
+        Click.objects.create(link=other, clicked_date=today, ip_address='2.2.2.2', clicks_count=3)
+
+        call_command('replay_click_log', '--dir', self.directory.name, stdout=StringIO())
+        self.assertEqual(
+            set(Click.objects.values_list('link_id', 'ip_address', 'clicks_count')),
+            {(self.link.id, '1.1.1.1', 1), (other.id, '2.2.2.2', 3)})
+
+        call_command('replay_click_log', '--dir', self.directory.name, '--replace-days', stdout=StringIO())
+        self.assertEqual(list(Click.objects.values_list('link_id', flat=True)), [self.link.id])
+
+    def test_replay_reads_one_day_at_a_time(self):
+        """
+        Long logs are aggregated and written day by day, reading only the
+        segments with events of that day.
+        """
+        now = time.time()
+        # One record per segment.
+        log = eventlog.ClickEventLog(
+            self.directory.name, segment_size=eventlog.SEGMENT_HEADER.size + eventlog.RECORD.size)
+        for days_ago in (3, 2, 2, 0):
+            log.append(self.link.id, '1.1.1.1', timestamp=now - days_ago * 86400)
+        log.close()
+        self.assertEqual([len(paths) for paths in eventlog.get_log_days(self.directory.name).values()], [1, 2, 1])
+
+        with mock.patch('app_urls.management.commands.replay_click_log.aggregate_clicks',
+                        wraps=eventlog.aggregate_clicks) as aggregate:
+            call_command('replay_click_log', '--dir', self.directory.name, stdout=StringIO())
+        self.assertEqual([len(aggregate_call.args[3]) for aggregate_call in aggregate.call_args_list], [1, 2, 1])
+        self.assertEqual(Click.objects.count(), 3)
+        self.assertEqual(Click.objects.aggregate(total=Sum('clicks_count'))['total'], 4)
+
+    def test_replay_requires_a_directory(self):
+        with self.assertRaises(CommandError):
+            call_command('replay_click_log', stdout=StringIO())
+
+
+class TestLinkStats(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='stats')
+        self.today = date.today()
+        return super().setUp()
+
+    def test_stats_are_maintained_by_writes(self):
+        """
+        Written clicks add to total clicks, count IPs once across days
+        and keep the latest click date.
+        """
+        yesterday = self.today - timedelta(days=1)
+        self.assertEqual(self.link.get_clicks(), {'total_clicks': 0, 'unique_users': 0})
+        write_clicks({(self.link.id, yesterday, '1.1.1.1'): 2})
+        write_clicks({
+            (self.link.id, self.today, '1.1.1.1'): 1,
+            (self.link.id, self.today, '2.2.2.2'): 3,
+        })
+        write_clicks({(self.link.id, yesterday, '1.1.1.1'): 1})
+        stats = LinkStats.objects.get(link=self.link)
+        self.assertEqual(stats.total_clicks, 7)
+        self.assertEqual(stats.unique_ips, 2)
+        self.assertEqual(stats.last_clicked, self.today)
+
+    def test_rows_are_written_in_key_order(self):
+        """
+        Concurrent flushes lock rows in the same order, whatever the order
+        of their clicks, so they can't deadlock.
+        """
+        other = Link.objects.create(user=self.user, url=URL, alias='stats-2')
+        yesterday = self.today - timedelta(days=1)
+        increments = {
+            (other.id, self.today, '2.2.2.2'): 1,
+            (other.id, self.today, '1.1.1.1'): 1,
+            (self.link.id, self.today, '1.1.1.1'): 1,
+            (self.link.id, yesterday, '1.1.1.1'): 1,
+        }
+        write_clicks({key: 1 for key in increments})
+        with CaptureQueriesContext(connection) as queries:
+            write_clicks(increments)
+
+        def get_updates(model):
+            return [query['sql'] for query in queries if query['sql'].startswith(f'UPDATE "{model._meta.db_table}"')]
+
+        updates = get_updates(Click)
+        self.assertEqual(len(updates), 4)
+        for sql, (link_id, clicked_date, ip_address) in zip(updates, sorted(increments)):
+            self.assertIn(f'"link_id" = {link_id}', sql)
+            self.assertIn(f"'{clicked_date}'", sql)
+            self.assertIn(f"'{ip_address}'", sql)
+        self.assertEqual([f'"link_id" = {link_id}' in sql for sql, link_id in zip(
+            get_updates(LinkStats), [self.link.id, other.id])], [True, True])
+        self.assertEqual([f'"link_id" = {link_id}' in sql for sql, link_id in zip(
+            get_updates(DailyClicks), [self.link.id, self.link.id, other.id])], [True, True, True])
+
+    def test_rebuild_reports_and_fixes_drift(self):
+        write_clicks({(self.link.id, self.today, '1.1.1.1'): 2})
+        Click.objects.create(link=self.link, ip_address='2.2.2.2', clicks_count=5)
+        other = Link.objects.create(user=self.user, url=URL, alias='no-stats')
+        Click.objects.create(link=other, ip_address='2.2.2.2', clicks_count=1)
+
+        out = StringIO()
+        call_command('rebuild_click_stats', '--dry-run', stdout=out)
+        self.assertIn('total_clicks 2 -> 7', out.getvalue())
+        self.assertIn('drift in 2', out.getvalue())
+        self.assertEqual(LinkStats.objects.get(link=self.link).total_clicks, 2)
+
+        call_command('rebuild_click_stats', stdout=StringIO())
+        self.assertEqual(self.link.get_clicks(), {'total_clicks': 7, 'unique_users': 2})
+        self.assertEqual(Link.objects.get(id=other.id).get_clicks()['total_clicks'], 1)
+
+        out = StringIO()
+        call_command('rebuild_click_stats', stdout=out)
+        self.assertIn('drift in 0', out.getvalue())
+
+    def test_rebuild_fixes_daily_clicks(self):
+        write_clicks({(self.link.id, self.today, '1.1.1.1'): 2})
+        DailyClicks.objects.filter(link=self.link).update(clicks=1)
+        DailyClicks.objects.create(link=self.link, date=self.today - timedelta(days=3), clicks=4)
+        out = StringIO()
+        call_command('rebuild_click_stats', stdout=out)
+        self.assertIn(f'on {self.today}: clicks 1 -> 2', out.getvalue())
+        self.assertEqual(
+            list(DailyClicks.objects.filter(link=self.link).values_list('date', 'clicks')),
+            [(self.today, 2)])
+
+
+class TestFillDb(TestCase):
+    """
+    `fill_db` streams users, links and clicks in batches and leaves
+    the click counters consistent.
+    """
+
+    def test_fill_db(self):
+        call_command('fill_db', '--users', '3', '--links', '20', '--clicks', '500', '--days', '5',
+                     '--seed', '1', '--batch-size', '64', stdout=StringIO())
+        self.assertTrue(User.objects.get(email='admin@admin.com').is_superuser)
+        self.assertEqual(User.objects.count(), 3)
+        self.assertEqual(Link.objects.count(), 20)
+        self.assertEqual(Link.objects.values('alias').distinct().count(), 20)
+        clicks = Click.objects.count()
+        self.assertGreater(clicks, 490)
+        self.assertFalse(Click.objects.filter(clicked_date__lt=date.today() - timedelta(days=4)).exists())
+        self.assertEqual(
+            LinkStats.objects.aggregate(total=Sum('total_clicks'))['total'],
+            Click.objects.aggregate(total=Sum('clicks_count'))['total'])
+
+        out = StringIO()
+        call_command('rebuild_click_stats', '--dry-run', stdout=out)
+        self.assertIn('drift in 0', out.getvalue())
+
+    def test_fill_db_can_run_again(self):
+        call_command('fill_db', '--links', '5', '--clicks', '10', stdout=StringIO())
+        call_command('fill_db', '--links', '5', '--clicks', '10', stdout=StringIO())
+        self.assertEqual(User.objects.count(), 1)
+        self.assertEqual(Link.objects.count(), 10)
+
+
+class TestClickPartitions(TestCase):
+    """
+    `partition_clicks` partitions clicks by month on PostgreSQL and removes
+    the clicks older than the retention window.
+    """
+
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='partitioned')
+        self.this_month = partitions.month_start(date.today())
+        for months in (-5, -2, 0):
+            Click.objects.create(link=self.link, clicked_date=partitions.add_months(self.this_month, months),
+                                 ip_address='1.2.3.4', clicks_count=1)
+        return super().setUp()
+
+    def partition_clicks(self, *args):
+        out = StringIO()
+        call_command('partition_clicks', *args, stdout=out)
+        return out.getvalue()
+
+    def test_add_months(self):
+        self.assertEqual(partitions.add_months(date(2024, 11, 15), 2), date(2025, 1, 1))
+        self.assertEqual(partitions.add_months(date(2024, 1, 31), -1), date(2023, 12, 1))
+
+    def test_retention(self):
+        self.assertIn('Would', self.partition_clicks('--retention-months', '3', '--dry-run'))
+        self.assertEqual(Click.objects.count(), 3)
+        self.partition_clicks('--retention-months', '3')
+        self.assertEqual(
+            sorted(Click.objects.values_list('clicked_date', flat=True)),
+            [partitions.add_months(self.this_month, -2), self.this_month])
+        self.partition_clicks('--retention-months', '0')
+        self.assertEqual(Click.objects.count(), 2)
+
+    @override_settings(CLICK_RETENTION_MONTHS=1)
+    def test_retention_setting(self):
+        self.partition_clicks()
+        self.assertEqual(list(Click.objects.values_list('clicked_date', flat=True)), [self.this_month])
+
+    def test_rebuild_keeps_rollups_of_dropped_days(self):
+        """
+        Rebuilding the click counters after old clicks were dropped keeps
+        what the counters and daily clicks know of them.
+        """
+        Click.objects.all().delete()
+        old_day = partitions.add_months(self.this_month, -5)
+        write_clicks({
+            (self.link.id, old_day, '1.1.1.1'): 2,
+            (self.link.id, old_day, '2.2.2.2'): 1,
+            (self.link.id, self.this_month, '1.1.1.1'): 3,
+        })
+
+        def get_rollups():
+            stats = LinkStats.objects.get(link=self.link)
+            return (stats.total_clicks, stats.unique_ips, stats.last_clicked, bytes(stats.unique_ips_sketch),
+                    sorted((daily.date, daily.clicks, bytes(daily.unique_ips_sketch))
+                           for daily in DailyClicks.objects.filter(link=self.link)))
+
+        rollups = get_rollups()
+        self.assertEqual(rollups[:3], (6, 2, self.this_month))
+        with self.settings(CLICK_RETENTION_MONTHS=3):
+            self.partition_clicks()
+            self.assertEqual(Click.objects.count(), 1)
+            out = StringIO()
+            call_command('rebuild_click_stats', sketches=True, stdout=out)
+        self.assertIn('drift in 0', out.getvalue())
+        self.assertEqual(get_rollups(), rollups)
+
+    @skipUnless(connection.vendor == 'postgresql', "Partitions need PostgreSQL.")
+    def test_partitions(self):
+        self.partition_clicks('--months-ahead', '1')
+        self.assertTrue(partitions.is_partitioned(connection))
+        self.assertEqual(
+            list(partitions.get_partitions(connection)),
+            list(partitions.get_months(partitions.add_months(self.this_month, -5),
+                                       partitions.add_months(self.this_month, 1))))
+        self.assertEqual(Click.objects.count(), 3)
+        # Clicks of months without a partition go to the default one, and
+        # move to their partition once it's created.
+        later = partitions.add_months(self.this_month, 3)
+        Click.objects.create(link=self.link, clicked_date=later, ip_address='1.2.3.4', clicks_count=1)
+        self.assertIn(partitions.get_partition_name(later), self.partition_clicks('--months-ahead', '3'))
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {partitions.get_partition_name(later)}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+        self.partition_clicks('--retention-months', '3')
+        self.assertNotIn(partitions.add_months(self.this_month, -5), partitions.get_partitions(connection))
+        self.assertEqual(Click.objects.count(), 3)
+        # Clicks are still written and read through the partitioned table.
+        write_clicks({(self.link.id, self.this_month, '1.2.3.4'): 2})
+        self.assertEqual(Click.objects.get(clicked_date=self.this_month).clicks_count, 3)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Click.objects.create(link=self.link, clicked_date=self.this_month, ip_address='1.2.3.4')
+
+
+class TestChartBatch(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='user@gmail.com')
+        self.authenticated_client = Client()
+        self.authenticated_client.force_login(user=self.user)
+        self.url = reverse('app_urls:chart_batch')
+        links = [Link.objects.create(user=self.user, url=URL, alias=f'batch{i}') for i in range(3)]
+        other = Link.objects.create(user=User.objects.create(email='user2@gmail.com'), url=URL, alias='other')
+        write_clicks({
+            (links[0].id, date(2022, 1, 1), '1.1.1.1'): 2,
+            (links[0].id, date(2022, 1, 3), '2.2.2.2'): 1,
+            (links[1].id, date(2022, 1, 9), '1.1.1.1'): 5,
+            (links[2].id, date(2022, 1, 2), '1.1.1.1'): 4,
+            (other.id, date(2022, 1, 2), '1.1.1.1'): 7,
+        })
+        return super().setUp()
+
+    def get(self, params, status_code=200):
+        response = self.authenticated_client.get(self.url, {'start': '2022-01-01', 'end': '2022-01-03', **params})
+        self.assertEqual(response.status_code, status_code)
+        return response.json()
+
+    def test_requested_aliases(self):
+        """
+        Series of the requested links are read in one query. Unknown aliases
+        and other users' links are reported as missing.
+        """
+        with self.assertNumQueries(3):
+            data = self.get({'alias': ['batch1', 'Batch0', 'other', 'unknown']})
+        self.assertEqual(data, {
+            'labels': ['2022-01-01', '2022-01-02', '2022-01-03'],
+            'series': [
+                {'alias': 'batch1', 'total': 0, 'data': [0, 0, 0]},
+                {'alias': 'batch0', 'total': 3, 'data': [2, 0, 1]},
+            ],
+            'missing': ['other', 'unknown'],
+        })
+
+    def test_all_links_are_paginated(self):
+        with self.settings(CHART_BATCH_MAX_LINKS=2):
+            first = self.get({'all': '1'})
+            second = self.get({'all': '1', 'page': '2'})
+            self.get({'all': '1', 'page': '0'}, status_code=400)
+            self.get({'alias': ['batch0', 'batch1', 'batch2']}, status_code=400)
+        self.assertEqual([s['alias'] for s in first['series']], ['batch2', 'batch1'])
+        self.assertTrue(first['has_next'])
+        self.assertEqual(second['series'], [{'alias': 'batch0', 'total': 3, 'data': [2, 0, 1]}])
+        self.assertFalse(second['has_next'])
+
+    def test_invalid_requests(self):
+        self.get({}, status_code=400)
+        self.get({'alias': 'batch0', 'start': '2022-01-05'}, status_code=400)
+
+
+class TestHyperLogLog(TestCase):
+    def test_estimates(self):
+        """
+        Estimates are exact for a handful of values and within a few
+        standard errors (1.6%) for many.
+        """
+        for count in (0, 1, 5, 100, 20000):
+            sketch = HyperLogLog()
+            sketch.update(f'10.0.{i >> 8}.{i & 255}' for i in range(count))
+            if count <= 5:
+                self.assertEqual(sketch.count(), count)
+            else:
+                self.assertAlmostEqual(sketch.count() / count, 1, delta=0.05)
+
+    def test_merge_and_serialization(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        first.update(str(i) for i in range(3000))
+        second.update(str(i) for i in range(2000, 5000))
+        merged = merge_sketches([first.to_bytes(), b'', second.to_bytes()])
+        self.assertAlmostEqual(merged.count() / 5000, 1, delta=0.05)
+        self.assertEqual(HyperLogLog.from_bytes(first.to_bytes()).registers, first.registers)
+        self.assertLess(len(HyperLogLog.from_bytes(b'').to_bytes()), 32)
+        self.assertFalse(first.add('1'))
+
+    def test_sketches_follow_clicks(self):
+        """
+        Clicks update the daily and link sketches, and `rebuild_click_stats
+        --sketches` rebuilds the same sketches from the clicks.
+        """
+        link = Link.objects.create(user=User.objects.create(email='user@gmail.com'), url=URL, alias='sketched')
+        today = date.today()
+        write_clicks({(link.id, today, '1.1.1.1'): 3, (link.id, today, '2.2.2.2'): 1})
+        write_clicks({(link.id, today, '1.1.1.1'): 1, (link.id, today - timedelta(days=1), '3.3.3.3'): 1})
+        daily = DailyClicks.objects.get(link=link, date=today)
+        self.assertEqual(HyperLogLog.from_bytes(daily.unique_ips_sketch).count(), 2)
+        stats = LinkStats.objects.get(link=link)
+        self.assertEqual(HyperLogLog.from_bytes(stats.unique_ips_sketch).count(), 3)
+
+        out = StringIO()
+        call_command('rebuild_click_stats', '--sketches', stdout=out)
+        self.assertIn('drift in 0', out.getvalue())
+        DailyClicks.objects.filter(link=link).update(unique_ips_sketch=b'')
+        call_command('rebuild_click_stats', '--sketches', stdout=StringIO())
+        daily.refresh_from_db()
+        self.assertEqual(HyperLogLog.from_bytes(daily.unique_ips_sketch).count(), 2)
+
+
+class TestChartData(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='chart')
+        self.authenticated_client = Client()
+        self.authenticated_client.force_login(user=self.user)
+        self.url = reverse('app_urls:chart_data', args=('chart',))
+        return super().setUp()
+
+    def test_daily_clicks_are_zero_filled(self):
+        write_clicks({
+            (self.link.id, date(2022, 1, 2), '1.1.1.1'): 2,
+            (self.link.id, date(2022, 1, 2), '2.2.2.2'): 1,
+            (self.link.id, date(2022, 1, 4), '1.1.1.1'): 5,
+            (self.link.id, date(2022, 1, 9), '1.1.1.1'): 5,
+        })
+        with self.assertNumQueries(4):
+            response = self.authenticated_client.get(self.url, {'start': '2022-01-01', 'end': '2022-01-05'})
+        self.assertEqual(response.json(), {
+            'labels': ['2022-01-01', '2022-01-02', '2022-01-03', '2022-01-04', '2022-01-05'],
+            'data': [0, 3, 0, 5, 0],
+            'unique_data': [0, 2, 0, 1, 0],
+            'unique_ips': 2,
+        })
+
+    def test_default_range_is_last_week(self):
+        response = self.authenticated_client.get(self.url)
+        labels = response.json()['labels']
+        self.assertEqual(len(labels), 8)
+        self.assertEqual(labels[-1], str(date.today()))
+
+    def test_invalid_range(self):
+        for params in ({'start': 'yesterday'}, {'start': '2022-02-30'},
+                       {'start': '2022-01-05', 'end': '2022-01-01'},
+                       {'start': '2000-01-01', 'end': '2022-01-01'}):
+            response = self.authenticated_client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_other_users_link(self):
+        client = Client()
+        client.force_login(User.objects.create(email='user2@gmail.com'))
+        self.assertEqual(client.get(self.url).status_code, 403)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(TestCase):
+    """
+    `ConnectionPool` reuses, bounds, checks and evicts connections.
+    """
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(max_size=2)
+        connection = pool.acquire(FakeConnection)
+        pool.release(connection)
+        self.assertIs(pool.acquire(FakeConnection), connection)
+        other = pool.acquire(FakeConnection)
+        self.assertIsNot(other, connection)
+        self.assertEqual(pool.stats()['connections_created'], 2)
+        self.assertEqual(pool.stats()['in_use'], 2)
+
+    def test_full_pool_waits_for_release(self):
+        pool = ConnectionPool(max_size=1, timeout=0.05)
+        connection = pool.acquire(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection)
+        pool.timeout = 5
+        threading.Timer(0.05, pool.release, (connection,)).start()
+        self.assertIs(pool.acquire(FakeConnection), connection)
+        self.assertEqual(pool.stats()['waits'], 2)
+
+    def test_stale_connections_are_replaced(self):
+        pool = ConnectionPool(max_size=1, max_idle=0)
+        idle = pool.acquire(FakeConnection)
+        pool.release(idle)
+        self.assertIsNot(pool.acquire(FakeConnection), idle)
+        self.assertTrue(idle.closed)
+
+        pool = ConnectionPool(max_size=1, max_age=0)
+        old = pool.acquire(FakeConnection)
+        pool.release(old)
+        self.assertTrue(old.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_broken_connections_are_closed(self):
+        pool = ConnectionPool(max_size=1, check_after=0, check=lambda connection: not connection.broken)
+        connection = pool.acquire(FakeConnection)
+        connection.broken = True
+        pool.release(connection)
+        replacement = pool.acquire(FakeConnection)
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.closed)
+
+        pool.reset = mock.Mock(side_effect=OperationalError)
+        pool.release(replacement)
+        self.assertTrue(replacement.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_lost_connections_are_reclaimed(self):
+        pool = ConnectionPool(max_size=1, timeout=0)
+        pool.acquire(FakeConnection)
+        gc.collect()
+        connection = pool.acquire(FakeConnection)
+        self.assertEqual(pool.stats()['connections_closed'], 1)
+        self.assertEqual(pool.stats()['in_use'], 1)
+        pool.release(connection)
+
+    def test_benchmark_needs_postgresql(self):
+        with self.assertRaises(CommandError):
+            call_command('bench_connections', stdout=StringIO())
+
+
+@override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+class TestAliasCache(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.authenticated_client = Client()
+        self.authenticated_client.force_login(user=self.user)
+        return super().setUp()
+
+    def test_resolve_hits_database_once(self):
+        """
+        Resolving the same alias twice, in any case, only queries once.
+        """
+        link = Link.objects.create(user=self.user, url=URL, alias='cached')
+        with self.assertNumQueries(1):
+            self.assertEqual(link_cache.resolve_alias('cached')[:2], (link.id, URL))
+        with self.assertNumQueries(0):
+            self.assertEqual(link_cache.resolve_alias('CACHED')[:2], (link.id, URL))
+        stats = link_cache.alias_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['local_hits'], 1)
+
+    def test_shared_tier_is_used_after_local_eviction(self):
+        link = Link.objects.create(user=self.user, url=URL, alias='shared')
+        link_cache.resolve_alias('shared')
+        link_cache.alias_cache.local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(link_cache.resolve_alias('shared')[:2], (link.id, URL))
+        self.assertEqual(link_cache.alias_cache.stats()['shared_hits'], 1)
+
+    def test_local_memory_shared_tier_expires_with_local_tier(self):
+        """
+        A local-memory cache isn't shared by the workers, so it keeps aliases
+        no longer than the local tier and edits reach every worker as quickly.
+        """
+        link = Link.objects.create(user=self.user, url=URL, alias='locmem')
+        link_cache.resolve_alias('locmem')
+        link_cache.alias_cache.local.clear()
+        later = time.time() + settings.LINK_CACHE_LOCAL_TIMEOUT + 1
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=later):
+            with self.assertNumQueries(1):
+                self.assertEqual(link_cache.resolve_alias('locmem')[:2], (link.id, URL))
+        self.assertEqual(link_cache.alias_cache.stats()['misses'], 2)
+
+    def test_negative_caching(self):
+        """
+        Unknown aliases are cached until a link with that alias is created.
+        """
+        self.assertIsNone(link_cache.resolve_alias('later'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(link_cache.resolve_alias('later'))
+        self.assertEqual(link_cache.alias_cache.stats()['negative_hits'], 1)
+        link = Link.objects.create(user=self.user, url=URL, alias='later')
+        self.assertEqual(link_cache.resolve_alias('later')[:2], (link.id, URL))
+
+    def test_local_tier_is_bounded(self):
+        with self.settings(LINK_CACHE_LOCAL_SIZE=2):
+            for alias in ('a', 'b', 'c'):
+                link_cache.resolve_alias(alias)
+            self.assertEqual(len(link_cache.alias_cache.local), 2)
+            self.assertIsNone(link_cache.alias_cache.local.get('a'))
+
+    def test_update_and_delete_invalidate(self):
+        """
+        Updating or deleting a link through the views is visible
+        to the next redirect.
+        """
+        Link.objects.create(user=self.user, url=URL, alias='changing')
+        redirect_url = reverse('app_urls:alias', args=('changing',))
+        self.assertRedirects(self.client.get(redirect_url), URL,
+                             status_code=302, target_status_code=302)
+
+        new_url = 'https://www.example.com/'
+        self.authenticated_client.post(
+            reverse('app_urls:update', args=('changing',)),
+            {'url': new_url, 'redirect_type': Link.TEMPORARY_REDIRECT, 'cache_max_age': 0, 'click_sampling': 1})
+        self.assertRedirects(self.client.get(redirect_url), new_url,
+                             status_code=302, fetch_redirect_response=False)
+
+        self.authenticated_client.post(
+            reverse('app_urls:delete', args=('changing',)))
+        self.assertEqual(self.client.get(redirect_url).status_code, 404)
+
+    def test_admin_rename_invalidates_old_alias(self):
+        link = Link.objects.create(user=self.user, url=URL, alias='old-name')
+        link_cache.resolve_alias('old-name')
+        link.alias = 'new-name'
+        link.save()
+        self.assertIsNone(link_cache.resolve_alias('old-name'))
+        self.assertEqual(link_cache.resolve_alias('new-name')[:2], (link.id, URL))
+
+
+@override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+class TestAliasFilter(TestCase):
+    """
+    Aliases the alias filter rules out get a 404 without any lookup.
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(ALIAS_FILTER_DIR=self.directory.name)
+        self.settings_override.enable()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='filtered')
+        self.alias_filter = bloom.get_alias_filter()
+        self.assertTrue(self.alias_filter.rebuild(force=True))
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom_filter = BloomFilter.create(1000, 0.01)
+        aliases = [f'alias-{i}' for i in range(1000)]
+        for alias in aliases:
+            bloom_filter.add(alias)
+        self.assertTrue(all(alias in bloom_filter for alias in aliases))
+        false_positives = sum(f'other-{i}' in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_unknown_alias_is_not_looked_up(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/unknown-alias').status_code, 404)
+        self.assertEqual(self.client.get('/Filtered').status_code, 302)
+        stats = link_cache.alias_cache.stats()
+        self.assertEqual((stats['filtered'], stats['misses']), (1, 1))
+
+    def test_new_links_are_added(self):
+        Link.objects.create(user=self.user, url=URL, alias='created-later')
+        self.assertEqual(self.client.get('/created-later').status_code, 302)
+        authenticated_client = Client()
+        authenticated_client.force_login(user=self.user)
+        response = authenticated_client.post(
+            reverse('app_urls:bulk_create'), data=json.dumps({'links': [{'url': URL, 'alias': 'imported'}]}),
+            content_type='application/json')
+        b''.join(response.streaming_content)
+        self.assertEqual(self.client.get('/imported').status_code, 302)
+
+    def test_links_added_during_a_rebuild_are_kept(self):
+        """
+        Aliases a worker added are added again to a rebuilt filter that
+        was read from the database before they were created.
+        """
+        self.alias_filter.add(['racing'])
+        self.alias_filter.rebuild(force=True)
+        self.assertTrue(self.alias_filter.may_exist('racing'))
+        self.assertFalse(self.alias_filter.may_exist('never-created'))
+
+    def test_aliases_added_before_any_lookup_are_shared(self):
+        """
+        A process that never looked up an alias, e.g. a bulk import run
+        from the command line, adds its aliases to the shared file.
+        """
+        writer = bloom.AliasFilter(self.directory.name)
+        self.assertFalse(self.alias_filter.may_exist('from-writer'))
+        writer.add(['from-writer'])
+        self.assertTrue(self.alias_filter.may_exist('from-writer'))
+        writer.close()
+
+    def test_links_created_elsewhere_are_synced(self):
+        """
+        Links created by processes that don't share the filter file, e.g. on
+        another host, are added by the next sync. Links created within the
+        sync margin are read again, as links with lower ids may still commit.
+        """
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        Link.objects.filter(id=self.link.id).update(date_created=an_hour_ago)
+        self.alias_filter.rebuild(force=True)
+        # Creating links without signals, like another host would.
+        Link.objects.bulk_create([
+            Link(user=self.user, url=URL, alias='elsewhere-old'),
+            Link(user=self.user, url=URL, alias='elsewhere-new'),
+        ])
+        Link.objects.filter(alias='elsewhere-old').update(date_created=an_hour_ago)
+        self.assertFalse(self.alias_filter.may_exist('elsewhere-old'))
+        self.assertFalse(self.alias_filter.may_exist('elsewhere-new'))
+
+        self.assertEqual(self.alias_filter.sync(), 2)
+        self.assertTrue(self.alias_filter.may_exist('elsewhere-old'))
+        self.assertTrue(self.alias_filter.may_exist('elsewhere-new'))
+        self.assertEqual(self.client.get('/elsewhere-new').status_code, 302)
+        self.assertEqual(self.alias_filter.sync(), 1)
+
+    def test_stats_report_memory(self):
+        stats = link_cache.alias_cache.stats()['alias_filter']
+        self.assertTrue(stats['ready'])
+        self.assertEqual(stats['aliases'], 1)
+        num_bits, _ = bloom.get_size(settings.ALIAS_FILTER_MIN_CAPACITY, settings.ALIAS_FILTER_ERROR_RATE)
+        self.assertEqual(stats['bytes'], bloom.HEADER.size + (num_bits + 7) // 8)
+
+    @override_settings(ALIAS_FILTER_DIR=None)
+    def test_disabled(self):
+        self.assertIsNone(bloom.get_alias_filter())
+        self.assertEqual(self.client.get('/unknown-alias').status_code, 404)
+        self.assertEqual(link_cache.alias_cache.stats()['filtered'], 0)
+
+
+class TestAsyncRedirect(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='async')
+        self.factory = AsyncRequestFactory()
+        return super().setUp()
+
+    async def test_redirect(self):
+        request = self.factory.get('/Async/path?q=1')
+        response = await link_redirect_async(request, alias='Async', extra='/path')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, URL + '/path')
+
+    async def test_invalid_alias(self):
+        with self.assertRaises(Http404):
+            await link_redirect_async(self.factory.get('/invalid'), alias='invalid')
+
+    async def test_clicks_are_buffered(self):
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=100)
+        with mock.patch('app_urls.misc.get_click_recorder', return_value=recorder):
+            await link_redirect_async(self.factory.get('/async'), alias='async')
+            await link_redirect_async(self.factory.get('/async'), alias='async')
+        self.assertEqual(recorder.pending_clicks, 2)
+
+    async def test_event_log_is_written_in_thread(self):
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=100)
+        loop_thread = threading.get_ident()
+        threads = []
+        with tempfile.TemporaryDirectory() as directory, self.settings(CLICK_EVENT_LOG_DIR=directory), \
+                mock.patch('app_urls.misc.get_click_recorder', return_value=recorder), \
+                mock.patch('app_urls.misc.log_click', side_effect=lambda *args: threads.append(threading.get_ident())):
+            await link_redirect_async(self.factory.get('/async'), alias='async')
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+        self.assertEqual(recorder.pending_clicks, 1)
+
+    @override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+    async def test_blocking_recorder_runs_in_thread(self):
+        await link_redirect_async(self.factory.get('/async'), alias='async')
+        click = await sync_to_async(Click.objects.get)(link=self.link)
+        self.assertEqual(click.clicks_count, 1)
+
+    async def test_local_hits_stay_in_event_loop(self):
+        await link_cache.resolve_alias_async('async')
+        with mock.patch('app_urls.cache.sync_to_async', side_effect=AssertionError):
+            link = await link_cache.resolve_alias_async('async')
+        self.assertEqual(link[:2], (self.link.id, URL))
+
+
+@override_settings(REQUEST_TIMING=1, CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+class TestRequestTiming(TestCase):
+    """
+    `RequestTimingMiddleware` times requests per URL name when enabled.
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        view_timings.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='timed')
+        self.client = Client()
+        return super().setUp()
+
+    def test_redirect_is_timed(self):
+        response = self.client.get('/timed')
+        self.assertEqual(response.status_code, 302)
+        self.assertRegex(response['Server-Timing'], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries"$')
+        timings = view_timings.snapshot()['app_urls:alias']
+        self.assertEqual(timings['count'], 1)
+        self.assertGreaterEqual(timings['queries_per_request'], 2)
+        self.assertEqual(sum(timings['histogram'].values()), 1)
+
+    async def test_async_requests_count_queries_in_threads(self):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user)
+        await client.get(reverse('app_urls:analytics'))  # loads the middleware
+        view_timings.clear()
+        # Like the ASGI handler, send `request_started` from the thread that
+        # runs the request's sync code.
+        await sync_to_async(request_started.send)(sender=None)
+        response = await client.get(reverse('app_urls:analytics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(view_timings.snapshot()['app_urls:analytics']['queries_per_request'], 0)
+
+    @override_settings(REQUEST_TIMING=0)
+    def test_disabled(self):
+        response = Client().get('/timed')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(view_timings.snapshot(), {})
+
+    def test_timings_endpoint_is_staff_only(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('app_urls:timings')).status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('app_urls:timings'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('app_urls:timings', response.json()['views'])
+
+    def test_percentiles_are_bucket_bounds(self):
+        timings = ViewTimings(buckets=(1, 10, 100))
+        for ms in [0.5] * 90 + [5] * 9 + [50]:
+            timings.record('view', ms / 1000, 1, 0)
+        view = timings.snapshot()['view']
+        self.assertEqual((view['p50_ms'], view['p95_ms'], view['p99_ms']), (1, 10, 10))
+        self.assertEqual(view['histogram'], {'1': 90, '10': 9, '100': 1, '+Inf': 0})
+
+
+@override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+class TestRedirectFastPath(TestCase):
+    """
+    `RedirectFastPathMiddleware` serves redirects before the rest of the
+    middleware stack and leaves other requests to it.
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.link = Link.objects.create(user=self.user, url=URL, alias='fast')
+        self.client = Client()
+        return super().setUp()
+
+    def test_redirect_skips_middleware(self):
+        response = self.client.get('/fast/path?q=1')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, URL + '/path')
+        self.assertNotIn('X-Frame-Options', response)
+        self.assertNotIn('Vary', response)
+        self.assertEqual(response.wsgi_request.resolver_match.view_name, 'app_urls:alias')
+        self.assertEqual(Click.objects.get(link=self.link).clicks_count, 1)
+        self.assertEqual(self.client.get('/invalid').status_code, 404)
+
+    def test_other_paths_use_full_stack(self):
+        self.client.force_login(self.user)
+        for path in ('/fast+', '/accounts/login/', '/admin/'):
+            response = self.client.get(path)
+            self.assertEqual(response['X-Frame-Options'], 'DENY', path)
+        self.assertFalse(Click.objects.exists())
+        # Other methods are redirected too, through the full stack.
+        response = self.client.post('/fast')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+    @override_settings(REQUEST_TIMING=1)
+    def test_redirect_is_timed(self):
+        view_timings.clear()
+        Client().get('/fast')
+        self.assertEqual(view_timings.snapshot()['app_urls:alias']['count'], 1)
+
+    @override_settings(REDIRECT_FAST_PATH=0)
+    def test_disabled(self):
+        response = Client().get('/fast')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+class TestReplicaRouting(TestCase):
+    """
+    Redirect lookups and analytics reads go to replicas, except for clients
+    that wrote recently.
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.client.force_login(self.user)
+        self.factory = RequestFactory()
+        return super().setUp()
+
+    def test_reads_in_block_go_to_replica(self):
+        self.assertEqual(router.db_for_read(Link), 'default')
+        with routers.read_from_replica(self.factory.get('/')) as database:
+            self.assertEqual(database, 'replica1')
+            self.assertEqual(router.db_for_read(Link), 'replica1')
+            self.assertEqual(router.db_for_write(Link), 'default')
+        self.assertEqual(router.db_for_read(Link), 'default')
+
+    def test_pinned_client_reads_primary(self):
+        request = self.factory.get('/', HTTP_COOKIE=f'{routers.PIN_COOKIE}=1')
+        with routers.read_from_replica(request) as database:
+            self.assertEqual(database, 'default')
+            self.assertEqual(router.db_for_read(Link), 'default')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        with routers.read_from_replica(self.factory.get('/')):
+            self.assertEqual(router.db_for_read(Link), 'default')
+
+    def test_writes_pin_client(self):
+        response = self.client.post(reverse('app_urls:index'), {'url': URL, 'alias': 'pinned'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], settings.REPLICA_PIN_SECONDS)
+        response = self.client.post(reverse('app_urls:update', args=('pinned',)), {
+            'url': URL + 'new', 'redirect_type': 302, 'cache_max_age': 0, 'click_sampling': 1})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertNotIn(routers.PIN_COOKIE, self.client.get(reverse('app_urls:analytics')).cookies)
+
+    def test_views_read_from_replica(self):
+        Link.objects.create(user=self.user, url=URL, alias='replicated')
+        databases = []
+
+        def record_database(*args, **kwargs):
+            databases.append(routers.current_read_db.get())
+            return 'default'
+
+        paths = ['/replicated', reverse('app_urls:analytics'), reverse('app_urls:chart_data', args=('replicated',))]
+        with mock.patch.object(routers.ReplicaRouter, 'db_for_read', side_effect=record_database):
+            for path in paths:
+                databases.clear()
+                self.assertLess(self.client.get(path).status_code, 400)
+                # Sessions and users are still read from the primary.
+                self.assertIn('replica1', databases, path)
+
+    def test_missing_alias_falls_back_to_primary(self):
+        Link.objects.create(user=self.user, url=URL, alias='lagging')
+        queries = []
+
+        def load(rows):
+            queries.append(rows.db)
+            return None if rows.db == 'replica1' else Link.objects.using('default').values_list(*link_cache.ResolvedLink._fields).get()
+
+        with routers.read_from_replica(), mock.patch('django.db.models.QuerySet.first', autospec=True, side_effect=load):
+            link = link_cache.resolve_alias('lagging')
+        self.assertEqual(queries, ['replica1', 'default'])
+        self.assertEqual(link.url, URL)
+
+
+@skipUnless(settings.DATABASE_REPLICAS, "Set SQL_REPLICAS to test against real replicas.")
+@override_settings(CLICK_RECORDER='app_urls.clicks.DirectClickRecorder')
+class TestReplicaDatabases(TransactionTestCase):
+    """
+    Routing against the databases named by `SQL_REPLICAS`, which mirror
+    `default` in tests. Run on its own, other tests don't expect replicas:
+    SQL_REPLICAS=replica.sqlite3 python manage.py test app_urls.tests.TestReplicaDatabases
+    """
+    databases = '__all__'
+
+    def test_redirect_reads_replica(self):
+        cache.clear()
+        link_cache.alias_cache.clear()
+        user = User.objects.create(email='user@gmail.com')
+        Link.objects.create(user=user, url=URL, alias='replicated')
+        replica = connections[settings.DATABASE_REPLICAS[0]]
+        with override_settings(DATABASE_REPLICAS=settings.DATABASE_REPLICAS[:1]), \
+                CaptureQueriesContext(replica) as replica_queries:
+            self.assertEqual(Client().get('/replicated').status_code, 302)
+        self.assertEqual(len(replica_queries), 1)
+        self.assertEqual(Click.objects.get().clicks_count, 1)
+
+
+def record_metrics_in_child():
+    metrics.REDIRECTS.inc(amount=3)
+    metrics.CLICK_BUFFER_DEPTH.set(5)
+
+
+@override_settings(CLICK_RECORDER='app_urls.clicks.BufferedClickRecorder')
+class TestMetrics(TestCase):
+    """
+    `/metrics` exposes redirect and click metrics summed over workers.
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(METRICS_DIR=self.directory.name)
+        self.settings_override.enable()
+        self.user = User.objects.create(email='user@gmail.com')
+        Link.objects.create(user=self.user, url=URL, alias='metered')
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+    def get_metrics(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return dict(
+            line.rsplit(' ', 1) for line in response.content.decode().splitlines() if not line.startswith('#')
+        )
+
+    def test_redirects_are_counted(self):
+        self.client.get('/metered')
+        self.client.get('/metered')
+        self.client.get('/missing')
+        values = self.get_metrics()
+        self.assertEqual(values['url_shortener_redirects_total'], '2')
+        self.assertEqual(values['url_shortener_redirect_not_found_total'], '1')
+        self.assertEqual(values['url_shortener_redirect_duration_seconds_count'], '3')
+        self.assertEqual(values['url_shortener_redirect_duration_seconds_bucket{le="+Inf"}'], '3')
+        self.assertEqual(values['url_shortener_alias_cache_lookups_total{result="local_hit"}'], '1')
+        self.assertEqual(values['url_shortener_alias_cache_lookups_total{result="miss"}'], '2')
+        self.assertEqual(values['url_shortener_clicks_recorded_total'], '2')
+
+    def test_flushes_are_timed(self):
+        recorder = BufferedClickRecorder(flush_interval=60, max_pending=1)
+        recorder.record(1, date.today(), '1.1.1.1')
+        recorder.record(1, date.today(), '1.1.1.1')
+        metrics.CLICK_BUFFER_DEPTH.set(recorder.pending_clicks)
+        self.assertEqual(self.get_metrics()['url_shortener_click_buffer_depth'], '1')
+        recorder.flush()
+        values = self.get_metrics()
+        self.assertEqual(values['url_shortener_clicks_dropped_total'], '1')
+        self.assertEqual(values['url_shortener_click_flush_duration_seconds_count'], '1')
+        self.assertEqual(values['url_shortener_click_buffer_depth'], '0')
+
+    def test_metrics_are_summed_over_processes(self):
+        metrics.REDIRECTS.inc()
+        metrics.CLICK_BUFFER_DEPTH.set(2)
+        child = multiprocessing.get_context('fork').Process(target=record_metrics_in_child)
+        child.start()
+        child.join()
+        values = self.get_metrics()
+        self.assertEqual(values['url_shortener_redirects_total'], '4')
+        # Gauges of processes that exited are left out.
+        self.assertEqual(values['url_shortener_click_buffer_depth'], '2')
+
+    def test_metrics_of_other_hosts(self):
+        """
+        Counters of processes on other hosts sharing `METRICS_DIR`, e.g.
+        the click worker's container, are summed. Their gauges are left
+        out, as it's unknown whether the processes still run.
+        """
+        store = metrics.registry.store
+        other = metrics.MetricsStore(store.size, store.directory, store.layout)
+        other.host = 'click_worker'
+        other.add(metrics.CLICK_FLUSH_ERRORS.get_index(), 3)
+        other.set(metrics.CLICK_BUFFER_DEPTH.get_index(), 5)
+        values = self.get_metrics()
+        self.assertEqual(values['url_shortener_click_flush_errors_total'], '3')
+        self.assertEqual(values['url_shortener_click_buffer_depth'], '0')
+
+    def test_metrics_alias_is_reserved(self):
+        form = URLShortenerForm(data={'url': URL, 'alias': 'Metrics'})
+        self.assertFalse(form.is_valid())
+
+
+class TestBulkLinkCreate(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        link_cache.alias_cache.clear()
+        self.user = User.objects.create(email='user@gmail.com')
+        self.authenticated_client = Client()
+        self.authenticated_client.force_login(user=self.user)
+        Link.objects.create(user=self.user, url=URL, alias='taken')
+        return super().setUp()
+
+    def post(self, **kwargs):
+        response = self.authenticated_client.post(reverse('app_urls:bulk_create'), **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_json_import(self):
+        self.assertIsNone(link_cache.resolve_alias('new-alias'))
+        lines = self.post(data=json.dumps({'links': [
+            {'url': URL, 'alias': 'New-Alias'},
+            {'url': URL},
+            {'url': URL},
+            {'url': 'not a url'},
+            {'url': URL, 'alias': 'taken'},
+            {'url': URL, 'alias': 'new-alias'},
+        ]}), content_type='application/json')
+        self.assertEqual(lines[-1], {'done': True, 'processed': 6, 'created': 3})
+        self.assertEqual([(p['row'], p['alias']) for p in lines[0]['problems']],
+                         [(4, ''), (5, 'taken'), (6, 'new-alias')])
+        self.assertEqual(Link.objects.filter(user=self.user).count(), 4)
+        self.assertEqual(link_cache.resolve_alias('new-alias').url, URL)
+
+    def test_csv_import(self):
+        upload = SimpleUploadedFile('links.csv', b'url,alias\nhttps://www.example.com/,csv-alias\nhttps://www.example.com/,\n')
+        lines = self.post(data={'file': upload})
+        self.assertEqual(lines[-1]['created'], 2)
+        self.assertTrue(Link.objects.filter(alias='csv-alias').exists())
+
+    def test_invalid_payload(self):
+        response = self.authenticated_client.post(
+            reverse('app_urls:bulk_create'), data='{"links": 1}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_import_under_asgi(self):
+        """
+        The ORM can't be used while ASGI streams the response in the event loop.
+        """
+        session = self.authenticated_client.cookies[settings.SESSION_COOKIE_NAME].value
+        token = 'a' * 32
+        body = ''.join(json.dumps({'url': URL, 'alias': f'asgi-{i}'}) + '\n' for i in range(3))
+        status, content = await asgi_request('POST', reverse('app_urls:bulk_create'), body=body.encode(), headers=[
+            ('cookie', f'{settings.SESSION_COOKIE_NAME}={session}; {settings.CSRF_COOKIE_NAME}={token}'),
+            ('x-csrftoken', token), ('content-type', 'application/x-ndjson'),
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content.splitlines()[-1]), {'done': True, 'processed': 3, 'created': 3})
+        self.assertEqual(await sync_to_async(Link.objects.filter(alias__startswith='asgi-').count)(), 3)
+
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=100)
+    def test_json_body_too_big(self):
+        links = [{'url': URL, 'alias': f'big-{i}'} for i in range(10)]
+        response = self.authenticated_client.post(
+            reverse('app_urls:bulk_create'), data=json.dumps(links), content_type='application/json')
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('application/x-ndjson', response.json()['error'])
+        self.assertFalse(Link.objects.filter(alias__startswith='big-').exists())
+
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=100)
+    def test_ndjson_and_csv_bodies_are_not_limited(self):
+        body = ''.join(json.dumps({'url': URL, 'alias': f'nd-{i}'}) + '\n' for i in range(10))
+        lines = self.post(data=body + '\nnot json\n[1]\n', content_type='application/x-ndjson')
+        self.assertEqual(lines[-1], {'done': True, 'processed': 12, 'created': 10})
+        self.assertEqual([p['row'] for p in lines[0]['problems']], [12, 13])
+        self.assertEqual(Link.objects.filter(alias__startswith='nd-').count(), 10)
+
+        body = 'url,alias\n' + ''.join(f'{URL},csv-{i}\n' for i in range(10))
+        lines = self.post(data=body, content_type='text/csv')
+        self.assertEqual(lines[-1]['created'], 10)
+        self.assertTrue(Link.objects.filter(alias='csv-9').exists())
+
+    def test_import_links_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as f:
+            f.write('url,alias\n')
+            for i in range(5):
+                f.write(f'{URL},cmd-{i}\n')
+            f.write(f'{URL},taken\n')
+            f.flush()
+            out, err = StringIO(), StringIO()
+            call_command('import_links', f.name, '--user', self.user.email, '--batch-size', '2',
+                         stdout=out, stderr=err)
+        self.assertIn('Processed 4 rows, created 4 links.', out.getvalue())
+        self.assertIn('6 rows, 5 links created, 1 rows skipped', out.getvalue())
+        self.assertIn('Row 7 (taken): Alias already exists.', err.getvalue())
+
+
+class TestRedirectBenchmark(TestCase):
+    """
+    `bench_redirects` replays Zipf traffic and reports comparable numbers.
+    """
+
+    def test_zipf_choices_favour_first_items(self):
+        picks = zipf_choices(['a', 'b', 'c', 'd'], 10000, s=1.5, rng=random.Random(0))
+        counts = [picks.count(item) for item in 'abcd']
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertEqual(sum(counts), 10000)
+
+    def test_bench_redirects_writes_json(self):
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as f:
+            call_command('bench_redirects', '--links', '50', '--clicks', '200', '--requests', '300',
+                         '--warmup', '50', '--miss-ratio', '0.1', '--output', f.name, stdout=StringIO())
+            results = json.load(f)
+        self.assertEqual(results['latency']['count'], 300)
+        self.assertEqual(sum(results['statuses'].values()), 300)
+        self.assertEqual(set(results['statuses']), {'302', '404'})
+        self.assertGreater(results['throughput_rps'], 0)
+        self.assertGreater(results['queries_per_request'], 0)
+        self.assertFalse(Link.objects.exists())
+
+
+class TestAnalyticsView(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='user@gmail.com')
+        self.authenticated_client = Client()
+        self.authenticated_client.force_login(user=self.user)
+        return super().setUp()
+
+    def create_links(self, count):
+        today = date.today()
+        increments = {}
+        for i in range(count):
+            link = Link.objects.create(user=self.user, url=URL, alias=f'link{i}')
+            for ip in ('1.1.1.1', '2.2.2.2'):
+                increments[(link.id, today, ip)] = i
+                increments[(link.id, today - timedelta(days=1), ip)] = 1
+        write_clicks(increments)
+
+    def test_clicks_are_read_from_stats(self):
+        """
+        Total clicks are summed and unique users are distinct IPs.
+        """
+        self.create_links(3)
+        response = self.authenticated_client.get(reverse('app_urls:analytics'))
+        links = {link.alias: link for link in response.context['links']}
+        self.assertEqual(links['link2'].get_clicks(), {'total_clicks': 6, 'unique_users': 2})
+        self.assertContains(response, '<td>6</td>', html=True)
+
+    def test_recent_unique_ips(self):
+        """
+        Recent unique IPs are merged from the daily sketches of the last 30 days.
+        """
+        self.create_links(1)
+        link = Link.objects.get()
+        write_clicks({
+            (link.id, date.today() - timedelta(days=10), '3.3.3.3'): 1,
+            (link.id, date.today() - timedelta(days=40), '4.4.4.4'): 1,
+        })
+        response = self.authenticated_client.get(reverse('app_urls:analytics'))
+        self.assertEqual(response.context['links'][0].recent_unique_ips, 3)
+        self.assertEqual(link.get_clicks()['unique_users'], 4)
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        """
+        The analytics page runs a constant number of queries
+        however many links are shown.
+        """
+        self.create_links(25)
+        for paginate_by in (1, 10, 25):
+            with self.subTest(paginate_by=paginate_by), \
+                    mock.patch.object(AnalyticsView, 'paginate_by', paginate_by), \
+                    self.assertNumQueries(5):
+                response = self.authenticated_client.get(reverse('app_urls:analytics'))
+                self.assertEqual(len(response.context['links']), paginate_by)
+
+
+class TestAnalyticsExport(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='user@gmail.com')
+        self.authenticated_client = Client()
+        self.authenticated_client.force_login(user=self.user)
+        self.links = [Link.objects.create(user=self.user, url=URL, alias=f'export{i}') for i in range(3)]
+        Link.objects.create(user=User.objects.create(email='user2@gmail.com'), url=URL, alias='other')
+        write_clicks({
+            (self.links[0].id, date(2022, 1, 1), '1.1.1.1'): 2,
+            (self.links[0].id, date(2022, 1, 3), '1.1.1.1'): 1,
+            (self.links[2].id, date(2022, 1, 2), '2.2.2.2'): 4,
+            (self.links[2].id, date(2022, 1, 9), '2.2.2.2'): 8,
+        })
+        return super().setUp()
+
+    def get_rows(self, **params):
+        response = self.authenticated_client.get(reverse('app_urls:analytics_export'), {
+            'start': '2022-01-01', 'end': '2022-01-03', **params})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        return response, [row.split(',')[:1] + row.split(',')[3:] for row in content.splitlines()]
+
+    def test_csv_export(self):
+        """
+        Every link of the user is exported with its totals and a column per day.
+        """
+        response, rows = self.get_rows(format='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('.csv', response['Content-Disposition'])
+        self.assertEqual(rows, [
+            ['alias', 'total_clicks', 'unique_ips', '2022-01-01', '2022-01-02', '2022-01-03'],
+            ['export0', '3', '1', '2', '0', '1'],
+            ['export1', '0', '0', '0', '0', '0'],
+            ['export2', '12', '1', '0', '4', '0'],
+        ])
+
+    async def test_csv_export_under_asgi(self):
+        """
+        The ORM can't be used while ASGI streams the response in the event loop.
+        """
+        session = self.authenticated_client.cookies[settings.SESSION_COOKIE_NAME].value
+        status, content = await asgi_request(
+            'GET', reverse('app_urls:analytics_export'), 'start=2022-01-01&end=2022-01-03',
+            headers=[('cookie', f'{settings.SESSION_COOKIE_NAME}={session}')])
+        self.assertEqual(status, 200)
+        rows = content.decode().splitlines()
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(rows[3].startswith('export2,'))
+
+    def test_parquet_falls_back_to_csv(self):
+        with mock.patch.object(export, 'pq', None):
+            response, rows = self.get_rows(format='parquet')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(len(rows), 4)
+
+    @skipIf(export.pq is None, "PyArrow is not installed.")
+    def test_parquet_export(self):
+        response = self.authenticated_client.get(reverse('app_urls:analytics_export'), {
+            'start': '2022-01-01', 'end': '2022-01-03', 'format': 'parquet'})
+        table = export.pq.read_table(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(table.column('alias').to_pylist(), ['export0', 'export1', 'export2'])
+        self.assertEqual(table.column('2022-01-02').to_pylist(), [0, 0, 4])
+
+    def test_links_are_streamed_in_chunks(self):
+        """
+        Each chunk of links is written with one daily clicks query.
+        """
+        chunks = export.stream_csv(self.user, date(2022, 1, 1), date(2022, 1, 3), chunk_size=2)
+        with self.assertNumQueries(3):
+            self.assertEqual(len(list(chunks)), 3)
+
+    def test_pivot(self):
+        daily_clicks = [(30, date(2022, 1, 2), 5), (10, date(2022, 1, 1), 1), (30, date(2022, 1, 1), 2)]
+        expected = [[1, 0], [0, 0], [2, 5]]
+        with mock.patch.object(export, 'np', None):
+            self.assertEqual(export.pivot_daily_clicks([10, 20, 30], daily_clicks, date(2022, 1, 1), 2), expected)
+        if export.np is not None:
+            matrix = export.pivot_daily_clicks([10, 20, 30], daily_clicks, date(2022, 1, 1), 2)
+            self.assertEqual(matrix.tolist(), expected)
+
+    def test_invalid_range(self):
+        response = self.authenticated_client.get(reverse('app_urls:analytics_export'), {'start': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestAliasAllocator(TransactionTestCase):
+    """
+    Generated aliases must stay unique when many workers and threads
+    create links at the same time.
+    """
+
+    def setUp(self) -> None:
+        alias_allocator.reset()
+        self.user = User.objects.create(email='user@gmail.com')
+
+    def tearDown(self) -> None:
+        alias_allocator.reset()
+
+    def test_allocate_reserves_blocks(self):
+        allocator = AliasAllocator(block_size=10)
+        numbers = [allocator.allocate() for _ in range(20)]
+        self.assertEqual(numbers, list(range(1, 21)))
+        self.assertEqual(AliasCounter.objects.get(name='link').value, 20)
+
+    def test_concurrent_creates_do_not_collide(self):
+        # One allocator per "worker" process, shared by its threads.
+        allocators = [AliasAllocator(block_size=7) for _ in range(3)]
+        threads_per_allocator, links_per_thread = 3, 250
+        failures = []
+
+        def retry_locked(func, *args):
+            # The in-memory test database uses SQLite's shared cache,
+            # which fails instead of waiting on table locks.
+            while True:
+                try:
+                    return func(*args)
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    time.sleep(0.001)
+
+        def create_links(allocator):
+            try:
+                for _ in range(links_per_thread):
+                    link = Link(user=self.user, url=URL)
+                    alias = hash_encode(retry_locked(allocator.allocate))
+                    if not retry_locked(save_with_alias, link, alias):
+                        failures.append(alias)
+            except Exception as e:
+                failures.append(e)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=create_links, args=(allocator,))
+            for allocator in allocators for _ in range(threads_per_allocator)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        total = len(threads) * links_per_thread
+        self.assertEqual(failures, [])
+        self.assertEqual(Link.objects.count(), total)
+        self.assertEqual(Link.objects.values('alias').distinct().count(), total)
 
 
 def create_link(user, url):
@@ -126,6 +1994,7 @@ class TestIndexView(TestCase):
     maxDiff = None
 
     def setUp(self) -> None:
+        alias_allocator.reset()
         self.user = User.objects.create(email='user@gmail.com')
         self.user2 = User.objects.create(email='user2@gmail.com')
 
@@ -171,14 +2040,15 @@ class TestIndexView(TestCase):
     def test_index_with_no_alias_with_database(self):
         """
         Even if the database was pre-populated, submitting the form
-        with no alias should create a new link as expected.
+        with no alias should create a new link as expected, skipping
+        generated aliases that are already taken.
         """
-        create_link(self.user, URL)
-        latest_link = create_link(self.user, URL)
+        Link.objects.create(user=self.user, url=URL, alias=hash_encode(1))
+        Link.objects.create(user=self.user, url=URL, alias=hash_encode(2))
         response = self.authenticated_client.post(reverse('app_urls:index'), {
             'url': URL,
         }, follow=True)
-        self.assert_link_created(response, hash_encode(latest_link.id + 1))
+        self.assert_link_created(response, hash_encode(3))
 
     def test_index_with_alias_with_database(self):
         """
@@ -199,13 +2069,13 @@ class TestIndexView(TestCase):
         and an appropriate message displayed.
         """
         link1 = create_link(self.user, URL)
-        link2 = create_link(self.user, URL)
+        create_link(self.user, URL)
         response = self.authenticated_client.post(reverse('app_urls:index'), {
             'url': URL,
             'alias': link1.alias,  # Uh oh, conflicts with the first link
         }, follow=True)
         self.assert_link_created(
-            response, link1.alias + "-" + hash_encode(link2.id + 1))
+            response, link1.alias + "-" + hash_encode(1))
         self.assertContains(response, link1.alias)
         self.assertContains(response, 'exists')
 
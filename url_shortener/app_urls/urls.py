@@ -1,15 +1,26 @@
 
+from django.conf import settings
 from django.urls import re_path
 from . import views
 
+if settings.ASYNC_REDIRECTS:
+    redirect_view = views.link_redirect_async
+else:
+    redirect_view = views.LinkRedirectView.as_view()
+
 app_name = 'app_urls'
 urlpatterns = [
     re_path(r'^$', views.NewLinkView.as_view(), name='index'),
-    re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)$', views.LinkRedirectView.as_view(), name='alias'),
-    re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)(?P<extra>/.*)$', views.LinkRedirectView.as_view(), name='alias'),
+    re_path(r'^metrics$', views.MetricsView.as_view(), name='metrics'),
+    re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)$', redirect_view, name='alias'),
+    re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)(?P<extra>/.*)$', redirect_view, name='alias'),
     re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)\+delete$', views.DeleteLinkView.as_view(), name='delete'),
     re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)\+update$', views.LinkUpdateView.as_view(), name='update'),
     re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)\+chart$', views.ChartDataView.as_view(), name='chart_data'),
     re_path(r'^(?P<alias>[a-zA-Z0-9-_]+)\+$', views.LinkPreview.as_view(), name='preview'),
     re_path(r'^~analytics/$', views.AnalyticsView.as_view(), name='analytics'),
+    re_path(r'^~analytics/charts$', views.ChartBatchView.as_view(), name='chart_batch'),
+    re_path(r'^~analytics/export$', views.AnalyticsExportView.as_view(), name='analytics_export'),
+    re_path(r'^~bulk/$', views.BulkLinkCreateView.as_view(), name='bulk_create'),
+    re_path(r'^~timings/$', views.RequestTimingsView.as_view(), name='timings'),
 ]
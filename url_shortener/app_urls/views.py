@@ -1,23 +1,72 @@
+import codecs
+import io
+import json
+from datetime import date, timedelta
+
+from django.conf import settings
 from django.urls import reverse, reverse_lazy
 from django.shortcuts import get_object_or_404
 from django.contrib import messages
-from django.http import HttpResponseRedirect, JsonResponse
-from django.utils.timezone import datetime, timedelta
+from django.core.exceptions import RequestDataTooBig
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.db.models import FilteredRelation, Q
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.edit import FormView, DeleteView, UpdateView
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
-from django.views.generic.base import RedirectView
 from django.contrib.auth.mixins import LoginRequiredMixin
 
-from .misc import (hash_encode,
+from . import cache as link_cache
+from .bulk import import_links, read_csv_rows, read_ndjson_rows
+from .cache import resolve_alias, resolve_alias_async
+from .misc import (count_unique_ips,
+                   generate_alias,
                    get_absolute_short_url,
-                   process_new_click)
+                   get_chart_date_range,
+                   get_daily_series,
+                   get_redirect_response,
+                   get_streaming_content,
+                   normalize_alias,
+                   process_new_click,
+                   process_new_click_async,
+                   save_with_alias)
+from .export import CONTENT_TYPES as EXPORT_CONTENT_TYPES, get_export_format, stream_export
 from .forms import URLShortenerForm
-from .models import Click, Link
+from .metrics import observe_redirect, registry, view_timings
+from .models import DailyClicks, Link
+from .routers import pin_to_primary, read_from_replica
+
+
+class PinToPrimaryMixin:
+    """
+    Pins the client to the primary database after a POST, so that it reads
+    its own writes for a while instead of a lagging replica.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        if request.method == 'POST' and response.status_code < 400:
+            pin_to_primary(response)
+        return response
 
 
-class NewLinkView(LoginRequiredMixin, FormView):
+class ReplicaReadMixin:
+    """
+    Runs the reads of the view, including those of a lazily rendered
+    template, on a read replica.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with read_from_replica(request):
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+
+class NewLinkView(LoginRequiredMixin, PinToPrimaryMixin, FormView):
     template_name = 'app_urls/index.html'
     form_class = URLShortenerForm
 
@@ -27,48 +76,105 @@ class NewLinkView(LoginRequiredMixin, FormView):
         alias = original_alias.lower()
         url = form.cleaned_data['url']
         new_link = Link(user=request.user, url=url)
-        try:
-            latest_link = Link.objects.latest('id')
-            if Link.objects.filter(alias__exact=alias).exists():
-                # handle alias conflict
-                new_link.alias = alias + '-' + hash_encode(latest_link.id + 1)
-                messages.add_message(request, messages.INFO,
-                                     'Short URL {} already exists so a new short URL was created.'
-                                     .format(get_absolute_short_url(request, original_alias)))
-                original_alias = new_link.alias
-            else:
-                new_link.alias = alias or hash_encode(latest_link.id + 1)
-        except Link.DoesNotExist:
-            new_link.alias = alias or hash_encode(1)
-        new_link.save()
+        if alias and not save_with_alias(new_link, alias):
+            # handle alias conflict
+            messages.add_message(request, messages.INFO,
+                                 'Short URL {} already exists so a new short URL was created.'
+                                 .format(get_absolute_short_url(request, original_alias)))
+            alias += '-'
+            original_alias = ''
+        if not new_link.pk:
+            # generated aliases can still clash with custom ones
+            while not save_with_alias(new_link, alias + generate_alias()):
+                pass
         return HttpResponseRedirect(reverse('app_urls:preview', args=(original_alias or new_link.alias,)))
 
 
-class LinkPreview(LoginRequiredMixin, DetailView):
+class AliasLookupMixin:
+    """
+    Looks the link up by its normalized alias with an exact match,
+    which can use the unique index on `Link.alias`.
+    """
+    slug_url_kwarg = 'alias'
+    slug_field = 'alias'
+
+    def get_object(self, queryset=None):
+        if queryset is None:
+            queryset = self.get_queryset()
+        alias = normalize_alias(self.kwargs.get(self.slug_url_kwarg, ''))
+        return get_object_or_404(queryset, alias=alias)
+
+
+class BulkLinkCreateView(LoginRequiredMixin, PinToPrimaryMixin, View):
+    """
+    Creates many links at once from a JSON list of `{"url": ..., "alias": ...}`
+    objects, a CSV file (`file` field) with `url` and `alias` columns, or a
+    CSV or newline delimited JSON body. Streams one JSON line per batch with
+    its progress and the rows that couldn't be created, followed by a
+    summary line.
+
+    Uploaded files and CSV and NDJSON bodies are read as they are imported,
+    JSON lists are limited by `DATA_UPLOAD_MAX_MEMORY_SIZE`. Under ASGI the
+    whole import runs before the results are sent, see
+    `get_streaming_content`.
+    """
+    batch_size = 1000
+
+    def post(self, request, *args, **kwargs):
+        if 'file' in request.FILES:
+            rows = read_csv_rows(io.TextIOWrapper(request.FILES['file'], encoding='utf-8-sig'))
+        elif request.content_type == 'text/csv':
+            rows = read_csv_rows(codecs.iterdecode(request, 'utf-8-sig'))
+        elif request.content_type == 'application/x-ndjson':
+            rows = read_ndjson_rows(request)
+        else:
+            try:
+                data = json.loads(request.body)
+            except RequestDataTooBig:
+                return JsonResponse(data={"error": (
+                    f"JSON bodies are limited to {settings.DATA_UPLOAD_MAX_MEMORY_SIZE} bytes, upload a CSV file "
+                    "or send CSV (text/csv) or one link per line (application/x-ndjson) instead.")}, status=413)
+            except ValueError:
+                return JsonResponse(data={"error": "Expected a JSON list of links or a CSV file."}, status=400)
+            if isinstance(data, dict):
+                data = data.get('links')
+            if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+                return JsonResponse(data={"error": "Expected a JSON list of links or a CSV file."}, status=400)
+            rows = enumerate(data, start=1)
+        return StreamingHttpResponse(
+            get_streaming_content(request, self.stream(rows)), content_type='application/x-ndjson')
+
+    def stream(self, rows):
+        processed = created = 0
+        for result in import_links(self.request.user, rows, self.batch_size):
+            processed += result.processed
+            created += len(result.created)
+            yield json.dumps(result.as_dict()) + '\n'
+        yield json.dumps({'done': True, 'processed': processed, 'created': created}) + '\n'
+
+
+class LinkPreview(LoginRequiredMixin, AliasLookupMixin, DetailView):
     model = Link
     template_name = 'app_urls/preview.html'
-    slug_url_kwarg = 'alias'
-    slug_field = 'alias__iexact'
 
     def get_queryset(self):
-        return Link.objects.filter(user=self.request.user)
+        return Link.objects.filter(user=self.request.user).with_stats()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        obj = self.get_object()
+        obj = self.object
         context.update({
             'alias': obj.alias,
             'absolute_short_url': get_absolute_short_url(self.request, obj.alias, remove_schema=False),
             'url': obj.url,
+            'clicks': obj.get_clicks(),
         })
         return context
 
 
-class LinkUpdateView(LoginRequiredMixin, UpdateView):
+class LinkUpdateView(LoginRequiredMixin, PinToPrimaryMixin, AliasLookupMixin, UpdateView):
     model = Link
-    fields = ['url']
-    slug_url_kwarg = 'alias'
-    slug_field = 'alias__iexact'
+    fields = ['url', 'redirect_type', 'cache_max_age', 'click_sampling']
     template_name_suffix = '_update_form'
     success_url = reverse_lazy('app_urls:analytics')
 
@@ -76,62 +182,233 @@ class LinkUpdateView(LoginRequiredMixin, UpdateView):
         return Link.objects.filter(user=self.request.user)
 
 
-class DeleteLinkView(LoginRequiredMixin, DeleteView):
+class DeleteLinkView(LoginRequiredMixin, PinToPrimaryMixin, AliasLookupMixin, DeleteView):
     model = Link
-    slug_url_kwarg = 'alias'
-    slug_field = 'alias__iexact'
     success_url = reverse_lazy('app_urls:analytics')
 
     def get_queryset(self):
         return Link.objects.filter(user=self.request.user)
 
 
-class LinkRedirectView(RedirectView):
-    permanent = False
+@method_decorator(csrf_exempt, name='dispatch')
+class LinkRedirectView(View):
+    """
+    Redirects an alias to its link following the link's redirect policy,
+    see `get_redirect_response`. Like `RedirectView`, every method is
+    redirected, which 308 redirects pass on to the link. Redirects change
+    nothing but click counts, so they don't need a CSRF token.
+    """
 
-    def get_redirect_url(self, *args, **kwargs):
-        alias = kwargs.get('alias', '')
-        extra = kwargs.get('extra', '')
-        link = get_object_or_404(Link, alias__iexact=alias)
-        process_new_click(self.request, link)
-        return link.url + extra
+    def get(self, request, alias, extra=''):
+        with observe_redirect():
+            with read_from_replica(request):
+                link = resolve_alias(alias)
+            if link is None:
+                raise Http404('No link matches the given alias.')
+            process_new_click(request, link)
+            return get_redirect_response(request, link, extra)
+
+    def head(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
+    def options(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
+    def delete(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
+    def put(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
+    def patch(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
+
+async def link_redirect_async(request, alias, extra=''):
+    """
+    Async variant of `LinkRedirectView`, used when `ASYNC_REDIRECTS` is set
+    and the project is served over ASGI. Aliases cached by this worker
+    and buffered clicks are handled without leaving the event loop.
+    """
+    with observe_redirect():
+        with read_from_replica(request):
+            link = await resolve_alias_async(alias)
+        if link is None:
+            raise Http404('No link matches the given alias.')
+        await process_new_click_async(request, link)
+        return get_redirect_response(request, link, extra)
+
+
+# `csrf_exempt` would wrap the coroutine function in a sync view.
+link_redirect_async.csrf_exempt = True
 
 
-class AnalyticsView(LoginRequiredMixin, ListView):
+class AnalyticsView(LoginRequiredMixin, ReplicaReadMixin, ListView):
     model = Link
     paginate_by = 10
     context_object_name = 'links'
     template_name = 'app_urls/analytics.html'
+    # Days covered by the recent unique IPs column.
+    recent_days = 30
 
     def get_queryset(self):
-        return Link.objects.filter(user=self.request.user)
+        return Link.objects.filter(user=self.request.user).with_stats()
+
+    def get_context_data(self, **kwargs):
+        """
+        Adds the estimated unique IPs of the last `recent_days` days to every
+        link of the page, merged from their daily sketches in one query.
+        """
+        context = super().get_context_data(**kwargs)
+        links = context['links']
+        start_date = date.today() - timedelta(days=self.recent_days - 1)
+        recent_unique_ips = count_unique_ips(DailyClicks.objects.filter(
+            link_id__in=[link.id for link in links], date__gte=start_date).values_list('link_id', 'unique_ips_sketch'))
+        for link in links:
+            link.recent_unique_ips = recent_unique_ips.get(link.id, 0)
+        context['recent_days'] = self.recent_days
+        return context
+
+
+class AnalyticsExportView(LoginRequiredMixin, View):
+    """
+    Streams all links of the user with their click totals and daily clicks
+    from `start` to `end` (see `app_urls.export`). `format` is `csv` or
+    `parquet`, which falls back to CSV if PyArrow isn't installed.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            start_date, end_date = get_chart_date_range(request.GET.get('start'), request.GET.get('end'))
+        except ValueError as e:
+            return JsonResponse(data={"error": str(e)}, status=400)
+        export_format = get_export_format(request.GET.get('format', 'csv'))
+        response = StreamingHttpResponse(
+            get_streaming_content(request, stream_export(request.user, start_date, end_date, export_format)),
+            content_type=EXPORT_CONTENT_TYPES[export_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="links-{start_date}-{end_date}.{export_format}"'
+        return response
 
 
-class ChartDataView(LoginRequiredMixin, View):
+class ChartDataView(LoginRequiredMixin, ReplicaReadMixin, View):
     def get(self, request, *args, **kwargs):
         alias = kwargs.get('alias', '')
-        link = get_object_or_404(Link, alias__iexact=alias)
-        if link.user != request.user:
+        link = get_object_or_404(Link, alias=normalize_alias(alias))
+        if link.user_id != request.user.id:
+            return JsonResponse(
+                data={"error": "Permission denied."},
+                status=403
+            )
+        try:
+            start_date, end_date = get_chart_date_range(request.GET.get('start'), request.GET.get('end'))
+        except ValueError as e:
+            return JsonResponse(data={"error": str(e)}, status=400)
+        days = DailyClicks.objects.filter(
+            link=link, date__range=(start_date, end_date)).values_list('date', 'clicks', 'unique_ips_sketch')
+        clicks, sketches = {}, []
+        for day, day_clicks, sketch in days:
+            clicks[day] = day_clicks
+            sketches.append((day, sketch))
+        labels, data = get_daily_series(start_date, end_date, clicks)
+        _, unique_data = get_daily_series(start_date, end_date, count_unique_ips(sketches))
+        return JsonResponse(data={
+            'labels': labels,
+            'data': data,
+            'unique_data': unique_data,
+            'unique_ips': count_unique_ips((None, sketch) for _, sketch in sketches).get(None, 0),
+        })
+
+
+class ChartBatchView(LoginRequiredMixin, ReplicaReadMixin, View):
+    """
+    Chart data of many links of the user at once: the links named by
+    `alias` parameters, or all links (`all=1`, paginated with `page`), from
+    `start` to `end`. Links are looked up and permissions checked in the
+    same query that reads their daily clicks. Aliases that don't exist or
+    belong to another user are listed in `missing`.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            start_date, end_date = get_chart_date_range(request.GET.get('start'), request.GET.get('end'))
+        except ValueError as e:
+            return JsonResponse(data={"error": str(e)}, status=400)
+        max_links = settings.CHART_BATCH_MAX_LINKS
+        links = Link.objects.filter(user=request.user)
+        data = {}
+        if request.GET.get('all'):
+            try:
+                page = int(request.GET.get('page', 1))
+            except ValueError:
+                page = 0
+            if page < 1:
+                return JsonResponse(data={"error": "Page must be a positive integer."}, status=400)
+            link_ids = list(links.order_by('-date_created', '-id').values_list('id', flat=True)[
+                (page - 1) * max_links:page * max_links + 1])
+            data['has_next'] = len(link_ids) > max_links
+            link_ids = link_ids[:max_links]
+            links = links.filter(id__in=link_ids)
+            aliases = None
+        else:
+            aliases = list(dict.fromkeys(normalize_alias(alias) for alias in request.GET.getlist('alias')))
+            if not aliases:
+                return JsonResponse(data={"error": "Pass one or more aliases, or all=1."}, status=400)
+            if len(aliases) > max_links:
+                return JsonResponse(data={"error": f"At most {max_links} aliases can be requested at once."},
+                                    status=400)
+            links = links.filter(alias__in=aliases)
+
+        rows = links.annotate(days=FilteredRelation(
+            'daily_clicks', condition=Q(daily_clicks__date__range=(start_date, end_date)),
+        )).order_by('-date_created', '-id').values_list('alias', 'days__date', 'days__clicks')
+        daily_clicks = {}
+        for alias, day, clicks in rows:
+            counts = daily_clicks.setdefault(alias, {})
+            if day is not None:
+                counts[day] = clicks
+        labels, _ = get_daily_series(start_date, end_date, {})
+        series = []
+        for alias in (aliases if aliases is not None else daily_clicks):
+            if alias in daily_clicks:
+                _, clicks = get_daily_series(start_date, end_date, daily_clicks[alias])
+                series.append({'alias': alias, 'total': sum(clicks), 'data': clicks})
+        data.update({
+            'labels': labels,
+            'series': series,
+            'missing': [alias for alias in aliases or () if alias not in daily_clicks],
+        })
+        return JsonResponse(data=data)
+
+
+class RequestTimingsView(LoginRequiredMixin, View):
+    """
+    Per-view request timings of this worker process, collected by
+    `RequestTimingMiddleware`, and its alias cache and alias filter
+    statistics, including the memory the filter takes. Staff only.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
             return JsonResponse(
                 data={"error": "Permission denied."},
                 status=403
             )
-        today = datetime.today()
-        start_date = request.GET.get('start')
-        end_date = request.GET.get('end')
-        if not start_date:
-            start_date = today - timedelta(days=7)
-        if not end_date:
-            end_date = today
-        clicks = Click.objects.filter(link=link, clicked_date__range=[start_date, end_date])
-        chart_data = {}
-        for click in clicks.iterator():
-            str_date = str(click.clicked_date)
-            if str_date in chart_data:
-                chart_data[str_date] += click.clicks_count
-            else:
-                chart_data[str_date] = click.clicks_count
         return JsonResponse(data={
-            'labels': list(chart_data.keys()),
-            'data': list(chart_data.values())
+            'enabled': bool(settings.REQUEST_TIMING),
+            'views': view_timings.snapshot(),
+            'alias_cache': link_cache.alias_cache.stats(),
         })
+
+
+class MetricsView(View):
+    """
+    Redirect and click metrics of all workers in the Prometheus text format.
+    Reads only the metric files, never the database.
+    """
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
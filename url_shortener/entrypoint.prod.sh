@@ -11,4 +11,11 @@ then
     echo "PostgreSQL started"
 fi
 
+if [ -n "$METRICS_DIR" ]
+then
+    # Metrics of the previous run's workers of this container. Other
+    # containers sharing the directory keep theirs.
+    rm -f "$METRICS_DIR"/metrics-*-"$(hostname | tr - _)"-*.db
+fi
+
 exec "$@"
@@ -49,7 +49,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app_urls.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'app_urls.middleware.RedirectFastPathMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -78,6 +80,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'url_shortener.wsgi.application'
 
+# Serve redirects with the async view. Only worth it over ASGI
+# (see docker-compose.prod.yml), under WSGI it adds overhead.
+ASYNC_REDIRECTS = int(environ.get("ASYNC_REDIRECTS", default=0))
+
 
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
@@ -90,6 +96,65 @@ DATABASES = {
         "PASSWORD": environ.get("SQL_PASSWORD", "password"),
         "HOST": environ.get("SQL_HOST", "localhost"),
         "PORT": environ.get("SQL_PORT", "5432"),
+        # Seconds to keep a connection open for later requests, 0 to
+        # connect on every request. Ignored with SQL_POOL.
+        "CONN_MAX_AGE": int(environ.get("SQL_CONN_MAX_AGE", 0)),
+    }
+}
+
+# With SQL_POOL=1, every worker process reuses PostgreSQL connections from
+# a pool of SQL_POOL_SIZE connections, see `app_urls.pool`. Workers use one
+# connection per thread running queries, and all workers together must stay
+# below PostgreSQL's max_connections.
+if int(environ.get("SQL_POOL", 0)) and DATABASES["default"]["ENGINE"] == "django.db.backends.postgresql":
+    DATABASES["default"].update(
+        ENGINE="app_urls.backends.postgresql_pool",
+        CONN_MAX_AGE=0,
+        POOL={
+            "max_size": int(environ.get("SQL_POOL_SIZE", 4)),
+            # Seconds to wait for a free connection.
+            "timeout": float(environ.get("SQL_POOL_TIMEOUT", 10)),
+            # Seconds after which connections are replaced.
+            "max_age": int(environ.get("SQL_POOL_MAX_AGE", 30 * 60)),
+            # Seconds after which idle connections are closed.
+            "max_idle": int(environ.get("SQL_POOL_MAX_IDLE", 5 * 60)),
+            # Connections idle for longer are checked before they're used.
+            "check_after": int(environ.get("SQL_POOL_CHECK_AFTER", 10)),
+        },
+    )
+
+# Read replicas, space separated: `host` or `host:port` of every replica or,
+# with SQLite, their database files. Redirect lookups and analytics reads
+# go to a random replica, see `app_urls.routers`.
+DATABASE_REPLICAS = []
+for number, replica in enumerate(environ.get("SQL_REPLICAS", "").split(), 1):
+    database = dict(DATABASES["default"], TEST={"MIRROR": "default"})
+    if database["ENGINE"] == "django.db.backends.sqlite3":
+        database["NAME"] = replica
+    else:
+        host, _, port = replica.partition(":")
+        database.update(HOST=host, PORT=port or database["PORT"])
+    DATABASES[f"replica{number}"] = database
+    DATABASE_REPLICAS.append(f"replica{number}")
+
+DATABASE_ROUTERS = ["app_urls.routers.ReplicaRouter"]
+
+# Seconds a client reads from the primary after a write, so that it sees
+# its changes while replicas catch up.
+REPLICA_PIN_SECONDS = int(environ.get("REPLICA_PIN_SECONDS", 10))
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Set CACHE_BACKEND/CACHE_LOCATION to share the cache between workers, e.g.
+# django.core.cache.backends.memcached.PyMemcacheCache (as in .env.prod) or
+# django_redis.cache.RedisCache. The local-memory default is per process,
+# so cached aliases only live as long as LINK_CACHE_LOCAL_TIMEOUT in it.
+
+CACHES = {
+    "default": {
+        "BACKEND": environ.get("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": environ.get("CACHE_LOCATION", ""),
     }
 }
 
@@ -147,3 +212,77 @@ LOGOUT_REDIRECT_URL = 'accounts:login'
 # Google ReCaptcha
 RECAPTCHA_PUBLIC_KEY = "6LdsHTMeAAAAAGOi1CBLZbq-GISKKwH1sz8EJ9Po"
 RECAPTCHA_PRIVATE_KEY = environ.get("RECAPTCHA_PRIVATE_KEY", "fake-key")
+
+# Click recording
+# `app_urls.clicks.BufferedClickRecorder` keeps up to `CLICK_BUFFER_MAX_PENDING`
+# clicks per worker in memory and writes them in bulk every
+# `CLICK_BUFFER_FLUSH_INTERVAL` seconds, also when the worker gets no requests.
+# `app_urls.clicks.DirectClickRecorder` writes every click during the redirect.
+CLICK_RECORDER = environ.get(
+    "CLICK_RECORDER", "app_urls.clicks.BufferedClickRecorder")
+CLICK_BUFFER_FLUSH_INTERVAL = float(
+    environ.get("CLICK_BUFFER_FLUSH_INTERVAL", 5))
+CLICK_BUFFER_MAX_PENDING = int(environ.get("CLICK_BUFFER_MAX_PENDING", 10000))
+# `app_urls.clicks.SpoolClickRecorder` queues clicks in the SQLite file at
+# `CLICK_SPOOL_PATH`, drained by `manage.py click_worker`, and drops clicks
+# while `CLICK_SPOOL_MAX_PENDING` of them are waiting.
+CLICK_SPOOL_PATH = environ.get("CLICK_SPOOL_PATH", BASE_DIR / "click_spool.sqlite3")
+CLICK_SPOOL_MAX_PENDING = int(environ.get("CLICK_SPOOL_MAX_PENDING", 1000000))
+# Raw click events are appended to segments of at most
+# `CLICK_EVENT_LOG_SEGMENT_SIZE` bytes in `CLICK_EVENT_LOG_DIR`, if it's set.
+CLICK_EVENT_LOG_DIR = environ.get("CLICK_EVENT_LOG_DIR")
+CLICK_EVENT_LOG_SEGMENT_SIZE = int(environ.get("CLICK_EVENT_LOG_SEGMENT_SIZE", 64 * 1024 * 1024))
+# Full months of clicks kept before the current one by `manage.py
+# partition_clicks`, which drops older monthly partitions (PostgreSQL) or
+# deletes older clicks. Click counters and daily clicks are kept. 0 keeps
+# all clicks.
+CLICK_RETENTION_MONTHS = int(environ.get("CLICK_RETENTION_MONTHS", 0))
+
+# Alias resolution cache
+# Each worker keeps up to `LINK_CACHE_LOCAL_SIZE` aliases for
+# `LINK_CACHE_LOCAL_TIMEOUT` seconds in front of the `LINK_CACHE_ALIAS` cache.
+LINK_CACHE_ALIAS = "default"
+LINK_CACHE_TIMEOUT = int(environ.get("LINK_CACHE_TIMEOUT", 60 * 60))
+LINK_CACHE_NEGATIVE_TIMEOUT = int(
+    environ.get("LINK_CACHE_NEGATIVE_TIMEOUT", 60))
+LINK_CACHE_LOCAL_SIZE = int(environ.get("LINK_CACHE_LOCAL_SIZE", 10000))
+LINK_CACHE_LOCAL_TIMEOUT = int(environ.get("LINK_CACHE_LOCAL_TIMEOUT", 30))
+
+# Bloom filter of all aliases, shared by the processes that see the same
+# `ALIAS_FILTER_DIR` through a file in it, see `app_urls.bloom`. Unknown
+# aliases it rules out get a 404 without any cache or database lookup.
+# Unset disables it.
+ALIAS_FILTER_DIR = environ.get("ALIAS_FILTER_DIR")
+ALIAS_FILTER_ERROR_RATE = float(environ.get("ALIAS_FILTER_ERROR_RATE", 0.01))
+# The filter is sized for twice the links at build time, at least this many.
+ALIAS_FILTER_MIN_CAPACITY = int(environ.get("ALIAS_FILTER_MIN_CAPACITY", 100000))
+# Seconds between rebuilds, which also drop deleted aliases.
+ALIAS_FILTER_REBUILD_INTERVAL = int(environ.get("ALIAS_FILTER_REBUILD_INTERVAL", 60 * 60))
+# Seconds between reads of the links created since, e.g. by other hosts
+# that don't share the filter file.
+ALIAS_FILTER_SYNC_INTERVAL = int(environ.get("ALIAS_FILTER_SYNC_INTERVAL", 5))
+
+# Longest date range (in days) a chart can be requested for.
+CHART_MAX_DAYS = 366
+# Most links the batch chart endpoint returns series of in one response.
+CHART_BATCH_MAX_LINKS = int(environ.get("CHART_BATCH_MAX_LINKS", 500))
+
+# Numbers for generated aliases are reserved from the database in blocks
+# of this size per worker.
+ALIAS_BLOCK_SIZE = int(environ.get("ALIAS_BLOCK_SIZE", 100))
+
+# Record per-view wall time, query count and DB time, returned in a
+# Server-Timing header and aggregated at /~timings/ (staff only).
+REQUEST_TIMING = int(environ.get("REQUEST_TIMING", 0))
+
+# Serve redirects before sessions, CSRF, auth and URL resolution, see
+# `app_urls.middleware.RedirectFastPathMiddleware`.
+REDIRECT_FAST_PATH = int(environ.get("REDIRECT_FAST_PATH", 1))
+
+# Directory where every worker keeps its redirect and click metrics, so
+# /metrics can sum them over workers. Unset keeps them in process memory.
+METRICS_DIR = environ.get("METRICS_DIR")
+
+# Longest time, in seconds, nginx keeps a cacheable redirect before asking
+# Django again (links set their own `Cache-Control: max-age`).
+REDIRECT_PROXY_CACHE_MAX_AGE = int(environ.get("REDIRECT_PROXY_CACHE_MAX_AGE", 10))